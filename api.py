@@ -2,69 +2,420 @@
 
 Here are defined all endpoints of the Recommendation Service API, namely
 GET `/api/v1/books/<book_id>` to get information about a book queried by ID
-GET `/api/v1/books?q` to get books by title or author's name
-POST `/api/v1/books/<book_id>/recommendations` to get book recommendations for a book by ID
+GET `/api/v1/books?q&limit&cursor&fields` to get books by title or author's name, page by page
+POST `/api/v1/books/<book_id>/recommendations?top_n` to get book recommendations for a book by ID,
+    `?mode=ann&nprobe=N` searches the whole catalog with the ANN index,
+    `?mode=dtw&window=N` matches emotional arcs shifted by up to N chunks
+POST `/api/v1/books/recommendations?top_n` to get book recommendations for many books by ID at once
+GET `/metrics` to get the metrics of a worker process in the Prometheus text format
+POST `/api/v1/admin/changes` to apply the changes of the catalog to a worker process now
 """
 
-import json
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-from flask import Flask, request
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import Flask, Response, g, request
 
-from src.logic import get_candidates
-from src.utils import get_config, get_sorted, make_query, preprocess_resp
-from src.db_utils import get_book_by, db_fetch
+from src import codec
+from src.ann import get_ann_index
+from src.cache import get_cache
+from src.changes import get_change_feed, start_change_feed
+from src.concurrency import DeadlineExceeded, get_process_pool, get_single_flight, \
+    run_concurrently, run_in_processes
+from src.features import get_feature_store
+from src import metrics
+from src.logic import get_batch_candidates, get_dtw_top_candidates, get_sharded_top_candidates, \
+    get_top_candidates
+from src.models import Book
+from src.resilience import CircuitOpen, Overloaded
+from src.search import get_search_index
+from src.snapshot import start_snapshots, warm_start
+from src.utils import decode_cursor, encode_cursor, get_config, get_sorted, make_projection, \
+    make_query, preprocess_resp, recommendation_key
+from src.db_utils import get_book_by, db_fetch, not_deleted, search_page_by_auth_or_title
 
 app = Flask(__name__)
 
 DB_ADDRESS = get_config()["mongo_rest_interface_addr"]
+ANN_CONFIG = get_config()["ann_index"]
+FETCH_DEADLINE = get_config()["fetch_deadline"]
+SEARCH_CONFIG = get_config()["search_index"]
+SHARDING_CONFIG = get_config()["sharded_scoring"]
+DTW_CONFIG = get_config()["dtw"]
+CHANGE_FEED_CONFIG = get_config()["change_feed"]
+DB_PROTECTION_CONFIG = get_config()["db_protection"]
+SNAPSHOT_CONFIG = get_config()["snapshot"]
+MAX_TOP_N = 100
+MAX_BATCH_SIZE = 100
+
+# fields of the candidates needed to score them, the rest is fetched for the top matches only
+SCORING_FIELDS = {"id": 1, "metadata.title": 1, "sentiment.timeline": 1}
 
 handler = RotatingFileHandler(get_config()["log_file"], maxBytes=10000000, backupCount=1)
 handler.setLevel(logging.INFO)
 handler.setFormatter(logging.Formatter(get_config()["log_format"]))
-app.logger.addHandler(handler)
+# requests only enqueue their log records, the file is written by the listener's thread
+log_queue = queue.Queue()
+log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+app.logger.addHandler(QueueHandler(log_queue))
 app.logger.setLevel(logging.INFO)
 
+@app.before_request
+def start_timer():
+    """Notes when the request started, see `observe_request`"""
+    g.started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    """Records the duration of the request in `metrics.REQUEST_SECONDS`"""
+    if "started" in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.started,
+                                        request.endpoint or "unknown", response.status_code)
+    return response
+
+if SNAPSHOT_CONFIG["enabled"]:
+    # a no-op if the gunicorn master loaded the snapshot already, see `gunicorn.conf.py`
+    warm_start(get_config())
+    start_snapshots(get_config())
+
+if CHANGE_FEED_CONFIG["enabled"]:
+    start_change_feed(CHANGE_FEED_CONFIG["poll_interval"])
+
+@app.route("/api/v1/admin/changes", methods=["POST"])
+def pull_changes():
+    """Applies the changes of the catalog since the last poll of the change feed
+    now, instead of waiting for the next one, see `src.changes`. Only the worker
+    serving the request is updated, the others catch up at their next poll."""
+    feed = get_change_feed()
+    applied = feed.poll()
+
+    app.logger.info("Output: 200 OK, %d changed books", applied) # [LOGGING]
+    return codec.dumps({"applied": applied, "watermark": feed.watermark}), \
+        {"Content-Type": "application/json"}
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Metrics of this worker process, in the Prometheus text format"""
+    return metrics.render(), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route("/api/v1/books/<book_id>", methods=["GET"])
 def get_book(book_id):
-    """Get specific book by it's ID"""
+    """Get specific book by it's ID.
+
+    While the Database Service is turned away, see `src.resilience`, a copy
+    of the book cached earlier is returned, with a `X-Stale: true` header."""
     app.logger.info("Input: %s", book_id) # [LOGGING]
 
-    response = preprocess_resp(get_book_by("id", DB_ADDRESS, book_id))
+    headers = {"Content-Type": "application/json"}
+    try:
+        book = get_book_by("id", DB_ADDRESS, book_id)
+    except Overloaded as error:
+        book = _get_stale("books", (DB_ADDRESS, book_id), error)
+        headers["X-Stale"] = "true"
+    response = codec.dumps(preprocess_resp(book))
 
     app.logger.info("Output: 200 OK") # [LOGGING]
-    return response, {"Content-Type": "application/json"}
+    return response, headers
 
 @app.route("/api/v1/books", methods=["GET"])
 def list_all_books():
-    """Return all books with matching names for `author` or `title`"""
+    """Return at most `limit` books with matching names for `author` or `title`.
+
+    Queries are answered with the local search index, best first, or with a regex
+    search in the database, in `id` order, while the index isn't built yet. The
+    `X-Search-Mode` header of the response tells which one served the request.
+
+    Results are paginated, when there are more the `X-Next-Cursor` header holds the
+    `cursor` argument of the request for the next page. A cursor is only valid in the
+    search mode which produced it, e.g. once the index is built, a cursor of the regex
+    search gets a 400 response and the search must start again from the first page.
+    Only the comma-separated `fields` are returned when given, e.g. `fields=metadata,genre`
+    leaves out the sentiment timelines. The books are encoded one at a time as they are sent."""
     search_query = request.args.get("q", "")
+    limit = request.args.get("limit", SEARCH_CONFIG["default_limit"], type=int)
+    cursor = request.args.get("cursor")
+    fields = request.args.get("fields")
 
     app.logger.info("Input: %s", search_query) # [LOGGING]
 
-    response = preprocess_resp(get_book_by("author_or_title", DB_ADDRESS, search_query))
+    if not 1 <= limit <= SEARCH_CONFIG["max_limit"]:
+        return _bad_request("limit must be between 1 and {}".format(SEARCH_CONFIG["max_limit"]))
+    try:
+        position = decode_cursor(cursor) if cursor else {}
+        projection = make_projection(fields) if fields else None
+    except ValueError as error:
+        return _bad_request(str(error))
+
+    index = get_search_index(DB_ADDRESS, SEARCH_CONFIG["refresh_interval"]) \
+        if SEARCH_CONFIG["enabled"] else None
+    search_mode = "index" if index is not None else "regex"
+    if position and position.get("mode") != search_mode:
+        return _bad_request("The cursor is from another search mode, search again")
+
+    if index is not None:
+        offset = position.get("offset", 0)
+        if not isinstance(offset, int) or offset < 0:
+            return _bad_request("Invalid cursor")
+
+        # one more than the page, to know whether there is a next one
+        ranked_ids = index.search(search_query, offset + limit + 1)
+        book_ids = ranked_ids[offset:offset + limit]
+        books = db_fetch(DB_ADDRESS, not_deleted({"id": {"$in": book_ids}}), projection)["resp"] \
+            if book_ids else []
+        rank = {book_id: i for i, book_id in enumerate(book_ids)}
+        books = sorted(books, key=lambda book: rank[book["id"]])
+        next_position = {"offset": offset + limit} if len(ranked_ids) > offset + limit else None
+    else:
+        books = search_page_by_auth_or_title(DB_ADDRESS, search_query, limit + 1,
+                                             position.get("after"), projection)["resp"]
+        next_position = {"after": books[limit - 1]["id"]} if len(books) > limit else None
+        books = books[:limit]
+
+    headers = {"Content-Type": "application/json", "X-Search-Mode": search_mode}
+    if next_position is not None:
+        headers["X-Next-Cursor"] = encode_cursor({"mode": search_mode, **next_position})
 
     app.logger.info("Output: 200 OK") # [LOGGING]
-    return response, {"Content-Type": "application/json"}
+    return Response(_stream_array(books), headers=headers)
+
+def _stream_array(docs):
+    """Encodes `docs` as a JSON array, one document at a time, as a generator
+    of chunks of the response body"""
+    yield "["
+    for i, doc in enumerate(docs):
+        yield ("," if i else "") + codec.dumps(doc)
+    yield "]"
 
 @app.route("/api/v1/books/<book_id>/recommendations", methods=["POST"])
 def recommend(book_id):
-    """Returns 5 most similar books to the one which's `id` was passed as URL argument"""
-    filters = json.loads(request.get_json())
+    """Returns `top_n` (5 by default) most similar books to the one which's `id`
+    was passed as URL argument.
+
+    With `?mode=ann` they are searched in the whole catalog using the ANN index,
+    `nprobe` trades latency for recall. With `?mode=dtw` the books are compared
+    with dynamic time warping, so that similar emotional arcs shifted by up to
+    `window` of the 100 chunks of a timeline still match. The
+    `X-Recommendation-Mode` header of the response tells which mode served the
+    request, as `ann` falls back to `exact` when the index can't serve it.
+
+    While the Database Service is turned away, see `src.resilience`, recommendations
+    cached earlier are returned, with a `X-Stale: true` header."""
+    filters = codec.loads(request.get_json())
+    top_n = request.args.get("top_n", 5, type=int)
+    mode = request.args.get("mode", "exact")
+    nprobe = request.args.get("nprobe", ANN_CONFIG["nprobe"], type=int) if mode == "ann" else None
+    window = request.args.get("window", DTW_CONFIG["window"], type=int) if mode == "dtw" else None
 
     app.logger.info("Input: %s", filters) # [LOGGING]
 
-    base = json.loads(get_book_by("id", DB_ADDRESS, book_id))["resp"][0]
+    if mode not in ("exact", "ann", "dtw"):
+        return _bad_request("Unknown mode '{}'".format(mode))
+    if not 1 <= top_n <= MAX_TOP_N:
+        return _bad_request("top_n must be between 1 and {}".format(MAX_TOP_N))
+    if window is not None and not 0 <= window <= DTW_CONFIG["max_window"]:
+        return _bad_request("window must be between 0 and {}".format(DTW_CONFIG["max_window"]))
+
+    query = make_query(filters)
+    cache = get_cache("recommendations")
+    key = recommendation_key(book_id, query, top_n, mode, nprobe, window)
+
+    headers = {"Content-Type": "application/json"}
+    result = cache.get(key)
+    if result is None:
+        try:
+            # identical requests arriving meanwhile wait for this one instead of scoring again
+            result = get_single_flight("recommendations").do(
+                key, lambda: _recommend_and_cache(key, book_id, query, top_n, mode, nprobe,
+                                                  window))
+        except Overloaded as error:
+            result = _get_stale("recommendations", key, error)
+            headers["X-Stale"] = "true"
+    response, served_mode, _ = result
+
+    app.logger.info("Output: 200 OK") # [LOGGING]
+    return response, {**headers, "X-Recommendation-Mode": served_mode}
+
+@app.route("/api/v1/books/recommendations", methods=["POST"])
+def recommend_batch():
+    """Returns `top_n` (5 by default) most similar books to each of the books
+    which's `id`s were passed in the request body, along with shared filters,
+    as `{"ids": [str], "filters": obj}`. The response maps every `id` to its
+    recommendations, books which don't exist get none."""
+    body = codec.loads(request.get_json())
+    top_n = request.args.get("top_n", 5, type=int)
+
+    app.logger.info("Input: %s", body) # [LOGGING]
+
+    book_ids = body.get("ids")
+    if not isinstance(book_ids, list) or not 1 <= len(book_ids) <= MAX_BATCH_SIZE:
+        return _bad_request("ids must be a list of 1 to {} book IDs".format(MAX_BATCH_SIZE))
+    filters = body.get("filters")
+    if not isinstance(filters, dict):
+        return _bad_request("filters must be an object")
+    if not 1 <= top_n <= MAX_TOP_N:
+        return _bad_request("top_n must be between 1 and {}".format(MAX_TOP_N))
+
     query = make_query(filters)
+    bases, matches = run_concurrently([lambda: get_book_by("ids", DB_ADDRESS, book_ids),
+                                       lambda: _fetch_candidates(query)],
+                                      timeout=FETCH_DEADLINE)
+    bases = bases["resp"]
+    metrics.CANDIDATES.observe(len(matches), "recommend_batch")
 
-    matches = json.loads(db_fetch(DB_ADDRESS, query))["resp"]
-    scores = get_candidates(base, matches)
+    # one more than `top_n`, as `get_sorted` drops the base book if it matches the filters
+    all_scores = get_batch_candidates(bases, matches, top_n + 1, store=get_feature_store())
 
-    response = json.dumps(get_sorted(base["metadata"]["title"], scores))
+    known_ids = {base["id"] for base in bases}
+    top_ids = list({entry["id"] for scores in all_scores for entries in scores.values()
+                    for entry in entries} - known_ids)
+    top_objs = get_book_by("ids", DB_ADDRESS, top_ids)["resp"] if top_ids else []
+
+    recommendations = {base["id"]: get_sorted(base["metadata"]["title"], scores, top_n=top_n,
+                                              base_id=base["id"], docs=[*bases, *top_objs])
+                       for base, scores in zip(bases, all_scores)}
+    response = codec.dumps({book_id: recommendations.get(book_id, []) for book_id in book_ids})
 
     app.logger.info("Output: 200 OK") # [LOGGING]
     return response, {"Content-Type": "application/json"}
 
+def _get_stale(cache_name, key, error):
+    """Value under `key` in the cache `cache_name`, even expired, or raises `error`"""
+    value = get_cache(cache_name).get_stale(key)
+    if value is None:
+        raise error
+
+    metrics.STALE_RESPONSES.inc(request.endpoint)
+    return value
+
+def _bad_request(message):
+    """Response to a request with invalid arguments"""
+    app.logger.info("Output: 400 Bad Request") # [LOGGING]
+    return codec.dumps({"error": message}), 400, {"Content-Type": "application/json"}
+
+def _recommend_and_cache(key, *args):
+    """`_recommend`, with its result kept in the recommendations cache under `key`.
+    Returns the response body, the mode which produced it and the IDs of the
+    recommended books, see `src.utils.invalidate_recommendations`."""
+    recommendations, mode = _recommend(*args)
+    result = (codec.dumps(recommendations), mode,
+              tuple(match["title"]["id"] for match in recommendations))
+    get_cache("recommendations").set(key, result)
+    return result
+
+def _recommend(book_id, query, top_n=5, mode="exact", nprobe=None, window=None):
+    """Scores the books matching `query` against the book `book_id`,
+    returns the recommendations and the mode which produced them"""
+    if mode == "ann":
+        recommendations = _recommend_ann(book_id, query, top_n, nprobe)
+        if recommendations is not None:
+            return recommendations, "ann"
+
+    base, matches = run_concurrently([lambda: get_book_by("id", DB_ADDRESS, book_id),
+                                      lambda: _fetch_candidates(query)],
+                                     timeout=FETCH_DEADLINE)
+    base = base["resp"][0]
+    metrics.CANDIDATES.observe(len(matches), "recommend")
+    # one more than `top_n`, as `get_sorted` drops the base book if it matches the filters
+    if mode == "dtw":
+        scores = get_dtw_top_candidates(base, matches, top_n + 1, window,
+                                        store=get_feature_store())
+    else:
+        scores, mode = _score(base, matches, top_n + 1), "exact"
+
+    # `matches` are partial, the top ones are fetched in full by `get_sorted`
+    return get_sorted(base["metadata"]["title"], scores, top_n=top_n, base_id=book_id,
+                      docs=[base]), mode
+
+def _score(base, matches, top_n):
+    """Scores `matches` against `base` with `get_top_candidates`. Many matches are
+    scored in the process pool instead, so that the worker keeps serving requests."""
+    workers = SHARDING_CONFIG["workers"]
+    if not SHARDING_CONFIG["enabled"] or len(matches) < SHARDING_CONFIG["min_candidates"] \
+            or get_process_pool(workers) is None:
+        return get_top_candidates(base, matches, top_n, store=get_feature_store())
+
+    run_shards = lambda func, shards: run_in_processes(func, shards, workers,
+                                                       timeout=SHARDING_CONFIG["timeout"])
+    with metrics.stage("sharded_scoring"):
+        return get_sharded_top_candidates(base, matches, top_n, run_shards, workers,
+                                          store=get_feature_store())
+
+def _fetch_candidates(query):
+    """Fetches the books matching `query`, with only the fields needed to score them,
+    as compact `Book`s.
+
+    The timelines of the books in the feature store aren't needed, so when there is
+    one only IDs and titles are fetched, then the timelines of the books missing from it.
+    Removed books are left out, see `src.changes`.
+    """
+    query = not_deleted(query)
+    store = get_feature_store()
+    if store is None:
+        docs = db_fetch(DB_ADDRESS, query, SCORING_FIELDS)["resp"]
+        with metrics.stage("reshape"):
+            return [Book.from_json(match) for match in docs]
+
+    docs = db_fetch(DB_ADDRESS, query, {"id": 1, "metadata.title": 1})["resp"]
+    with metrics.stage("reshape"):
+        matches = [Book.from_json(match) for match in docs]
+    missing = [match.id for match in matches if match.id not in store]
+    if not missing:
+        return matches
+
+    docs = db_fetch(DB_ADDRESS, not_deleted({"id": {"$in": missing}}), SCORING_FIELDS)["resp"]
+    with metrics.stage("reshape"):
+        timelines = {match["id"]: Book.from_json(match) for match in docs}
+    return [match if match.id in store else timelines[match.id]
+            for match in matches if match.id in store or match.id in timelines]
+
+def _recommend_ann(book_id, query, top_n, nprobe):
+    """Finds the books most similar to the book `book_id` in the ANN index and keeps
+    those matching `query`. Returns None if the index can't serve the request."""
+    index = get_ann_index()
+    if index is None or book_id not in index:
+        return None
+
+    hits = [(hit_id, score) for hit_id, score in
+            index.search(index.vector(book_id), (top_n + 1) * ANN_CONFIG["oversample"], nprobe)
+            if hit_id != book_id]
+    hits_query = not_deleted({"$and": [query, {"id": {"$in": [hit_id for hit_id, _ in hits]}}]})
+
+    base, matches = run_concurrently([lambda: get_book_by("id", DB_ADDRESS, book_id),
+                                      lambda: db_fetch(DB_ADDRESS, hits_query)],
+                                     timeout=FETCH_DEADLINE)
+    base = base["resp"][0]
+    matches = matches["resp"]
+    metrics.CANDIDATES.observe(len(matches), "recommend_ann")
+    if len(matches) < top_n:
+        return None
+
+    base_title = base["metadata"]["title"]
+    titles = {match["id"]: match["metadata"]["title"] for match in matches}
+    scores = [{"score": score, "title": titles[hit_id], "id": hit_id}
+              for hit_id, score in hits if hit_id in titles]
+
+    return get_sorted(base_title, {base_title: scores}, top_n=top_n, base_id=book_id,
+                      docs=[base, *matches])
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(error):
+    """The database service didn't answer in time"""
+    app.logger.info("Output: 504 Gateway Timeout, %s", error) # [LOGGING]
+    return codec.dumps({"error": str(error)}), 504, {"Content-Type": "application/json"}
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    """The Database Service is failing or overloaded, and nothing cached can be served"""
+    retry_after = DB_PROTECTION_CONFIG["breaker"]["reset_timeout"] \
+        if isinstance(error, CircuitOpen) else 1
+    app.logger.info("Output: 503 Service Unavailable, %s", error) # [LOGGING]
+    return codec.dumps({"error": str(error)}), 503, \
+        {"Content-Type": "application/json", "Retry-After": str(int(retry_after))}
+
 
 if __name__ == "__main__":
     # app.run(host="0.0.0.0", port=8000, debug=True)
@@ -117,9 +468,10 @@ if __name__ == "__main__":
     }
 
 
-    base = json.loads(get_book_by("id", DB_ADDRESS, book_id))["resp"][0]
+    base = get_book_by("id", DB_ADDRESS, book_id)["resp"][0]
     query = make_query(filters)
 
-    matches = json.loads(db_fetch(DB_ADDRESS, query))["resp"]
-    scores = get_candidates(base, matches)
-    response = json.dumps(get_sorted(base["metadata"]["title"], scores))
+    matches = _fetch_candidates(query)
+    scores = _score(base, matches, 6)
+    response = codec.dumps(get_sorted(base["metadata"]["title"], scores, base_id=book_id,
+                                      docs=[base]))
@@ -0,0 +1,228 @@
+"""Benchmark suite
+
+Times every stage of the recommendation pipeline on a synthetic catalog, see
+`src.catalog`, and the API endpoints end to end against a local Database Service
+listening at `mongo_rest_interface_addr`, see `src.local_db`. The results are
+written as JSON, and can be compared with those of a previous run.
+
+Usage: python benchmark.py [--books N] [--median-events N] [--repeat N] [--seed N]
+                           [--output PATH] [--compare PATH] [--tolerance R] [--skip-e2e]
+                           [--db-latency MS]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+from src import features
+from src.cache import get_cache
+from src.catalog import generate_catalog, make_filters
+from src.local_db import LocalDatabase, serve_in_background
+from src.logic import (batch_similarity, get_candidates, get_dtw_top_candidates, get_max_len,
+                       get_top_candidates, reshape_transform, vectorize)
+from src.models import Book
+from src.utils import get_config, get_sorted, make_query
+
+
+def measure(func, repeat, setup=None):
+    """Times `repeat` calls of `func`, after a warm-up call.
+
+    Parameters
+    ----------
+    func : callable
+    repeat : int
+    setup : callable, optional
+        Called before every call of `func`, untimed, its result is passed to `func`.
+
+    Returns
+    -------
+    dict
+        Number of calls, minimum, median, 95th percentile and mean, in milliseconds.
+    """
+    timings = []
+    for i in range(repeat + 1):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        if i: # the first call warms up caches
+            timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {"n": repeat,
+            "min_ms": timings[0],
+            "median_ms": statistics.median(timings),
+            "p95_ms": timings[min(int(0.95 * repeat), repeat - 1)],
+            "mean_ms": statistics.mean(timings)}
+
+def micro_benchmarks(books, repeat):
+    """Benchmarks of every stage of `src.logic` and `src.utils`, on `books[0]`
+    as the base book and all books as candidates"""
+    base, candidates = books[0], books
+    filters = make_filters(author=base["metadata"]["author"], characters=("aliens",))
+    timelines = [reshape_transform(book["sentiment"]["timeline"]) for book in candidates]
+    max_len = get_max_len(timelines) + 1
+    tensor = vectorize(timelines, max_len)
+    compact = [Book.from_json(book) for book in candidates]
+    scores = get_candidates(base, compact)
+
+    store_path = tempfile.mkdtemp()
+    try:
+        features.build_feature_store(os.path.join(store_path, "features"), candidates)
+        store = features.FeatureStore(os.path.join(store_path, "features"))
+        ids_only = [Book(book.id, book.title, None) for book in compact]
+
+        return {
+            "utils.make_query": measure(lambda: make_query(filters), repeat),
+            "models.Book.from_json": measure(
+                lambda: [Book.from_json(book) for book in candidates], repeat),
+            "logic.reshape_transform": measure(
+                lambda: [reshape_transform(book["sentiment"]["timeline"]) for book in candidates],
+                repeat),
+            "logic.get_max_len": measure(lambda: get_max_len(timelines), repeat),
+            "logic.vectorize": measure(lambda: vectorize(timelines, max_len), repeat),
+            "logic.batch_similarity": measure(lambda: batch_similarity(tensor[0], tensor), repeat),
+            "logic.get_candidates": measure(lambda: get_candidates(base, candidates), repeat),
+            "logic.get_candidates[books]": measure(lambda: get_candidates(base, compact), repeat),
+            "logic.get_top_candidates[books]": measure(
+                lambda: get_top_candidates(base, compact, 6), repeat),
+            "logic.get_top_candidates[store]": measure(
+                lambda: get_top_candidates(base, ids_only, 6, store=store), repeat),
+            "logic.get_dtw_top_candidates[books]": measure(
+                lambda: get_dtw_top_candidates(base, compact, 6, window=10), repeat),
+            # `get_sorted` consumes the scores, so every call gets a copy
+            "utils.get_sorted": measure(
+                lambda scores_copy: get_sorted(base["metadata"]["title"], scores_copy,
+                                               base_id=base["id"], docs=candidates),
+                repeat, setup=lambda: {k: [dict(e) for e in v] for k, v in scores.items()})
+        }
+    finally:
+        shutil.rmtree(store_path)
+
+def e2e_benchmarks(books, repeat, latency=0):
+    """Benchmarks of the API endpoints, through Flask's test client, against a
+    local Database Service answering in `latency` seconds"""
+    config = get_config()
+    os.makedirs(os.path.dirname(config["log_file"]) or ".", exist_ok=True)
+    import api # reads the configuration and opens the log file on import
+
+    url = urlparse(config["mongo_rest_interface_addr"])
+    server = serve_in_background(LocalDatabase(books), host=url.hostname, port=url.port,
+                                 latency=latency)
+    store_path = tempfile.mkdtemp()
+    try:
+        client = api.app.test_client()
+        base = books[0]
+        body = json.dumps(json.dumps(make_filters(author=base["metadata"]["author"],
+                                                  characters=("aliens",))))
+        recommend = lambda mode="exact": client.post(
+            "/api/v1/books/{}/recommendations?mode={}".format(base["id"], mode),
+            data=body, content_type="application/json")
+        batch_body = json.dumps(json.dumps({"ids": [book["id"] for book in books[:10]],
+                                            "filters": json.loads(json.loads(body))}))
+        clear_caches = lambda: [get_cache(name).clear() for name in ("books", "recommendations")]
+
+        results = {}
+        # the feature store of the working directory, if any, is replaced by none or by one
+        # built from the synthetic catalog
+        features.build_feature_store(os.path.join(store_path, "features"), books)
+        for label, store in [("", None),
+                             ("[store]", features.FeatureStore(os.path.join(store_path,
+                                                                           "features")))]:
+            features._STORE["store"] = store # pylint: disable=protected-access
+            results["api.recommend" + label] = measure(lambda _: recommend(), repeat,
+                                                       setup=clear_caches)
+            results["api.recommend[dtw]" + label] = measure(lambda _: recommend("dtw"), repeat,
+                                                            setup=clear_caches)
+            results["api.recommend_batch" + label] = measure(
+                lambda _: client.post("/api/v1/books/recommendations", data=batch_body,
+                                      content_type="application/json"),
+                repeat, setup=clear_caches)
+        results["api.recommend[cached]"] = measure(recommend, repeat)
+        results["api.get_book"] = measure(
+            lambda _: client.get("/api/v1/books/{}".format(base["id"])), repeat,
+            setup=clear_caches)
+
+        return results
+    finally:
+        features._STORE.pop("store", None) # pylint: disable=protected-access
+        shutil.rmtree(store_path)
+        server.shutdown()
+        server.server_close()
+
+def compare(results, baseline, tolerance):
+    """Prints the median of every benchmark next to the one of `baseline`,
+    and returns the names of those slower by more than `tolerance`"""
+    regressions = []
+    for name, stats in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            print("{:40} {:10.3f} ms  (new)".format(name, stats["median_ms"]))
+            continue
+
+        ratio = stats["median_ms"] / old["median_ms"] if old["median_ms"] else float("inf")
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+        print("{:40} {:10.3f} ms  {:10.3f} ms  x{:.2f}{}".format(
+            name, stats["median_ms"], old["median_ms"], ratio, "  SLOWER" if slower else ""))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--books", type=int, default=2000, help="number of synthetic books")
+    parser.add_argument("--median-events", type=int, default=400,
+                        help="median number of timeline events of a book")
+    parser.add_argument("--repeat", type=int, default=10, help="timed calls per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="file to write results to")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown of a median over which the comparison fails")
+    parser.add_argument("--skip-e2e", action="store_true", help="skip the API benchmarks")
+    parser.add_argument("--db-latency", type=float, default=0,
+                        help="milliseconds the local Database Service delays responses by")
+    args = parser.parse_args()
+
+    books = generate_catalog(args.books, args.median_events, args.seed)
+    results = micro_benchmarks(books, args.repeat)
+    if not args.skip_e2e:
+        results.update(e2e_benchmarks(books, args.repeat, args.db_latency / 1000))
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                 "python": platform.python_version(),
+                 "numpy": np.__version__,
+                 "platform": platform.platform(),
+                 "books": args.books,
+                 "median_events": args.median_events,
+                 "events": sum(len(book["sentiment"]["timeline"]) for book in books),
+                 "repeat": args.repeat,
+                 "db_latency_ms": args.db_latency,
+                 "seed": args.seed},
+        "results": results
+    }
+    with open(args.output, "w") as output_ptr:
+        json.dump(report, output_ptr, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_ptr:
+            baseline = json.load(baseline_ptr)["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    else:
+        for name, stats in sorted(results.items()):
+            print("{:40} {:10.3f} ms".format(name, stats["median_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Feature store builder
+
+Pulls the whole catalog from the Database Service and writes the feature store
+and the ANN index the Recommendation Service API memory-maps at `feature_store.path`
+and `ann_index.path`, see `src.features` and `src.ann`.
+
+Usage: python build_features.py [--path PATH] [--ann-path PATH] [--ann-lists N] [--db-address URL]
+"""
+
+import argparse
+
+from src.db_utils import db_fetch
+from src.ann import build_ann_index
+from src.changes import latest_change
+from src.features import build_feature_store, FeatureStore
+from src.utils import get_config
+
+
+def main():
+    config = get_config()
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--path", default=config["feature_store"]["path"],
+                        help="directory to write the feature store to")
+    parser.add_argument("--ann-path", default=config["ann_index"]["path"],
+                        help="directory to write the ANN index to")
+    parser.add_argument("--ann-lists", type=int, default=config["ann_index"]["n_lists"],
+                        help="number of clusters of the ANN index")
+    parser.add_argument("--db-address", default=config["mongo_rest_interface_addr"],
+                        help="address of the Database Service")
+    args = parser.parse_args()
+
+    books = db_fetch(args.db_address, {})["resp"]
+    # removed books only count for the watermark
+    count = build_feature_store(args.path, [book for book in books if not book.get("deleted")],
+                                latest_change(books, config["change_feed"]["field"]))
+    print("Wrote {} books to {}".format(count, args.path))
+
+    count = build_ann_index(args.ann_path, FeatureStore(args.path), args.ann_lists)
+    print("Wrote {} books to {}".format(count, args.ann_path))
+
+
+if __name__ == "__main__":
+    main()
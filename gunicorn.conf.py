@@ -0,0 +1,30 @@
+"""Gunicorn configuration of the Recommendation Service API, see `runserver`
+
+The master process loads the snapshot of the caches and the search index
+before it forks the workers, see `src.snapshot`, so they start warm and share
+the loaded objects copy-on-write. With `--reload` the workers load it
+themselves instead, as modules imported by the master aren't reloaded.
+"""
+
+# the master imports the application's modules, they must see the patched stdlib
+from gevent import monkey
+monkey.patch_all()
+
+bind = "127.0.0.1:8000"
+workers = 3
+worker_class = "gevent"
+worker_connections = 2048
+
+def on_starting(server):
+    """Loads the snapshot in the master, before the workers are forked"""
+    if server.cfg.reload:
+        return
+
+    from src.snapshot import warm_start
+    from src.utils import get_config
+
+    config = get_config()
+    if config["snapshot"]["enabled"]:
+        counts = warm_start(config)
+        server.log.info("Snapshot %s: %s", config["snapshot"]["path"],
+                        counts if counts is not None else "not loaded")
@@ -0,0 +1,48 @@
+"""Local Database Service
+
+Serves a catalog file, or a synthetic catalog, from memory as a stand-in for
+the Database Service, see `src.local_db`. By default it listens at the
+`mongo_rest_interface_addr` of the configuration file.
+
+Usage: python serve_catalog.py (CATALOG | --generate N) [--address URL] [--latency MS] [--jitter MS]
+"""
+
+import argparse
+from urllib.parse import urlparse
+
+from src.catalog import generate_catalog, load_catalog
+from src.local_db import LocalDatabase, make_server
+from src.utils import get_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("catalog", nargs="?", help="JSON or NDJSON file of book objects")
+    parser.add_argument("--generate", type=int, metavar="N",
+                        help="serve N synthetic books instead of a catalog file")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic catalog")
+    parser.add_argument("--address", default=get_config()["mongo_rest_interface_addr"],
+                        help="address to listen at")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds every response is delayed by")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="up to this many milliseconds are added at random to the delay")
+    args = parser.parse_args()
+    if (args.catalog is None) == (args.generate is None):
+        parser.error("either a catalog file or --generate is required")
+
+    books = load_catalog(args.catalog) if args.catalog else \
+        generate_catalog(args.generate, seed=args.seed)
+    url = urlparse(args.address)
+    server = make_server(LocalDatabase(books), url.hostname, url.port,
+                         args.latency / 1000, args.jitter / 1000)
+
+    print("Serving {} books at {}".format(len(books), args.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Approximate nearest neighbours module
+
+This module indexes the sentiment vectors of the whole catalog, so that the
+books most similar to a given one can be found without scoring every book.
+
+The similarity of `logic.get_candidates` is the sum of 6 per-emotion cosines.
+Once every emotion's chunk sums are scaled to unit length, that sum is the dot
+product of the concatenated vectors, so an inverted file index (IVF) over them
+answers maximum inner product queries: books are clustered by spherical
+k-means, and a query only scores the books of the `nprobe` closest clusters.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import copy
+import json
+import os
+import threading
+
+import numpy as np
+
+from .features import write_arrays
+from .logic import bucket_events, chunk_layout, EMOTIONS
+from .utils import get_config
+
+FORMAT_VERSION = 1
+
+
+def unit_vectors(tensor):
+    """Scales every emotion of every book to unit length and flattens them.
+
+    Parameters
+    ----------
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks), as built by `logic.vectorize`.
+
+    Returns
+    -------
+    numpy.ndarray
+        Float32 array of shape (n_books, 6 * n_chunks). Emotions without
+        any sentiment stay 0, as their cosine with anything is 0.
+    """
+    norms = np.sqrt(np.einsum("nec,nec->ne", tensor, tensor))
+    norms[norms == 0] = 1
+    return (tensor / norms[:, :, None]).reshape(len(tensor), -1).astype(np.float32)
+
+def _spherical_kmeans(vectors, n_lists, n_iter, seed):
+    """Clusters unit vectors by cosine, returns the centroids and assignments"""
+    rnd = np.random.RandomState(seed)
+    centroids = vectors[rnd.choice(len(vectors), n_lists, replace=False)].astype(np.float64)
+
+    for _ in range(n_iter):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        norms = np.linalg.norm(sums, axis=1)
+        non_empty = norms > 0
+        centroids[non_empty] = sums[non_empty] / norms[non_empty, None]
+
+    return centroids.astype(np.float32), np.argmax(vectors @ centroids.T, axis=1)
+
+def build_ann_index(path, store, n_lists=None, n_iter=10, seed=0):
+    """Writes the ANN index of all books of a feature store to the directory `path`.
+
+    Parameters
+    ----------
+    path : str
+    store : src.features.FeatureStore
+    n_lists : int, optional
+        Number of clusters, the square root of the number of books by default.
+    n_iter : int, optional
+        Number of k-means iterations.
+    seed : int, optional
+
+    Returns
+    -------
+    int
+        The number of books in the index.
+    """
+    max_len = int(store.lengths.max()) + 1 if len(store) else 1
+    n_chunks, _ = chunk_layout(max_len)
+
+    tensor = np.zeros((len(store), len(EMOTIONS), n_chunks))
+    for row, book_id in enumerate(store.ids):
+        timeline = store.timeline(book_id)
+        tensor[row] = bucket_events(timeline.codes, timeline.indices, timeline.scores, max_len)
+    vectors = unit_vectors(tensor)
+
+    n_lists = min(n_lists or int(np.sqrt(len(store))) or 1, max(len(store), 1))
+    if len(store):
+        centroids, assignments = _spherical_kmeans(vectors, n_lists, n_iter, seed)
+    else:
+        centroids, assignments = np.zeros((1, vectors.shape[1]), np.float32), np.zeros(0, int)
+
+    order = np.argsort(assignments, kind="mergesort")
+    list_offsets = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+
+    write_arrays(path, {"vectors": vectors,
+                        "centroids": centroids,
+                        "order": order.astype(np.int64),
+                        "list_offsets": list_offsets.astype(np.int64)},
+                 {"version": FORMAT_VERSION, "max_len": max_len, "ids": store.ids})
+
+    return len(store)
+
+class AnnIndex(object):
+    """Read-only view of an ANN index directory.
+
+    Books changed since the index was built are kept in memory, see `updated`,
+    until they are folded into the arrays, see `compacted`.
+
+    Parameters
+    ----------
+    path : str
+        The directory written by `build_ann_index`.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json")) as index_ptr:
+            index = json.load(index_ptr)
+        if index["version"] != FORMAT_VERSION:
+            raise ValueError("ANN index at '{}' has format version {}, expected {}".format(
+                path, index["version"], FORMAT_VERSION))
+
+        self.max_len = index["max_len"]
+        self.ids = index["ids"]
+        self._rows = {book_id: row for row, book_id in enumerate(self.ids)}
+
+        load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        self.vectors = load("vectors")
+        self.centroids = load("centroids")
+        self.order = load("order")
+        self.list_offsets = load("list_offsets")
+
+        # books changed since the index was built, see `updated`
+        self._changed_ids = []
+        self._changed_rows = {}
+        self._changed_vectors = np.zeros((0, self.vectors.shape[1]), np.float32)
+        self._changed_lists = np.zeros(0, np.int64) # cluster of every changed book
+        self._hidden = frozenset() # IDs of the books whose indexed vector is outdated
+        self._hidden_rows = np.zeros(0, np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, book_id):
+        return book_id in self._changed_rows or \
+            (book_id in self._rows and book_id not in self._hidden)
+
+    @property
+    def n_lists(self):
+        """Number of clusters of the index"""
+        return len(self.centroids)
+
+    @property
+    def n_changed(self):
+        """Number of books changed since the arrays were built"""
+        return len(self._hidden)
+
+    def vector(self, book_id):
+        """Unit vector of the book `book_id`"""
+        if book_id in self._changed_rows:
+            return self._changed_vectors[self._changed_rows[book_id]]
+        if book_id in self._hidden:
+            raise KeyError(book_id)
+        return self.vectors[self._rows[book_id]]
+
+    def updated(self, vectors, removed=()):
+        """Returns a copy of the index with changed books, sharing its arrays.
+
+        Changed books join the cluster of their closest centroid, the centroids
+        stay the same. The index itself is left untouched, so requests using it
+        meanwhile aren't affected.
+
+        Parameters
+        ----------
+        vectors : dict of str to numpy.ndarray
+            New unit vectors of added or updated books, see `unit_vectors`.
+        removed : iterable of str
+            IDs of the books to remove.
+
+        Returns
+        -------
+        AnnIndex
+        """
+        removed = set(removed)
+        kept = [(book_id, vector) for book_id, vector in
+                zip(self._changed_ids, self._changed_vectors)
+                if book_id not in vectors and book_id not in removed]
+        kept += [(book_id, vector) for book_id, vector in vectors.items()
+                 if book_id not in removed]
+
+        index = copy.copy(self)
+        index._changed_ids = [book_id for book_id, _ in kept]
+        index._changed_rows = {book_id: row for row, (book_id, _) in enumerate(kept)}
+        index._changed_vectors = np.array([vector for _, vector in kept],
+                                          np.float32).reshape(len(kept), self.vectors.shape[1])
+        index._changed_lists = np.argmax(index._changed_vectors @ self.centroids.T, axis=1) \
+            if kept else np.zeros(0, np.int64)
+        index._hidden = self._hidden | set(vectors) | removed
+        index._hidden_rows = np.array(sorted(self._rows[book_id] for book_id in index._hidden
+                                             if book_id in self._rows), np.int64)
+        return index
+
+    def search(self, vector, k, nprobe):
+        """Finds the books with the most similar sentiment vectors.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            Unit vector of the base book, see `unit_vectors`.
+        k : int
+            Number of books to return.
+        nprobe : int
+            Number of clusters to search. More clusters give better recall and
+            take longer, `n_lists` clusters amount to an exact search.
+
+        Returns
+        -------
+        list of (str, float)
+            IDs and similarity scores of the books, best first.
+        """
+        centroid_scores = self.centroids @ vector
+        nprobe = max(1, min(nprobe, self.n_lists))
+        lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        rows = np.concatenate([self.order[self.list_offsets[l]:self.list_offsets[l + 1]]
+                               for l in lists])
+        if len(self._hidden_rows):
+            rows = rows[~np.isin(rows, self._hidden_rows)]
+        changed_rows = np.flatnonzero(np.isin(self._changed_lists, lists))
+        scores = np.concatenate([self.vectors[rows] @ vector,
+                                 self._changed_vectors[changed_rows] @ vector])
+        get_id = lambda i: self.ids[rows[i]] if i < len(rows) else \
+            self._changed_ids[changed_rows[i - len(rows)]]
+
+        k = min(k, len(scores))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="mergesort")]
+
+        return [(get_id(i), float(scores[i])) for i in top]
+
+    def compacted(self):
+        """Returns a copy of the index with the changed books folded into its arrays.
+
+        The arrays of the copy are held in memory by this process rather than
+        mapped from the directory. Changed books no longer pile up in memory,
+        so the index never has to be rebuilt to keep searches fast.
+
+        Returns
+        -------
+        AnnIndex
+        """
+        assignments = np.zeros(len(self.ids), np.int64)
+        assignments[np.asarray(self.order)] = np.repeat(np.arange(self.n_lists),
+                                                        np.diff(self.list_offsets))
+        keep = np.array([book_id not in self._hidden for book_id in self.ids], dtype=bool)
+        assignments = np.concatenate([assignments[keep], self._changed_lists])
+        order = np.argsort(assignments, kind="mergesort")
+
+        index = copy.copy(self)
+        index.ids = [book_id for book_id, kept in zip(self.ids, keep) if kept] + \
+            list(self._changed_ids)
+        index._rows = {book_id: row for row, book_id in enumerate(index.ids)}
+        index.vectors = np.concatenate([self.vectors[keep], self._changed_vectors])
+        index.order = order.astype(np.int64)
+        index.list_offsets = np.searchsorted(assignments[order],
+                                             np.arange(self.n_lists + 1)).astype(np.int64)
+
+        index._changed_ids, index._changed_rows = [], {}
+        index._changed_vectors = np.zeros((0, self.vectors.shape[1]), np.float32)
+        index._changed_lists = np.zeros(0, np.int64)
+        index._hidden, index._hidden_rows = frozenset(), np.zeros(0, np.int64)
+        return index
+
+_INDEX = {}
+_INDEX_LOCK = threading.Lock()
+
+def get_ann_index():
+    """Returns the ANN index at the `ann_index.path` of the configuration
+    file, loaded once per process, or None if there is no index there."""
+    if "index" not in _INDEX:
+        with _INDEX_LOCK:
+            if "index" not in _INDEX:
+                path = get_config().get("ann_index", {}).get("path")
+                exists = path and os.path.exists(os.path.join(path, "index.json"))
+                _INDEX["index"] = AnnIndex(path) if exists else None
+
+    return _INDEX["index"]
+
+def swap_ann_index(index):
+    """Replaces the ANN index of the process, e.g. by an `updated` copy"""
+    _INDEX["index"] = index
@@ -0,0 +1,178 @@
+"""Caching module
+
+This module provides a bounded in-process cache with LRU eviction
+and per-entry expiration, and a decorator to memoize functions with it.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from .concurrency import get_single_flight
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    """Mapping of bounded size whose entries expire.
+
+    When full, the least recently used entry is evicted. The cache is safe
+    to share between greenlets and threads.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of entries.
+    ttl : float, optional
+        Seconds an entry stays valid after it was set.
+    stale_ttl : float, optional
+        Seconds an entry is kept after it expired, for `get_stale`.
+    timer : callable, optional
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, stale_ttl=0, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Returns the value under `key`, or `default` if absent or expired"""
+        with self._lock:
+            item = self._lookup(key)
+            if item is None or item[0] <= self.timer():
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def get_stale(self, key, default=None):
+        """Returns the value under `key` even if it expired less than `stale_ttl`
+        seconds ago, e.g. when it can't be computed again, or `default`"""
+        with self._lock:
+            item = self._lookup(key)
+            return default if item is None else item[1]
+
+    def _lookup(self, key):
+        """Entry under `key`, removed if it expired more than `stale_ttl` seconds ago"""
+        item = self._data.get(key)
+        if item is not None and item[0] + self.stale_ttl <= self.timer():
+            del self._data[key]
+            item = None
+        return item
+
+    def set(self, key, value, ttl=None):
+        """Stores `value` under `key` for `ttl` seconds, the cache's `ttl` by default"""
+        expires_at = self.timer() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Removes the entry under `key`, if any"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Removes all entries whose key satisfies `predicate`"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def invalidate_items_where(self, predicate):
+        """Removes all entries whose key and value satisfy `predicate(key, value)`"""
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def items(self):
+        """Returns the key, value and seconds until expiry, negative once expired,
+        of all entries, least recently used first"""
+        with self._lock:
+            now = self.timer()
+            return [(key, value, expires_at - now)
+                    for key, (expires_at, value) in self._data.items()]
+
+    def clear(self):
+        """Removes all entries and resets the counters"""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Returns the counters and size of the cache"""
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._data), "maxsize": self.maxsize}
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get_cache(name):
+    """Returns the shared cache `name`, configured by
+    the same key of the `caches` section of the configuration file."""
+    cache = _CACHES.get(name)
+    if cache is None:
+        from .utils import get_config # `utils` depends on modules using this one
+
+        with _CACHES_LOCK:
+            cache = _CACHES.get(name)
+            if cache is None:
+                cache = TTLCache(**get_config().get("caches", {}).get(name, {}))
+                _CACHES[name] = cache
+
+    return cache
+
+def get_caches():
+    """Returns the shared caches created so far, by name"""
+    return dict(_CACHES)
+
+def cached(name, key, single_flight=False, cacheable=None):
+    """Memoizes a function in the shared cache `name`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the cache, see `get_cache`.
+    key : callable
+        Maps the arguments of the decorated function to a cache key.
+    single_flight : bool, optional
+        Whether misses of the same key at the same time share one call,
+        see `concurrency.SingleFlight`.
+    cacheable : callable, optional
+        Whether a result is kept in the cache, all are by default.
+    """
+    def decorator(func):
+        @wraps(func)
+        def __inner(*args, **kwargs):
+            cache = get_cache(name)
+            cache_key = key(*args, **kwargs)
+
+            value = cache.get(cache_key, _MISSING)
+            if value is _MISSING:
+                def load():
+                    value = func(*args, **kwargs)
+                    if cacheable is None or cacheable(value):
+                        cache.set(cache_key, value)
+                    return value
+
+                value = get_single_flight(name).do(cache_key, load) if single_flight else load()
+
+            return value
+        return __inner
+    return decorator
@@ -0,0 +1,135 @@
+"""Synthetic catalog module
+
+This module generates catalogs of made-up book objects, shaped like the ones
+of the Database Service, to benchmark and load test the service without the
+real catalog, and reads and writes catalog files.
+
+Timeline lengths are log-normally distributed, as those of real books, and
+every book has its own mix of emotions, a few dominant ones and some rare ones.
+A timeline event scores +1 for positive emotions and -1 for negative ones.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import json
+
+import numpy as np
+
+from .models import EMOTIONS
+
+SIGNS = {"sadness": -1, "fear": -1, "joy": 1, "surprise": 1, "anger": -1, "love": 1}
+
+CHARACTERS = ("aliens", "mutants", "robots", "humanoiddroids", "dragons", "superintelligence")
+SPACE_SETTINGS = ("insideearth", "otherplanets", "outerspace", "beyondsolarsystem")
+
+_TOKENS = {
+    "sadness": ("grief", "loss", "tears", "mourning"),
+    "fear": ("dread", "terror", "panic", "shadow"),
+    "joy": ("hope", "laughter", "delight", "sunlight"),
+    "surprise": ("wonder", "shock", "sudden", "astonish"),
+    "anger": ("rage", "fury", "wrath", "spite"),
+    "love": ("tender", "embrace", "devotion", "kiss")
+}
+_WORDS = ("star", "empire", "night", "machine", "dragon", "city", "ocean", "silent", "red",
+          "last", "dream", "iron", "garden", "war", "glass", "storm", "child", "winter")
+_NAMES = ("Ada", "Isaac", "Ursula", "Arthur", "Octavia", "Philip", "Frank", "Mary",
+          "Stanislaw", "Ray", "Joanna", "Robert", "Liu", "Iain", "Lois", "Kim")
+_SURNAMES = ("Asimov", "Le Guin", "Clarke", "Butler", "Dick", "Herbert", "Shelley", "Lem",
+             "Bradbury", "Russ", "Heinlein", "Cixin", "Banks", "Bujold", "Stanley", "Gibson")
+
+
+def _timeline(rnd, median_events):
+    """Events of a made-up sentiment timeline, in chronological order"""
+    n_events = int(np.clip(rnd.lognormal(np.log(median_events), 0.8), 10, 40 * median_events))
+    text_length = int(n_events * rnd.lognormal(np.log(60), 0.5)) + 1
+    indices = np.unique(rnd.randint(0, text_length, n_events))
+
+    mix = rnd.dirichlet(np.full(len(EMOTIONS), 0.8))
+    codes = rnd.choice(len(EMOTIONS), len(indices), p=mix)
+    token_picks = rnd.randint(0, 4, len(indices))
+
+    return [[SIGNS[EMOTIONS[code]], EMOTIONS[code], _TOKENS[EMOTIONS[code]][pick], int(index)]
+            for code, pick, index in zip(codes, token_picks, indices)]
+
+def generate_book(rnd, book_id, author, median_events=400):
+    """Generates one book object.
+
+    Parameters
+    ----------
+    rnd : numpy.random.RandomState
+    book_id : str
+    author : str
+    median_events : int, optional
+        Median number of sentiment timeline events.
+
+    Returns
+    -------
+    dict
+        A book object, as returned by the Database Service.
+    """
+    timeline = _timeline(rnd, median_events)
+    counts = {emotion: 0 for emotion in EMOTIONS}
+    for event in timeline:
+        counts[event[1]] += 1
+
+    title_words = rnd.choice(_WORDS, rnd.randint(1, 4), replace=False)
+    return {
+        "id": book_id,
+        "metadata": {"title": " ".join(title_words).title(), "author": author},
+        "genre": {
+            "characters": {"labels": {k: int(rnd.random_sample() < 0.3) for k in CHARACTERS}},
+            "spaceSetting": {"labels": {k: int(rnd.random_sample() < 0.3) for k in SPACE_SETTINGS}}
+        },
+        "sentiment": {
+            "overall": [{emotion: count / len(timeline) for emotion, count in counts.items()}],
+            "timeline": timeline
+        }
+    }
+
+def generate_catalog(n_books, median_events=400, seed=0):
+    """Generates a catalog of `n_books` book objects.
+
+    About 8 books share each author, so author filters match several books.
+
+    Parameters
+    ----------
+    n_books : int
+    median_events : int, optional
+        Median number of sentiment timeline events per book.
+    seed : int, optional
+
+    Returns
+    -------
+    list of dict
+    """
+    rnd = np.random.RandomState(seed)
+    authors = ["{} {}".format(rnd.choice(_NAMES), rnd.choice(_SURNAMES))
+               for _ in range(max(n_books // 8, 1))]
+
+    return [generate_book(rnd, "syn{:06d}".format(i), authors[rnd.randint(len(authors))],
+                          median_events)
+            for i in range(n_books)]
+
+def make_filters(author="", characters=(), space_settings=()):
+    """Builds a filter object, as sent by the clients, see `utils.make_query`"""
+    return {
+        "characters": {k: int(k in characters) for k in CHARACTERS},
+        "spaceSetting": {k: int(k in space_settings) for k in SPACE_SETTINGS},
+        "metadata": {"author": {"value": author}}
+    }
+
+def load_catalog(path):
+    """Reads the book objects of a catalog file, either a JSON array or NDJSON"""
+    with open(path) as catalog_ptr:
+        content = catalog_ptr.read()
+
+    if content.lstrip().startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+def write_catalog(path, books):
+    """Writes book objects to `path`, as NDJSON, one book per line"""
+    with open(path, "w") as catalog_ptr:
+        for book in books:
+            catalog_ptr.write(json.dumps(book) + "\n")
@@ -0,0 +1,197 @@
+"""Change feed module
+
+This module keeps the structures built over the catalog up to date as books
+are added, reprocessed or removed, without rebuilding them: the feature
+store, the ANN index, the search index and the caches.
+
+Books carry the time they last changed in a field, `updated_at` by default,
+and removed books are kept with a true `deleted` field. The change feed pulls
+the books changed since its watermark from the Database Service, and swaps in
+updated copies of the structures, so requests are never blocked by it.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import logging
+import threading
+import time
+
+from . import ann, features, search
+from .concurrency import run_periodically
+from .db_utils import db_fetch, invalidate_book
+from .logic import bucket_events
+from .models import Book
+from .utils import get_config, invalidate_recommendations
+
+logger = logging.getLogger(__name__)
+
+
+def _ann_vector(index, timeline):
+    """Unit vector of a timeline in the ANN index, or None if it's too long for it"""
+    if timeline.length + 1 > index.max_len:
+        return None
+    buckets = bucket_events(timeline.codes, timeline.indices, timeline.scores, index.max_len)
+    return ann.unit_vectors(buckets[None])[0]
+
+def _compact(structure, compact_ratio):
+    """`structure` with its changed books folded in, once they are more than
+    `compact_ratio` of its books"""
+    if structure.n_changed > compact_ratio * max(len(structure), 1):
+        return structure.compacted()
+    return structure
+
+def apply_changes(addr, books, compact_ratio=0.1):
+    """Applies changed book objects to the structures of this process.
+
+    Parameters
+    ----------
+    addr : str
+        Address of the Database Service the books come from.
+    books : list of dict
+        Added, updated or removed book objects.
+    compact_ratio : float, optional
+        The changed books are folded into the arrays of the feature store and
+        the ANN index once they are more than this share of their books.
+    """
+    removed = [book["id"] for book in books if book.get("deleted")]
+    changed = [book for book in books if not book.get("deleted")]
+    compact = {book["id"]: Book.from_json(book) for book in changed}
+    timelines = {book_id: book.timeline for book_id, book in compact.items()
+                 if book.timeline is not None}
+
+    store = features.get_feature_store()
+    if store is not None:
+        titles = {book_id: book.title for book_id, book in compact.items()}
+        features.swap_feature_store(
+            _compact(store.updated(timelines, removed, titles), compact_ratio))
+
+    index = ann.get_ann_index()
+    if index is not None:
+        vectors = {book_id: _ann_vector(index, timeline) for book_id, timeline in timelines.items()}
+        ann.swap_ann_index(_compact(index.updated(
+            {book_id: vector for book_id, vector in vectors.items() if vector is not None},
+            removed + [book_id for book_id, vector in vectors.items() if vector is None]),
+                                    compact_ratio))
+
+    search_index = search.peek_search_index(addr)
+    if search_index is not None:
+        search.swap_search_index(addr, search_index.updated(
+            [book for book in changed if "metadata" in book], removed))
+
+    for book in books:
+        invalidate_book(addr, book["id"])
+    invalidate_recommendations(book["id"] for book in books)
+
+class ChangeFeed(object):
+    """Pulls and applies the changes of the catalog.
+
+    Books changed at the watermark are pulled again, as others may have been
+    written with the same time after the last poll, the ones already applied
+    are skipped by ID. The first poll applies the books changed at the initial
+    watermark again, which is harmless.
+
+    The books are pulled in pages of `batch_size`, in order of change time
+    and ID, and each page is applied before the next one is pulled.
+
+    Parameters
+    ----------
+    addr : str
+        Address of the Database Service.
+    field : str
+        Field of the book objects with the time they last changed.
+    watermark : optional
+        Changes up to this time are already applied.
+    batch_size : int, optional
+        Number of books pulled and applied at once, other greenlets run
+        between batches.
+    compact_ratio : float, optional
+        See `apply_changes`.
+    """
+
+    def __init__(self, addr, field, watermark, batch_size=500, compact_ratio=0.1):
+        self.addr = addr
+        self.field = field
+        self.watermark = watermark
+        self.batch_size = batch_size
+        self.compact_ratio = compact_ratio
+        self._applied = set() # IDs of the books applied which changed at the watermark
+        self._lock = threading.Lock()
+
+    def _is_new(self, book):
+        """Whether `book` changed after it was last applied"""
+        changed_at = book[self.field]
+        return changed_at > self.watermark or \
+            (changed_at == self.watermark and book["id"] not in self._applied)
+
+    def _advance(self, batch):
+        """Moves the watermark past the books of `batch`, applied in order"""
+        for book in batch:
+            if book[self.field] != self.watermark:
+                self.watermark, self._applied = book[self.field], set()
+            self._applied.add(book["id"])
+
+    def poll(self):
+        """Pulls the books changed since the watermark and applies them.
+        Books without a change time are skipped.
+
+        Returns
+        -------
+        int
+            The number of books applied.
+        """
+        query = {self.field: {"$gte": self.watermark}}
+        applied = 0
+        while True:
+            page = db_fetch(self.addr, query, sort=[[self.field, 1], ["id", 1]],
+                            limit=self.batch_size)["resp"]
+            with self._lock:
+                # a concurrent poll may have applied some of them meanwhile
+                batch = [book for book in page
+                         if book.get(self.field) is not None and self._is_new(book)]
+                if batch:
+                    apply_changes(self.addr, batch, self.compact_ratio)
+                    self._advance(batch)
+                    applied += len(batch)
+
+            if len(page) < self.batch_size:
+                break
+            # the next page starts after the last book of this one
+            last = page[-1]
+            query = {"$or": [{self.field: {"$gt": last[self.field]}},
+                             {self.field: last[self.field], "id": {"$gt": last["id"]}}]}
+            time.sleep(0) # under gevent, lets the requests run between batches
+
+        if applied:
+            logger.info("Applied %d changed books, watermark %s", applied, self.watermark)
+        return applied
+
+_FEED = {}
+_FEED_LOCK = threading.Lock()
+
+def get_change_feed():
+    """Returns the change feed of this process, configured by the `change_feed`
+    section of the configuration file. It starts at the watermark of the feature
+    store, or at the current time without one."""
+    if "feed" not in _FEED:
+        with _FEED_LOCK:
+            if "feed" not in _FEED:
+                config = get_config()
+                store = features.get_feature_store()
+                watermark = store.watermark if store is not None else None
+                _FEED["feed"] = ChangeFeed(
+                    config["mongo_rest_interface_addr"], config["change_feed"]["field"],
+                    time.time() if watermark is None else watermark,
+                    config["change_feed"]["batch_size"], config["change_feed"]["compact_ratio"])
+
+    return _FEED["feed"]
+
+def start_change_feed(interval):
+    """Polls the change feed every `interval` seconds in the background"""
+    feed = get_change_feed()
+    return run_periodically(feed.poll, interval)
+
+def latest_change(books, field):
+    """The watermark of `books`, the latest time one of them changed, or None"""
+    times = [book[field] for book in books if book.get(field) is not None]
+    return max(times) if times else None
@@ -0,0 +1,75 @@
+"""JSON codec module
+
+This module is the single place where JSON is decoded and encoded: once at the
+database service boundary and once at the HTTP boundary. The implementation
+is picked by the `json_codec` option of the configuration file, `"auto"`
+prefers `orjson`, then `ujson`, when installed, over the standard library.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import json
+
+
+class JSONCodec(object):
+    """A JSON implementation.
+
+    Parameters
+    ----------
+    name : str
+    loads : callable
+        Decodes a str or bytes document.
+    dumps : callable
+        Encodes an object to str.
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+def _json_codec():
+    return JSONCodec("json", json.loads, json.dumps)
+
+def _orjson_codec():
+    import orjson
+    return JSONCodec("orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode("utf-8"))
+
+def _ujson_codec():
+    import ujson
+    return JSONCodec("ujson", ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False))
+
+CODECS = {"json": _json_codec, "orjson": _orjson_codec, "ujson": _ujson_codec}
+
+def make_codec(name="auto"):
+    """Creates the codec `name`, one of `CODECS` or `"auto"` for the fastest one installed"""
+    if name != "auto":
+        return CODECS[name]()
+
+    for candidate in ("orjson", "ujson"):
+        try:
+            return CODECS[candidate]()
+        except ImportError:
+            pass
+    return _json_codec()
+
+def _load_codec():
+    from .utils import get_config # `utils` depends on modules using this one
+    return make_codec(get_config().get("json_codec", "auto"))
+
+_CODEC = {}
+
+def get_codec():
+    """Returns the codec selected in the configuration file"""
+    if "codec" not in _CODEC:
+        _CODEC["codec"] = _load_codec()
+    return _CODEC["codec"]
+
+def loads(data):
+    """Decodes a JSON document with the configured codec"""
+    return get_codec().loads(data)
+
+def dumps(obj):
+    """Encodes an object to a JSON str with the configured codec"""
+    return get_codec().dumps(obj)
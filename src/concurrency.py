@@ -0,0 +1,323 @@
+"""Concurrency utility functions module
+
+This module runs independent I/O bound calls, such as fetches from the
+database service, concurrently. Under the gevent worker of `runserver`
+they run as greenlets, otherwise in a thread pool. CPU bound calls run
+in a pool of processes, so they don't block the other requests.
+Identical calls made at the same time can share one run, see `SingleFlight`.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import wraps
+
+try:
+    import gevent
+    from gevent import monkey
+except ImportError:
+    gevent = None
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when concurrent calls don't finish before their deadline"""
+
+def _uses_greenlets():
+    return gevent is not None and monkey.is_module_patched("socket")
+
+def _run_greenlets(calls, timeout):
+    greenlets = [gevent.spawn(call) for call in calls]
+    try:
+        gevent.joinall(greenlets, timeout=timeout, raise_error=True)
+    finally:
+        unfinished = [g for g in greenlets if not g.ready()]
+        gevent.killall(unfinished, block=False)
+
+    if unfinished:
+        raise DeadlineExceeded("{} of {} calls did not finish in {}s".format(
+            len(unfinished), len(calls), timeout))
+    return [g.value for g in greenlets]
+
+def _run_threads(calls, timeout):
+    return _wait([_EXECUTOR.submit(call) for call in calls], timeout)
+
+def _wait(futures, timeout):
+    done, unfinished = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+    for future in unfinished:
+        future.cancel()
+
+    for future in done:
+        if future.exception() is not None:
+            raise future.exception()
+    if unfinished:
+        raise DeadlineExceeded("{} of {} calls did not finish in {}s".format(
+            len(unfinished), len(futures), timeout))
+    return [future.result() for future in futures]
+
+def run_concurrently(calls, timeout=None):
+    """Runs calls concurrently and waits for all of them.
+
+    If a call fails, or the deadline passes, the unfinished calls are cancelled.
+    Greenlets are killed, threads can only be cancelled before they start.
+
+    Parameters
+    ----------
+    calls : list of callable
+        Functions without arguments.
+    timeout : float, optional
+        Seconds to wait for all calls to finish.
+
+    Returns
+    -------
+    list
+        The results of the calls, in order.
+
+    Raises
+    ------
+    DeadlineExceeded
+        If not all calls finished within `timeout` seconds.
+    Exception
+        The first exception raised by a call.
+    """
+    if _uses_greenlets():
+        return _run_greenlets(calls, timeout)
+    return _run_threads(calls, timeout)
+
+_PROCESS_POOL = {}
+_PROCESS_POOL_LOCK = threading.Lock()
+
+def get_process_pool(workers):
+    """Returns the pool of `workers` processes shared by the calls of `run_in_processes`.
+
+    The processes are started with `spawn`, forking a process running greenlets
+    and threads isn't safe, on the first call, and then kept running. Returns
+    None before Python 3.7, whose pools can't be told how to start processes.
+    """
+    if "pool" not in _PROCESS_POOL:
+        with _PROCESS_POOL_LOCK:
+            if "pool" not in _PROCESS_POOL:
+                try:
+                    _PROCESS_POOL["pool"] = ProcessPoolExecutor(
+                        max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                except TypeError: # no `mp_context` before Python 3.7
+                    logger.warning("Process pools need Python 3.7, calls run in-process")
+                    _PROCESS_POOL["pool"] = None
+
+    return _PROCESS_POOL["pool"]
+
+def run_in_processes(func, arg_tuples, workers, timeout=None):
+    """Runs calls of `func` in the shared process pool and waits for all of them.
+
+    Waiting only blocks the calling greenlet or thread. A pool whose process
+    died is replaced on the next call. Without a pool, see `get_process_pool`,
+    the calls run one after the other in this process.
+
+    Parameters
+    ----------
+    func : callable
+        A module-level function, its arguments and results must be picklable.
+    arg_tuples : list of tuple
+        Arguments of every call.
+    workers : int
+        Number of processes of the pool, when it is started.
+    timeout : float, optional
+        Seconds to wait for all calls to finish.
+
+    Returns
+    -------
+    list
+        The results of the calls, in order.
+
+    Raises
+    ------
+    DeadlineExceeded
+        If not all calls finished within `timeout` seconds.
+    Exception
+        The first exception raised by a call.
+    """
+    pool = get_process_pool(workers)
+    if pool is None:
+        return [func(*args) for args in arg_tuples]
+    try:
+        return _wait([pool.submit(func, *args) for args in arg_tuples], timeout)
+    except BrokenProcessPool:
+        with _PROCESS_POOL_LOCK:
+            if _PROCESS_POOL.get("pool") is pool:
+                del _PROCESS_POOL["pool"]
+        raise
+
+def run_periodically(func, interval, delay=0):
+    """Calls `func` after `delay` seconds, now by default, and then every
+    `interval` seconds, in the background.
+
+    Exceptions raised by `func` are logged and don't stop the next calls.
+
+    Parameters
+    ----------
+    func : callable
+        Function without arguments.
+    interval : float
+    delay : float, optional
+
+    Returns
+    -------
+    gevent.Greenlet or threading.Thread
+    """
+    def loop():
+        time.sleep(delay)
+        while True:
+            try:
+                func()
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Periodic call of %s failed", func)
+            time.sleep(interval)
+
+    if _uses_greenlets():
+        return gevent.spawn(loop)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+class _Call(object):
+    """A run of a `SingleFlight` call, shared by its leader and followers"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.finished = False # False if the leader was interrupted, e.g. killed
+
+class SingleFlight(object):
+    """Coalesces identical calls running at the same time into one.
+
+    The first caller of a key, the leader, runs the call, callers of the same
+    key arriving meanwhile, the followers, wait for it and get its result, or
+    its exception. Nothing is kept once the call returned, pair it with a cache
+    to also reuse results. It is safe to share between greenlets and threads.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Seconds a follower waits for the leader.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.calls = 0
+        self.shared = 0
+        self._calls = {} # key -> _Call
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func):
+        """Calls `func`, or waits for the call of `key` in flight and shares its result.
+
+        Parameters
+        ----------
+        key : hashable
+        func : callable
+            Function without arguments.
+
+        Returns
+        -------
+        The result of the call, shared, so it must not be modified.
+
+        Raises
+        ------
+        DeadlineExceeded
+            If the leader didn't finish within `timeout` seconds.
+        Exception
+            The exception raised by the call.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                self.calls += leader
+                self.shared += not leader
+
+            if leader:
+                return self._lead(key, call, func)
+
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not call.done.wait(remaining):
+                raise DeadlineExceeded("Shared call {!r} did not finish in {}s".format(
+                    key, self.timeout))
+            if call.error is not None:
+                raise call.error
+            if call.finished:
+                return call.value
+            # the leader was interrupted, try again, this time as the leader if first
+
+    def _lead(self, key, call, func):
+        try:
+            call.value = func()
+            call.finished = True
+            return call.value
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Returns the counters of the calls and the number of calls in flight"""
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls)}
+
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+def get_single_flight(name):
+    """Returns the shared `SingleFlight` `name`, configured by
+    the `single_flight` section of the configuration file."""
+    flight = _FLIGHTS.get(name)
+    if flight is None:
+        from .utils import get_config # `utils` depends on modules using this one
+
+        with _FLIGHTS_LOCK:
+            flight = _FLIGHTS.get(name)
+            if flight is None:
+                flight = SingleFlight(**get_config().get("single_flight", {}))
+                _FLIGHTS[name] = flight
+
+    return flight
+
+def get_single_flights():
+    """Returns the shared `SingleFlight`s created so far, by name"""
+    return dict(_FLIGHTS)
+
+def coalesced(name, key):
+    """Coalesces identical calls of a function running at the same time.
+
+    Parameters
+    ----------
+    name : str
+        Name of the `SingleFlight`, see `get_single_flight`.
+    key : callable
+        Maps the arguments of the decorated function to a key.
+    """
+    def decorator(func):
+        @wraps(func)
+        def __inner(*args, **kwargs):
+            return get_single_flight(name).do(key(*args, **kwargs),
+                                              lambda: func(*args, **kwargs))
+        return __inner
+    return decorator
@@ -7,10 +7,144 @@ This module provides functions for fetching data from database.
 # Email:  alexandru-varacuta@bookvoyager.org
 
 import json
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import codec
+from .cache import cached, get_cache
+from .concurrency import coalesced
+from .metrics import stage
+from .resilience import AdaptiveLimiter, CircuitBreaker, Guard
+
+# removed books are kept in the database with a true `deleted` field, see `src.changes`
+NOT_DELETED = {"deleted": {"$ne": True}}
+
+class DBClient(object):
+    """Keep-alive, pooled client of the database service.
+
+    The client is shared by all greenlets of a worker. It keeps no
+    per-request state and its connection pool is guarded by a queue,
+    which gevent's monkey patching makes cooperative.
+
+    Parameters
+    ----------
+    db_service_url : str
+    pool_size : int, optional
+        Maximum number of connections kept alive.
+    pool_block : bool, optional
+        Whether to wait for a free connection instead of opening
+        a throwaway one when all `pool_size` connections are busy.
+    connect_timeout : float, optional
+        Seconds to wait for a connection to be established.
+    read_timeout : float, optional
+        Seconds to wait for the database service to respond.
+    max_retries : int, optional
+        How many times a failed connection or a 502/503/504 response is retried.
+    backoff_factor : float, optional
+        Base of the exponential backoff between retries, in seconds.
+    guard : src.resilience.Guard, optional
+        Limits the concurrent requests and stops them while the database
+        service is failing, see `make_guard`.
+    """
+
+    def __init__(self, db_service_url, pool_size=10, pool_block=False,
+                 connect_timeout=3.05, read_timeout=10, max_retries=2, backoff_factor=0.1,
+                 guard=None):
+        self.db_service_url = db_service_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.guard = guard
+
+        # `/fetch` only reads, so it is safe to retry it although it is a POST
+        retries = Retry(total=max_retries, backoff_factor=backoff_factor,
+                        status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset(["POST"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=pool_block, max_retries=retries)
+
+        self.session = requests.Session()
+        self.session.mount(db_service_url, adapter)
+        self.session.headers.update({"content-type": "application/json"})
+
+    def fetch(self, constraints, projection=None, sort=None, limit=None):
+        """Applies a query on the database service.
+
+        Parameters
+        ----------
+        constraints : dict
+            The PyMongo-style query object.
+        projection : dict, optional
+            The PyMongo-style projection, to fetch only some fields of the documents.
+        sort : list of [str, int], optional
+            The PyMongo-style sort, e.g. `[["id", 1]]`.
+        limit : int, optional
+            Maximum number of documents.
+
+        Returns
+        -------
+        dict of {"resp": [dict]}
+            The result of the applied query.
+
+        Raises
+        ------
+        src.resilience.Overloaded
+            If the guard of the client turned the request away.
+        """
+        body = {"constraints": json.dumps(constraints)}
+        for name, value in [("projection", projection), ("sort", sort), ("limit", limit)]:
+            if value is not None:
+                body[name] = json.dumps(value)
+
+        def post():
+            resp = self.session.post(self.db_service_url + "/fetch", json=body,
+                                     timeout=self.timeout)
+            resp.raise_for_status()
+            return resp
+
+        with stage("db_fetch"):
+            resp = post() if self.guard is None else self.guard.call(post)
 
+        with stage("json_decode"):
+            # the database service sends its JSON result encoded as a JSON string
+            result = codec.loads(resp.content.decode("utf-8"))
+            return codec.loads(result) if isinstance(result, str) else result
 
-def db_fetch(db_service_url, constraints):
+def _is_failure(error):
+    """Whether a request failed because of the database service, rather than of the query"""
+    response = getattr(error, "response", None)
+    return response is None or response.status_code >= 500
+
+def make_guard(config):
+    """Builds the guard of a client from the `db_protection` section of the
+    configuration file, or returns None if it isn't enabled"""
+    if not config.get("enabled"):
+        return None
+    return Guard(AdaptiveLimiter(**config["limiter"]), CircuitBreaker(**config["breaker"]),
+                 is_failure=_is_failure)
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def get_client(db_service_url):
+    """Returns the shared client of the database service at `db_service_url`,
+    configured by the `db_client` and `db_protection` sections of the configuration file."""
+    client = _CLIENTS.get(db_service_url)
+    if client is None:
+        from .utils import get_config # `utils` imports this module
+
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(db_service_url)
+            if client is None:
+                config = get_config()
+                client = DBClient(db_service_url, **config.get("db_client", {}),
+                                  guard=make_guard(config.get("db_protection", {})))
+                _CLIENTS[db_service_url] = client
+
+    return client
+
+def db_fetch(db_service_url, constraints, projection=None, sort=None, limit=None):
     """Wraps the underling request to the database service.
 
     Parameters
@@ -18,38 +152,87 @@ def db_fetch(db_service_url, constraints):
     db_service_url : str
     constraints : dict
         The PyMongo-style query object.
+    projection : dict, optional
+        The PyMongo-style projection, e.g. `{"id": 1, "metadata.title": 1}`.
+    sort : list of [str, int], optional
+        The PyMongo-style sort, e.g. `[["id", 1]]`.
+    limit : int, optional
+        Maximum number of documents.
 
     Returns
     -------
-    dict
-        The result of the applied query.
+    dict of {"resp": [dict]}
+        The result of the applied query, shared with the books cache,
+        so it must not be modified.
     """
-    resp = requests.post(db_service_url + "/fetch",
-                         json={"constraints": json.dumps(constraints)},
-                         headers={"content-type": "application/json"})
-    return json.loads(resp.content.decode("utf-8"))
+    return get_client(db_service_url).fetch(constraints, projection, sort, limit)
+
+def not_deleted(query):
+    """Restricts `query` to the books which weren't removed"""
+    return {"$and": [query, NOT_DELETED]} if query else dict(NOT_DELETED)
 
 def get_book_by(field_name, addr, field_value):
     """Facade function to make the API for fetching the database more uniform
     and to reduce the number of imported functions"""
     if field_name == "id":
         data = _get_book_by_id(addr, field_value)
+    elif field_name == "ids":
+        data = _get_books_by_ids(addr, field_value)
     elif field_name == "author_or_title":
         data = _search_by_auth_or_title(addr, field_value)
     else:
         raise KeyError("Function get_book_by not defined for field_name '{}', \
-available options are {}".format(field_name, ["id", "author_or_title"]))
+available options are {}".format(field_name, ["id", "ids", "author_or_title"]))
 
     return data
 
+@cached("books", key=lambda addr, book_id: (addr, book_id), single_flight=True,
+        cacheable=lambda data: bool(data["resp"]))
 def _get_book_by_id(addr, book_id):
-    """Get book by MongoDB ID"""
-    return db_fetch(addr, {"id": book_id})
+    """Get book by MongoDB ID. Unknown IDs aren't cached, the book may be added later."""
+    return db_fetch(addr, not_deleted({"id": book_id}))
+
+def invalidate_book(addr, book_id):
+    """Drops the cached copy of a book, so that it is fetched again on next use"""
+    get_cache("books").invalidate((addr, book_id))
+
+@coalesced("db_queries", key=lambda addr, book_ids: ("ids", addr, tuple(book_ids)))
+def _get_books_by_ids(addr, book_ids):
+    """Get many books by MongoDB ID in a single request"""
+    return db_fetch(addr, not_deleted({"id": {"$in": list(book_ids)}}))
 
+@coalesced("db_queries", key=lambda addr, search_token: ("author_or_title", addr,
+                                                         search_token.lower()))
 def _search_by_auth_or_title(addr, search_token):
     """Given a string, perform a regex search over `author` and `title` fields of a book."""
+    return db_fetch(addr, _auth_or_title_query(search_token))
+
+def _auth_or_title_query(search_token):
+    """Query of the books with an author or title matching `search_token`"""
     token = search_token.lower()
-    return db_fetch(addr, {"$or": [{"metadata.author": {"$regex": r"({})\w*".format(token),
-                                                        "$options": "i"}},
-                                   {"metadata.title":  {"$regex": r"({})\w*".format(token),
-                                                        "$options": "i"}}]})
+    return not_deleted(
+        {"$or": [{"metadata.author": {"$regex": r"({})\w*".format(token), "$options": "i"}},
+                 {"metadata.title":  {"$regex": r"({})\w*".format(token), "$options": "i"}}]})
+
+def search_page_by_auth_or_title(addr, search_token, limit, after=None, projection=None):
+    """One page of the books `get_book_by("author_or_title", ...)` finds, in `id` order.
+
+    Parameters
+    ----------
+    addr : str
+    search_token : str
+    limit : int
+        Maximum number of books.
+    after : str, optional
+        Only books with a greater `id` are returned, the last one of the previous page.
+    projection : dict, optional
+        Must include `id`.
+
+    Returns
+    -------
+    dict of {"resp": [dict]}
+    """
+    query = _auth_or_title_query(search_token)
+    if after is not None:
+        query = {"$and": [query, {"id": {"$gt": after}}]}
+    return db_fetch(addr, query, projection, sort=[["id", 1]], limit=limit)
@@ -0,0 +1,248 @@
+"""Feature store module
+
+This module writes and reads the feature store, the preprocessed sentiment
+timelines of the whole catalog kept on disk. Its arrays are memory-mapped
+read-only, so all workers on a machine share the same pages.
+
+Layout of the store directory:
+    index.json    - format version, book IDs and titles, in row order, and the
+                    change feed watermark of the catalog, see `src.changes`
+    codes.npy     - uint8 emotion codes of all events, see `models.EMOTIONS`
+    indices.npy   - int64 timeline indices of all events
+    scores.npy    - float64 sentiment scores of all events
+    offsets.npy   - int64, events of row `i` are `offsets[i]:offsets[i + 1]`
+    lengths.npy   - int64 `get_max_len` of every book's timeline
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import copy
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from .models import SentimentTimeline
+from .utils import get_config
+
+FORMAT_VERSION = 2
+
+
+class FeatureStore(object):
+    """Read-only view of a feature store directory.
+
+    Books changed since the store was built are kept in memory, see `updated`,
+    until they are folded into the arrays, see `compacted`.
+
+    Parameters
+    ----------
+    path : str
+        The directory written by `build_feature_store`.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json")) as index_ptr:
+            index = json.load(index_ptr)
+        if index["version"] != FORMAT_VERSION:
+            raise ValueError("Feature store at '{}' has format version {}, expected {}".format(
+                path, index["version"], FORMAT_VERSION))
+
+        self.path = path
+        self.ids = index["ids"]
+        self.titles = index["titles"]
+        self.watermark = index.get("watermark")
+        self._rows = {book_id: row for row, book_id in enumerate(self.ids)}
+        self._changed = {} # book ID -> SentimentTimeline, or None if removed
+        self._changed_titles = {}
+
+        load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        self.codes = load("codes")
+        self.indices = load("indices")
+        self.scores = load("scores")
+        self.offsets = load("offsets")
+        self.lengths = load("lengths")
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_changed(self):
+        """Number of books changed since the arrays were built"""
+        return len(self._changed)
+
+    def __contains__(self, book_id):
+        if book_id in self._changed:
+            return self._changed[book_id] is not None
+        return book_id in self._rows
+
+    def row(self, book_id):
+        """Row of the book `book_id`"""
+        return self._rows[book_id]
+
+    def timeline(self, book_id):
+        """Sentiment timeline of the book `book_id`, viewing the store's arrays"""
+        if book_id in self._changed:
+            if self._changed[book_id] is None:
+                raise KeyError(book_id)
+            return self._changed[book_id]
+
+        row = self._rows[book_id]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return SentimentTimeline(self.codes[start:end], self.indices[start:end],
+                                 self.scores[start:end], int(self.lengths[row]))
+
+    def updated(self, timelines, removed=(), titles=None):
+        """Returns a copy of the store with changed books, sharing its arrays.
+
+        The store itself is left untouched, so requests using it meanwhile
+        aren't affected, and the copy can be swapped in at once.
+
+        Parameters
+        ----------
+        timelines : dict of str to src.models.SentimentTimeline
+            New timelines of added or updated books.
+        removed : iterable of str
+            IDs of the books to remove.
+        titles : dict of str to str, optional
+            New titles of the added or updated books.
+
+        Returns
+        -------
+        FeatureStore
+        """
+        store = copy.copy(self)
+        store._changed = {**self._changed, **timelines, **{book_id: None for book_id in removed}}
+        store._changed_titles = {**self._changed_titles, **(titles or {})}
+        return store
+
+    def compacted(self):
+        """Returns a copy of the store with the changed books folded into its arrays.
+
+        The arrays of the copy are held in memory by this process rather than
+        mapped from the directory. Changed books no longer pile up in memory,
+        so the store never has to be rebuilt to keep lookups fast.
+
+        Returns
+        -------
+        FeatureStore
+        """
+        keep = np.array([book_id not in self._changed for book_id in self.ids], dtype=bool)
+        events = np.repeat(keep, np.diff(self.offsets))
+        added = [(book_id, timeline) for book_id, timeline in self._changed.items()
+                 if timeline is not None]
+        concat = lambda kept, changed, dtype: np.concatenate(
+            [np.asarray(kept, dtype=dtype)] + [np.asarray(a, dtype=dtype) for a in changed])
+
+        store = copy.copy(self)
+        store.ids = [book_id for book_id, kept in zip(self.ids, keep) if kept] + \
+            [book_id for book_id, _ in added]
+        old_title = lambda book_id: self.titles[self._rows[book_id]] \
+            if book_id in self._rows else None
+        store.titles = [title for title, kept in zip(self.titles, keep) if kept] + \
+            [self._changed_titles.get(book_id, old_title(book_id)) for book_id, _ in added]
+        store._rows = {book_id: row for row, book_id in enumerate(store.ids)}
+        store._changed, store._changed_titles = {}, {}
+
+        store.codes = concat(self.codes[events], [t.codes for _, t in added], np.uint8)
+        store.indices = concat(self.indices[events], [t.indices for _, t in added], np.int64)
+        store.scores = concat(self.scores[events], [t.scores for _, t in added], np.float64)
+        store.lengths = concat(self.lengths[keep], [[t.length] for _, t in added], np.int64)
+        counts = concat(np.diff(self.offsets)[keep], [[len(t)] for _, t in added], np.int64)
+        store.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return store
+
+def build_feature_store(path, books, watermark=None):
+    """Writes the feature store of `books` to the directory `path`.
+
+    Parameters
+    ----------
+    path : str
+    books : iterable of dict
+        Book objects, as returned by the database service.
+    watermark : optional
+        Change feed watermark of `books`, changes after it are applied
+        to the store in memory, see `src.changes`.
+
+    Returns
+    -------
+    int
+        The number of books in the store.
+    """
+    ids, titles, lengths, offsets = [], [], [], [0]
+    codes, indices, scores = [], [], []
+
+    for book in books:
+        timeline = SentimentTimeline.from_json(book["sentiment"]["timeline"])
+
+        ids.append(book["id"])
+        titles.append(book["metadata"]["title"])
+        lengths.append(timeline.length)
+        offsets.append(offsets[-1] + len(timeline))
+        codes.append(timeline.codes)
+        indices.append(timeline.indices)
+        scores.append(timeline.scores)
+
+    concat = lambda arrays, dtype: np.concatenate(arrays).astype(dtype) if arrays \
+        else np.zeros(0, dtype=dtype)
+
+    write_arrays(path, {"codes": concat(codes, np.uint8),
+                        "indices": concat(indices, np.int64),
+                        "scores": concat(scores, np.float64),
+                        "offsets": np.asarray(offsets, dtype=np.int64),
+                        "lengths": np.asarray(lengths, dtype=np.int64)},
+                 {"version": FORMAT_VERSION, "ids": ids, "titles": titles,
+                  "watermark": watermark})
+
+    return len(ids)
+
+def write_arrays(path, arrays, index):
+    """Writes a directory of `.npy` arrays plus an `index.json`.
+
+    The directory is written next to `path` and then moved in place,
+    so readers never see a partially written one.
+
+    Parameters
+    ----------
+    path : str
+    arrays : dict of str to numpy.ndarray
+        Arrays by file name, without extension.
+    index : dict
+        Content of `index.json`.
+    """
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+    with open(os.path.join(tmp_path, "index.json"), "w") as index_ptr:
+        json.dump(index, index_ptr)
+
+    old_path = path.rstrip(os.sep) + ".old"
+    if os.path.exists(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+_STORE = {}
+_STORE_LOCK = threading.Lock()
+
+def get_feature_store():
+    """Returns the feature store at the `feature_store.path` of the configuration
+    file, loaded once per process, or None if there is no store there."""
+    if "store" not in _STORE:
+        with _STORE_LOCK:
+            if "store" not in _STORE:
+                path = get_config().get("feature_store", {}).get("path")
+                exists = path and os.path.exists(os.path.join(path, "index.json"))
+                _STORE["store"] = FeatureStore(path) if exists else None
+
+    return _STORE["store"]
+
+def swap_feature_store(store):
+    """Replaces the feature store of the process, e.g. by an `updated` copy"""
+    _STORE["store"] = store
@@ -0,0 +1,302 @@
+"""Local database module
+
+This module provides an in-memory stand-in for the Database Service, to run
+the service, load tests and benchmarks on a machine without it. It answers
+`/fetch` requests, as sent by `db_utils.DBClient`, from a catalog held in
+memory, and can delay its responses to mimic the latency of the real one.
+
+Only the subset of MongoDB queries the service emits is supported: equality,
+`$and`, `$or`, `$in`, `$ne`, `$regex` with `$options` and the range operators
+`$gt`, `$gte`, `$lt` and `$lte`, on dotted paths, and results can be sorted and
+limited.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import copy
+import itertools
+import json
+import operator
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+_MISSING = object()
+
+_COMPARISONS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+_REGEX_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each connection in a thread, as the one of Python 3.7"""
+    daemon_threads = True
+
+def get_path(doc, path):
+    """Value of the dotted `path` in `doc`, or `_MISSING`"""
+    value = doc
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+def _comparison(compare, bound):
+    """Check of a range operator, values of other types than `bound` don't match"""
+    def check(value):
+        try:
+            return value is not _MISSING and value is not None and compare(value, bound)
+        except TypeError:
+            return False
+    return check
+
+def _candidates(value):
+    """Values a condition is checked against, an array matches if any of its items does"""
+    return [value, *value] if isinstance(value, list) else [value]
+
+def _compile_condition(path, condition):
+    """Predicate of the condition on the field at `path`"""
+    if not isinstance(condition, dict) or not any(k.startswith("$") for k in condition):
+        expected = None if condition is None else condition
+        return lambda doc: any(v == expected if v is not _MISSING else expected is None
+                               for v in _candidates(get_path(doc, path)))
+
+    unknown = set(condition) - {"$in", "$ne", "$regex", "$options", *_COMPARISONS}
+    if unknown:
+        raise ValueError("Unsupported operators {}".format(sorted(unknown)))
+
+    checks = [_comparison(_COMPARISONS[op], bound) for op, bound in condition.items()
+              if op in _COMPARISONS]
+    if "$in" in condition:
+        values = condition["$in"]
+        scalars = {v for v in values if not isinstance(v, (list, dict))}
+        def is_in(value):
+            if value is _MISSING:
+                return None in scalars
+            return value in values if isinstance(value, (list, dict)) else value in scalars
+        checks.append(is_in)
+    if "$regex" in condition:
+        flags = 0
+        for option in condition.get("$options", ""):
+            flags |= _REGEX_FLAGS[option]
+        pattern = re.compile(condition["$regex"], flags)
+        checks.append(lambda value: isinstance(value, str) and pattern.search(value) is not None)
+
+    if "$ne" in condition:
+        # a missing field doesn't equal anything, an array must not contain the value
+        equal = _compile_condition(path, condition["$ne"])
+        checks_all = lambda doc: not equal(doc)
+    else:
+        checks_all = lambda doc: True
+
+    return lambda doc: checks_all(doc) and all(
+        any(check(v) for v in _candidates(get_path(doc, path))) for check in checks)
+
+def compile_query(query):
+    """Compiles a MongoDB-style query into a predicate on documents.
+
+    Parameters
+    ----------
+    query : dict
+
+    Returns
+    -------
+    callable
+        Function of a document, true if the document matches `query`.
+
+    Raises
+    ------
+    ValueError
+        If the query uses an unsupported operator.
+    """
+    predicates = []
+    for key, value in query.items():
+        if key in ("$and", "$or"):
+            clauses = [compile_query(clause) for clause in value]
+            combine = all if key == "$and" else any
+            predicates.append(lambda doc, clauses=clauses, combine=combine:
+                              combine(clause(doc) for clause in clauses))
+        elif key.startswith("$"):
+            raise ValueError("Unsupported operator {}".format(key))
+        else:
+            predicates.append(_compile_condition(key, value))
+
+    return lambda doc: all(predicate(doc) for predicate in predicates)
+
+def project(doc, projection):
+    """Applies a MongoDB-style projection, of only inclusions or only exclusions, to `doc`"""
+    if not projection:
+        return doc
+
+    if not any(projection.values()):
+        result = copy.deepcopy(doc)
+        for path in projection:
+            *parents, key = path.split(".")
+            parent = get_path(result, ".".join(parents)) if parents else result
+            if isinstance(parent, dict):
+                parent.pop(key, None)
+        return result
+
+    result = {}
+    for path, include in projection.items():
+        value = get_path(doc, path)
+        if not include or value is _MISSING:
+            continue
+        *parents, key = path.split(".")
+        target = result
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[key] = value
+    return result
+
+def _sort_key(path):
+    """Sort key of documents by the field at `path`, missing values first"""
+    def key(doc):
+        value = get_path(doc, path)
+        return (0, None) if value is _MISSING or value is None else (1, value)
+    return key
+
+def _id_constraint(query):
+    """IDs a query is restricted to by an `id` equality or `$in`, or None"""
+    value = query.get("id", _MISSING)
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict) and set(value) == {"$in"}:
+        return value["$in"]
+
+    for clause in query.get("$and", []):
+        ids = _id_constraint(clause)
+        if ids is not None:
+            return ids
+    return None
+
+class LocalDatabase(object):
+    """In-memory collection of book objects.
+
+    Parameters
+    ----------
+    books : iterable of dict
+        Book objects, as returned by the Database Service.
+    """
+
+    def __init__(self, books):
+        self.books = list(books)
+        self._by_id = {book["id"]: book for book in self.books if "id" in book}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.books)
+
+    def put(self, book):
+        """Adds `book`, or replaces the book with the same ID"""
+        with self._lock:
+            books = [b for b in self.books if b.get("id") != book["id"]] + [book]
+            self.books, self._by_id = books, {**self._by_id, book["id"]: book}
+
+    def find(self, query, projection=None, sort=None, limit=None):
+        """Finds the books matching `query`, in catalog order.
+
+        Queries on `id` are answered from an index by ID instead of a scan.
+
+        Parameters
+        ----------
+        query : dict
+            The PyMongo-style query object.
+        projection : dict, optional
+        sort : list of [str, int], optional
+            Paths to sort by, with 1 for ascending and -1 for descending order.
+        limit : int, optional
+            Maximum number of books, 0 or None for no limit.
+
+        Returns
+        -------
+        list of dict
+
+        Raises
+        ------
+        ValueError
+            If the query uses an unsupported operator.
+        TypeError
+            If the values of a sort path can't be compared.
+        """
+        predicate = compile_query(query)
+        ids = _id_constraint(query)
+        if ids is None:
+            books = self.books
+        else:
+            books = [self._by_id[book_id] for book_id in dict.fromkeys(ids)
+                     if book_id in self._by_id]
+
+        matches = (book for book in books if predicate(book))
+        if sort:
+            matches = list(matches)
+            for path, direction in reversed(sort):
+                if direction not in (1, -1):
+                    raise ValueError("Invalid sort direction {!r}".format(direction))
+                matches.sort(key=_sort_key(path), reverse=direction == -1)
+
+        return [project(book, projection) for book in itertools.islice(matches, limit or None)]
+
+def make_server(database, host="127.0.0.1", port=9000, latency=0, jitter=0):
+    """Creates an HTTP server answering `/fetch` requests from `database`.
+
+    Parameters
+    ----------
+    database : LocalDatabase
+    host : str, optional
+    port : int, optional
+        0 picks a free port, see `server.server_address`.
+    latency : float, optional
+        Seconds every response is delayed by, on top of the time to answer it.
+    jitter : float, optional
+        Up to this many seconds are added at random to the delay.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        Call `serve_forever` to serve requests, one thread per connection.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True # headers and body are written separately
+
+        def do_POST(self): # pylint: disable=invalid-name
+            try:
+                length = int(self.headers["Content-Length"])
+                body = json.loads(self.rfile.read(length).decode("utf-8"))
+                options = {name: json.loads(body[name]) for name in ("projection", "sort", "limit")
+                           if body.get(name)}
+                docs = database.find(json.loads(body["constraints"]), **options)
+                # as the Database Service, the JSON result is sent encoded as a JSON string
+                status, payload = 200, json.dumps(json.dumps({"resp": docs}))
+            except (KeyError, TypeError, ValueError) as error:
+                status, payload = 400, json.dumps({"error": str(error)})
+
+            delay = latency + random.uniform(0, jitter)
+            if delay > 0:
+                time.sleep(delay)
+            self._send(status, payload.encode("utf-8"))
+
+        def _send(self, status, payload):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args): # pylint: disable=arguments-differ
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+def serve_in_background(database, **kwargs):
+    """Starts `make_server(database, **kwargs)` in a daemon thread,
+    returns the server, call `shutdown` to stop it."""
+    server = make_server(database, **kwargs)
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05},
+                     daemon=True).start()
+    return server
@@ -7,8 +7,14 @@ database and for mesuring similarity between books.
 # Author: Alexandru Burlacu
 # Email:  alexandru-varacuta@bookvoyager.org
 
+import heapq
+import time
 from math import sqrt
-from .utils import compose
+
+import numpy as np
+
+from .metrics import DTW_CANDIDATES, stage, STAGE_SECONDS
+from .models import as_book, EMOTIONS
 
 
 def reshape_transform(objs):
@@ -172,51 +178,633 @@ def reshape_output(func):
     Parameters
     ----------
     func : binary function
-    base : dict
-    matches : list of dict
+    base : src.models.Book or dict
+    matches : list of src.models.Book or dict
 
     Returns
     -------
-    {base_name : [{"score" : score, "title": candidate_obj}]}
-        base_name, candidate_obj is str and score is float
+    {base_name : [{"score" : score, "title": candidate_obj, "id": candidate_id}]}
+        base_name, candidate_obj, candidate_id is str and score is float
     """
-    get_title = lambda o: o["metadata"]["title"]
     def __inner(base, matches, *args, **kwargs):
-        base_name = get_title(base)
+        base, matches = as_book(base), [as_book(match) for match in matches]
 
         scores = func(base, matches, *args, **kwargs)
 
         return {
-            base_name: [{"score": score,
-                         "title": title} for score, title in
-                        zip(scores, map(get_title, matches))]
+            base.title: [{"score": score,
+                          "title": match.title,
+                          "id": match.id} for score, match in zip(scores, matches)]
         }
 
     return __inner
 
+def chunk_layout(max_len):
+    """Computes the chunking `chunk_sum` applies to vectors of length `max_len`.
+
+    Parameters
+    ----------
+    max_len : int
+
+    Returns
+    -------
+    (int, int)
+        The number of chunks and the size of a chunk. The last chunk may be
+        shorter, so there can be more than 100 chunks.
+    """
+    size = max(max_len, 100)
+    chunk_size = int(size / 100)
+    return -(-size // chunk_size), chunk_size
+
+def _positions(indices, max_len):
+    """Maps timeline indices to `fill` positions, with list assignment semantics"""
+    positions = np.asarray(indices, dtype=np.intp)
+    if positions.max() >= max_len or positions.min() < -max_len:
+        raise IndexError("timeline index out of range for length {}".format(max_len))
+
+    return np.where(positions < 0, positions + max_len, positions)
+
+def timeline_events(timeline):
+    """Flattens a sentiment timeline into parallel arrays of events.
+
+    Parameters
+    ----------
+    timeline : dict of str to list of (int, int)
+        Output of `reshape_transform`.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        Emotion codes (positions in `EMOTIONS`), indices and scores of the events.
+        Events of an emotion keep their chronological order.
+    """
+    codes, indices, scores = [], [], []
+    for code, key in enumerate(EMOTIONS):
+        for score, index in timeline[key]:
+            codes.append(code)
+            indices.append(index)
+            scores.append(score)
+
+    return (np.asarray(codes, dtype=np.uint8), np.asarray(indices, dtype=np.int64),
+            np.asarray(scores, dtype=float))
+
+def bucket_events(codes, indices, scores, max_len):
+    """Computes the chunk sums of a sentiment timeline without filling it.
+
+    Every (score, index) pair is mapped straight to its chunk, so the cost is
+    linear in the number of timeline events instead of in `max_len`. As in
+    `fill`, a later event at the same index overwrites an earlier one.
+
+    Parameters
+    ----------
+    codes, indices, scores : numpy.ndarray
+        Output of `timeline_events`.
+    max_len : int
+        Length of the vector `fill` would produce.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (6, n_chunks), equal to `chunk_sum(fill(...))` of every emotion.
+    """
+    n_chunks, chunk_size = chunk_layout(max_len)
+    if not len(codes):
+        return np.zeros((len(EMOTIONS), n_chunks))
+
+    codes = np.asarray(codes, dtype=np.intp)
+    positions = _positions(indices, max_len)
+    _, last = np.unique((codes * max_len + positions)[::-1], return_index=True)
+    last = len(codes) - 1 - last
+
+    buckets = np.bincount(codes[last] * n_chunks + positions[last] // chunk_size,
+                          weights=np.asarray(scores, dtype=float)[last],
+                          minlength=len(EMOTIONS) * n_chunks)
+    return buckets.reshape(len(EMOTIONS), n_chunks)
+
+def bucket_timeline(timeline, max_len):
+    """Applies `bucket_events` to a `reshape_transform` output"""
+    return bucket_events(*timeline_events(timeline), max_len)
+
+def vectorize(timelines, max_len):
+    """Stacks the chunk sums of many sentiment timelines into one array.
+
+    Equivalent to applying `fill_obj` to every timeline, but the result is
+    a single NumPy array instead of a list of dicts.
+
+    Parameters
+    ----------
+    timelines : list of dict of str to list of (int, int)
+        Outputs of `reshape_transform`.
+    max_len : int
+        Length of the filled sentiment vectors.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (len(timelines), 6, n_chunks), emotions in `EMOTIONS` order.
+    """
+    n_chunks, _ = chunk_layout(max_len)
+    tensor = np.zeros((len(timelines), len(EMOTIONS), n_chunks))
+    for row, timeline in zip(tensor, timelines):
+        row[:] = bucket_timeline(timeline, max_len)
+
+    return tensor
+
+def batch_similarity(base, tensor):
+    """Computes `similarity` between a base book and many books at once.
+
+    Parameters
+    ----------
+    base : numpy.ndarray
+        Array of shape (6, n_chunks).
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_books, 6) with the per-emotion cosine similarities.
+    """
+    numerator = np.einsum("ec,nec->ne", base, tensor)
+    denominator = (np.sqrt(np.einsum("ec,ec->e", base, base))
+                   * np.sqrt(np.einsum("nec,nec->ne", tensor, tensor)))
+    denominator[denominator == 0] = 1e-5
+
+    return numerator / denominator
+
+def block_similarity(bases, tensor):
+    """Computes `batch_similarity` of many base books at once.
+
+    Parameters
+    ----------
+    bases : numpy.ndarray
+        Array of shape (n_bases, 6, n_chunks).
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_bases, n_books, 6) with the per-emotion cosine similarities.
+    """
+    numerator = np.einsum("bec,nec->bne", bases, tensor)
+    denominator = (np.sqrt(np.einsum("bec,bec->be", bases, bases))[:, None, :]
+                   * np.sqrt(np.einsum("nec,nec->ne", tensor, tensor))[None, :, :])
+    denominator[denominator == 0] = 1e-5
+
+    return numerator / denominator
+
+def batch_score(cosines):
+    """Sums per-emotion similarities, the last axis of `cosines`,
+    in the same order as `compute_score`"""
+    scores = np.zeros(cosines.shape[:-1])
+    for column in np.moveaxis(cosines, -1, 0):
+        scores += column
+
+    return scores
+
+def unit_series(tensor):
+    """Scales every emotion of every book to unit length, see `dtw_distance`.
+
+    Parameters
+    ----------
+    tensor : numpy.ndarray
+        Array of shape (..., 6, n_chunks).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of the same shape, emotions without any sentiment stay 0.
+    """
+    norms = np.sqrt(np.einsum("...c,...c->...", tensor, tensor))
+    norms[norms == 0] = 1
+    return tensor / norms[..., None]
+
+def envelope(series, window):
+    """Running maximum and minimum of `series` over `window` chunks on each side.
+
+    Parameters
+    ----------
+    series : numpy.ndarray
+        Array of shape (..., n_chunks).
+    window : int
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        Upper and lower envelopes, of the shape of `series`.
+    """
+    upper = np.array(series, dtype=float)
+    lower = upper.copy()
+    # one pass per shift, with NumPy 1.14 there is no sliding window view
+    for shift in range(1, window + 1):
+        for ahead, behind in [(slice(shift, None), slice(None, -shift)),
+                              (slice(None, -shift), slice(shift, None))]:
+            np.maximum(upper[..., ahead], series[..., behind], out=upper[..., ahead])
+            np.minimum(lower[..., ahead], series[..., behind], out=lower[..., ahead])
+    return upper, lower
+
+def lb_kim(base, tensor):
+    """Lower bound of `dtw_distance`, from the first and last chunks, which
+    every warping path matches with each other.
+
+    Parameters
+    ----------
+    base : numpy.ndarray
+        Array of shape (6, n_chunks).
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_books, 6).
+    """
+    first = (base[:, 0] - tensor[:, :, 0]) ** 2
+    if base.shape[-1] == 1:
+        return first
+    return first + (base[:, -1] - tensor[:, :, -1]) ** 2
+
+def lb_keogh(upper, lower, tensor):
+    """Lower bound of `dtw_distance`, from how far the chunks of the books are
+    outside of the `envelope` of the base book.
+
+    Parameters
+    ----------
+    upper, lower : numpy.ndarray
+        Envelope of the base book, arrays of shape (6, n_chunks).
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_books, 6).
+    """
+    above = np.maximum(tensor - upper, 0)
+    below = np.maximum(lower - tensor, 0)
+    return np.einsum("nec,nec->ne", above, above) + np.einsum("nec,nec->ne", below, below)
+
+def dtw_distance(base, tensor, window):
+    """Dynamic time warping distances between a base book and many books,
+    for every emotion, with a Sakoe-Chiba band of `window` chunks.
+
+    The cost of a warping path is the sum of the squared differences of the
+    chunks it matches, so with a `window` of 0 it is the squared Euclidean
+    distance. The cells of an anti-diagonal of the cost matrix don't depend
+    on each other, so they are computed at once, for all books and emotions.
+
+    Parameters
+    ----------
+    base : numpy.ndarray
+        Array of shape (6, n_chunks).
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks).
+    window : int
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_books, 6).
+    """
+    n_books, n_emotions, n_chunks = tensor.shape
+    # chunks first and the series of all books and emotions side by side, so
+    # that the cells of an anti-diagonal are contiguous rows
+    base = np.tile(base.T, (1, n_books))
+    reversed_tensor = tensor.reshape(-1, n_chunks).T[::-1]
+
+    # costs of the cells of the last three anti-diagonals, by row, shifted by
+    # one so that the row before the first one is an infinite border
+    buffers = [np.full((n_chunks + 1, base.shape[1]), np.inf) for _ in range(3)]
+    bands = [(0, -1)] * 3
+    for diagonal in range(2 * n_chunks - 1):
+        first = max(0, diagonal - n_chunks + 1, -(-(diagonal - window) // 2))
+        last = min(n_chunks - 1, diagonal, (diagonal + window) // 2) + 1
+        current, previous, before = buffers[diagonal % 3], buffers[(diagonal - 1) % 3], \
+            buffers[(diagonal - 2) % 3]
+        stale = bands[diagonal % 3]
+        current[stale[0] + 1:stale[1] + 1] = np.inf
+        bands[diagonal % 3] = (first, last)
+
+        offset = n_chunks - 1 - diagonal
+        cost = base[first:last] - reversed_tensor[offset + first:offset + last]
+        cost *= cost
+        if diagonal == 0:
+            current[1] = cost[0]
+        else:
+            steps = np.minimum(previous[first:last], previous[first + 1:last + 1])
+            np.minimum(steps, before[first:last], out=steps)
+            current[first + 1:last + 1] = cost + steps
+
+    return current[n_chunks].reshape(n_books, n_emotions)
+
+def dtw_similarity(base, tensor, window):
+    """Like `batch_similarity`, but the books are compared with `dtw_distance`.
+
+    Every emotion is scaled to unit length, so with a `window` of 0 the result
+    equals the cosine similarity, as `1 - distance / 2`. Warping can only lower
+    the distance, so the similarities are at least the cosine ones. Emotions
+    missing from either book are 0, as for the cosine.
+
+    Parameters
+    ----------
+    base : numpy.ndarray
+        Array of shape (6, n_chunks).
+    tensor : numpy.ndarray
+        Array of shape (n_books, 6, n_chunks).
+    window : int
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_books, 6).
+    """
+    shared = base.any(axis=1) & tensor.any(axis=2)
+    distances = dtw_distance(unit_series(base), unit_series(tensor), window)
+    return np.where(shared, 1 - distances / 2, 0)
+
+def _load_timeline(book, store):
+    """Sentiment timeline of a `Book`, from the feature store when it's there"""
+    if store is not None and book.id in store:
+        return store.timeline(book.id)
+    return book.timeline
+
+def _stack_timelines(timelines, max_len):
+    """Applies `bucket_events` to many `SentimentTimeline`, see `vectorize`"""
+    n_chunks, _ = chunk_layout(max_len)
+    tensor = np.zeros((len(timelines), len(EMOTIONS), n_chunks))
+    for row, timeline in zip(tensor, timelines):
+        row[:] = bucket_events(timeline.codes, timeline.indices, timeline.scores, max_len)
+
+    return tensor
+
 @reshape_output
-def get_candidates(raw_base, raw_fetched_objs):
+def get_candidates(raw_base, raw_fetched_objs, store=None):
     """
 
     Parameters
     ----------
-    raw_base : dict
+    raw_base : src.models.Book or dict
         Base book
-    raw_fetched_objs : [dict]
+    raw_fetched_objs : [src.models.Book or dict]
         Matching books
+    store : src.features.FeatureStore, optional
+        Preprocessed timelines, used instead of the `sentiment.timeline`
+        of the books found in it.
 
     Returns
     -------
     [float]
         The similarity scores of books compared to the base book.
     """
-    get_timeline = compose(reshape_transform, lambda o: o["sentiment"]["timeline"])
+    with stage("vectorize"):
+        timelines = [_load_timeline(book, store) for book in [raw_base, *raw_fetched_objs]]
+        tensor = _stack_timelines(timelines, max(t.length for t in timelines) + 1)
+
+    with stage("similarity"):
+        return batch_score(batch_similarity(tensor[0], tensor[1:])).tolist()
+
+def score_shard(base_timeline, timelines, top_n, max_len, offset=0):
+    """Finds the `top_n` best scoring books of a shard of the candidates.
 
-    base_sentiment = get_timeline(raw_base)
-    fetched_objs_sentiment = list(map(get_timeline, raw_fetched_objs))
+    A cosine is at most 1, and it is exactly 0 for an emotion missing from
+    either book, so the number of emotions two books share bounds their score.
+    Books are scored in groups of equal bound, highest first, and scoring stops
+    once the bound can't beat the `top_n`-th best score found so far.
 
-    max_len = get_max_len([base_sentiment, *fetched_objs_sentiment]) + 1
-    base = fill_obj(base_sentiment, max_len)
-    fetched_objs = (fill_obj(o, max_len) for o in fetched_objs_sentiment)
+    Parameters
+    ----------
+    base_timeline : src.models.SentimentTimeline
+    timelines : [src.models.SentimentTimeline]
+        Timelines of the books of the shard.
+    top_n : int
+    max_len : int
+        Length of the vectors, the same for all shards.
+    offset : int, optional
+        Position of the first book of the shard among all candidates.
 
-    return compute_score(similarity(base, obj) for obj in fetched_objs)
+    Returns
+    -------
+    ([(float, int)], (float, float))
+        Score and negated position of the best books, and the seconds spent
+        vectorizing and computing similarities.
+    """
+    started = time.perf_counter()
+    base = _stack_timelines([base_timeline], max_len)[0]
+    base_emotions = base.any(axis=1)
+    bounds = [int(np.count_nonzero(base_emotions
+                                   & (np.bincount(t.codes, minlength=len(EMOTIONS)) > 0)))
+              for t in timelines]
+
+    heap = [] # (score, -position) of the best books so far
+    vectorizing, scoring = time.perf_counter() - started, 0
+    for bound in [] if top_n < 1 else sorted(set(bounds), reverse=True):
+        if len(heap) == top_n and bound < heap[0][0] - 1e-9:
+            break
+
+        started = time.perf_counter()
+        group = [i for i, b in enumerate(bounds) if b == bound]
+        tensor = _stack_timelines([timelines[i] for i in group], max_len)
+        vectorized = time.perf_counter()
+
+        for i, score in zip(group, batch_score(batch_similarity(base, tensor)).tolist()):
+            if len(heap) < top_n:
+                heapq.heappush(heap, (score, -(offset + i)))
+            elif (score, -(offset + i)) > heap[0]:
+                heapq.heapreplace(heap, (score, -(offset + i)))
+        vectorizing += vectorized - started
+        scoring += time.perf_counter() - vectorized
+
+    return heap, (vectorizing, scoring)
+
+def _load_candidates(raw_base, raw_fetched_objs, store):
+    """Books, timelines and vector length of the base book and the candidates"""
+    base_book, books = as_book(raw_base), [as_book(o) for o in raw_fetched_objs]
+    base_timeline, *timelines = [_load_timeline(b, store) for b in [base_book, *books]]
+    max_len = max(t.length for t in [base_timeline, *timelines]) + 1
+
+    return base_book, books, base_timeline, timelines, max_len
+
+def _top_entries(base_book, books, top):
+    """Output of `get_top_candidates` for the (score, -position) pairs `top`"""
+    return {
+        base_book.title: [{"score": score,
+                           "title": books[-i].title,
+                           "id": books[-i].id} for score, i in sorted(top, key=lambda x: -x[1])]
+    }
+
+def get_top_candidates(raw_base, raw_fetched_objs, top_n, store=None):
+    """Like `get_candidates`, but only keeps the `top_n` best scoring books,
+    see `score_shard`.
+
+    Parameters
+    ----------
+    raw_base : src.models.Book or dict
+        Base book
+    raw_fetched_objs : [src.models.Book or dict]
+        Matching books
+    top_n : int
+        Number of books to keep.
+    store : src.features.FeatureStore, optional
+
+    Returns
+    -------
+    {base_name : [{"score" : score, "title": candidate_obj, "id": candidate_id}]}
+        The entries of `get_candidates` for the `top_n` best books, in the order
+        of `raw_fetched_objs`. Ties are won by the book coming first.
+    """
+    started = time.perf_counter()
+    base_book, books, base_timeline, timelines, max_len = \
+        _load_candidates(raw_base, raw_fetched_objs, store)
+    loading = time.perf_counter() - started
+
+    top, (vectorizing, scoring) = score_shard(base_timeline, timelines, top_n, max_len)
+    STAGE_SECONDS.observe(loading + vectorizing, "vectorize")
+    STAGE_SECONDS.observe(scoring, "similarity")
+
+    return _top_entries(base_book, books, top)
+
+def get_sharded_top_candidates(raw_base, raw_fetched_objs, top_n, run_shards, n_shards,
+                               store=None):
+    """Like `get_top_candidates`, but the candidates are split in `n_shards`
+    shards scored by `score_shard` calls run by `run_shards`, for instance in
+    other processes, and their best books are merged. The result is the same.
+
+    Parameters
+    ----------
+    raw_base : src.models.Book or dict
+    raw_fetched_objs : [src.models.Book or dict]
+    top_n : int
+    run_shards : callable
+        Called with `score_shard` and a list of tuples of its arguments,
+        returns the results of the calls, in order.
+    n_shards : int
+    store : src.features.FeatureStore, optional
+
+    Returns
+    -------
+    {base_name : [{"score" : score, "title": candidate_obj, "id": candidate_id}]}
+    """
+    base_book, books, base_timeline, timelines, max_len = \
+        _load_candidates(raw_base, raw_fetched_objs, store)
+
+    shard_size = -(-len(timelines) // max(n_shards, 1)) or 1
+    shards = [(base_timeline, timelines[offset:offset + shard_size], top_n, max_len, offset)
+              for offset in range(0, len(timelines), shard_size)]
+
+    results = run_shards(score_shard, shards)
+    top = heapq.nlargest(max(top_n, 0), (entry for shard_top, _ in results for entry in shard_top))
+    STAGE_SECONDS.observe(sum(seconds for _, (seconds, _) in results), "vectorize")
+    STAGE_SECONDS.observe(sum(seconds for _, (_, seconds) in results), "similarity")
+
+    return _top_entries(base_book, books, top)
+
+def get_dtw_top_candidates(raw_base, raw_fetched_objs, top_n, window, store=None,
+                           batch_size=64):
+    """Like `get_top_candidates`, but the books are compared with `dtw_similarity`,
+    so that similar emotional arcs shifted by up to `window` chunks still match.
+
+    The upper bound of the score of every book is computed from the `lb_kim`
+    and `lb_keogh` lower bounds of its distances. Books are scored in batches,
+    highest bound first, and scoring stops once the bound can't beat the
+    `top_n`-th best score found so far, which usually prunes most books.
+
+    Parameters
+    ----------
+    raw_base : src.models.Book or dict
+    raw_fetched_objs : [src.models.Book or dict]
+    top_n : int
+    window : int
+        Maximum shift in chunks, see `dtw_distance`.
+    store : src.features.FeatureStore, optional
+    batch_size : int, optional
+        Number of books whose distances are computed at once.
+
+    Returns
+    -------
+    {base_name : [{"score" : score, "title": candidate_obj, "id": candidate_id}]}
+    """
+    with stage("vectorize"):
+        base_book, books, base_timeline, timelines, max_len = \
+            _load_candidates(raw_base, raw_fetched_objs, store)
+        tensor = _stack_timelines([base_timeline, *timelines], max_len)
+        base, tensor = tensor[0], tensor[1:]
+
+    with stage("lower_bounds"):
+        unit_base, unit_tensor = unit_series(base), unit_series(tensor)
+        upper, lower = envelope(unit_base, window)
+        distances = np.maximum(lb_kim(unit_base, unit_tensor),
+                               lb_keogh(upper, lower, unit_tensor))
+        shared = base.any(axis=1) & tensor.any(axis=2)
+        bounds = batch_score(np.where(shared, 1 - distances / 2, 0))
+        order = np.argsort(-bounds, kind="mergesort")
+
+    heap = [] # (score, -position) of the best books so far
+    scored = 0
+    with stage("similarity"):
+        for start in [] if top_n < 1 else range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            if len(heap) == top_n and bounds[batch[0]] < heap[0][0] - 1e-9:
+                break
+
+            scores = batch_score(dtw_similarity(base, tensor[batch], window))
+            scored += len(batch)
+            for i, score in zip(batch.tolist(), scores.tolist()):
+                if len(heap) < top_n:
+                    heapq.heappush(heap, (score, -i))
+                elif (score, -i) > heap[0]:
+                    heapq.heapreplace(heap, (score, -i))
+
+    DTW_CANDIDATES.inc("scored", amount=scored)
+    DTW_CANDIDATES.inc("pruned", amount=len(books) - scored)
+    return _top_entries(base_book, books, heap)
+
+def get_batch_candidates(raw_bases, raw_fetched_objs, top_n, store=None):
+    """Finds the `top_n` best matches of many base books at once.
+
+    Every book is vectorized once, the bases found among the matches are not
+    vectorized again, and all bases are scored against all matches in one pass.
+    The vectors use the longest timeline of all bases and matches, so the scores
+    are those of `get_candidates` when the bases are among the matches.
+
+    Parameters
+    ----------
+    raw_bases : [src.models.Book or dict]
+        Base books
+    raw_fetched_objs : [src.models.Book or dict]
+        Matching books
+    top_n : int
+        Number of books to keep for each base.
+    store : src.features.FeatureStore, optional
+
+    Returns
+    -------
+    list of {base_name : [{"score" : score, "title": candidate_obj, "id": candidate_id}]}
+        The output of `get_top_candidates` for every base book, in order.
+    """
+    if not raw_bases:
+        return []
+
+    bases, books = [as_book(o) for o in raw_bases], [as_book(o) for o in raw_fetched_objs]
+    rows = {book.id: row for row, book in enumerate(books)}
+    extra_bases, base_rows = [], []
+    for base in bases:
+        if base.id not in rows:
+            rows[base.id] = len(books) + len(extra_bases)
+            extra_bases.append(base)
+        base_rows.append(rows[base.id])
+
+    with stage("vectorize"):
+        timelines = [_load_timeline(book, store) for book in [*books, *extra_bases]]
+        tensor = _stack_timelines(timelines, max(t.length for t in timelines) + 1)
+
+    with stage("similarity"):
+        scores = batch_score(block_similarity(tensor[base_rows], tensor[:len(books)]))
+
+    results = []
+    for base, base_scores in zip(bases, scores):
+        top = np.sort(np.argsort(-base_scores, kind="mergesort")[:max(top_n, 0)])
+        results.append({base.title: [{"score": float(base_scores[i]),
+                                      "title": books[i].title,
+                                      "id": books[i].id} for i in top]})
+    return results
@@ -0,0 +1,223 @@
+"""Metrics module
+
+This module keeps in-process counters and histograms of the service, such as
+the time spent in every stage of a recommendation, and renders them in the
+Prometheus text format for the `/metrics` endpoint. Observing a value is a
+bisection and two additions under a lock, cheap enough for the hot path.
+
+Metrics are kept per worker process, so every worker has to be scraped.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from .cache import get_caches
+from .concurrency import get_single_flights
+
+# upper bounds of the buckets of a latency histogram, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# upper bounds of the buckets of a size histogram
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+_METRICS = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values, extra=()):
+    """Renders label names and values as `{name="value",...}`"""
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, _escape(value)) for name, value in pairs) + "}"
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+class Counter(object):
+    """Monotonically increasing count, by label values.
+
+    Parameters
+    ----------
+    name : str
+    documentation : str
+    labelnames : tuple of str, optional
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        """Increases the count of the series `labelvalues` by `amount`"""
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        """Lines of the metric in the Prometheus text format"""
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} counter".format(self.name)]
+        lines += ["{}{} {}".format(self.name, _labels(self.labelnames, labelvalues), _number(value))
+                  for labelvalues, value in values]
+        return lines
+
+class Gauge(object):
+    """Value which goes up and down, by label values.
+
+    Parameters
+    ----------
+    name : str
+    documentation : str
+    labelnames : tuple of str, optional
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def set(self, value, *labelvalues):
+        """Sets the value of the series `labelvalues`"""
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def collect(self):
+        """Lines of the metric in the Prometheus text format"""
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} gauge".format(self.name)]
+        lines += ["{}{} {}".format(self.name, _labels(self.labelnames, labelvalues), _number(value))
+                  for labelvalues, value in values]
+        return lines
+
+class Histogram(object):
+    """Distribution of observed values, as counts of values in buckets.
+
+    Parameters
+    ----------
+    name : str
+    documentation : str
+    buckets : tuple of float, optional
+        Increasing upper bounds of the buckets, a `+Inf` one is added.
+    labelnames : tuple of str, optional
+    """
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._series = {} # label values -> [count of every bucket..., sum]
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def observe(self, value, *labelvalues):
+        """Adds `value` to the series `labelvalues`"""
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observes the seconds the `with` block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def collect(self):
+        """Lines of the metric in the Prometheus text format"""
+        with self._lock:
+            series = sorted((labelvalues, list(counts)) for labelvalues, counts in
+                            self._series.items())
+
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} histogram".format(self.name)]
+        for labelvalues, counts in series:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _labels(self.labelnames, labelvalues, [("le", _number(bound))]),
+                    cumulative))
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append("{}_sum{} {}".format(self.name, labels, _number(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+STAGE_SECONDS = Histogram("recommendation_stage_seconds",
+                          "Seconds spent in every stage of serving a request.",
+                          labelnames=("stage",))
+CANDIDATES = Histogram("recommendation_candidates",
+                       "Number of candidate books scored for a request.",
+                       buckets=SIZE_BUCKETS, labelnames=("endpoint",))
+DTW_CANDIDATES = Counter("dtw_candidates_total",
+                         "Candidates of DTW scoring, by whether the lower bounds pruned them.",
+                         labelnames=("outcome",))
+STALE_RESPONSES = Counter("stale_responses_total",
+                          "Responses served from expired cache entries, as the Database Service "
+                          "turned the requests away.", labelnames=("endpoint",))
+REQUEST_SECONDS = Histogram("http_request_duration_seconds",
+                            "Seconds spent serving HTTP requests.",
+                            labelnames=("endpoint", "status"))
+
+def stage(name):
+    """Times the `with` block as the stage `name` of `STAGE_SECONDS`"""
+    return STAGE_SECONDS.time(name)
+
+def _collect_caches():
+    caches = sorted(get_caches().items())
+    lines = []
+    for metric, kind, field, documentation in [
+            ("cache_hits_total", "counter", "hits", "Lookups which found a valid entry."),
+            ("cache_misses_total", "counter", "misses", "Lookups which found no valid entry."),
+            ("cache_entries", "gauge", "size", "Number of entries.")]:
+        lines += ["# HELP {} {}".format(metric, documentation),
+                  "# TYPE {} {}".format(metric, kind)]
+        lines += ["{}{} {}".format(metric, _labels(("cache",), (name,)),
+                                   _number(cache.stats()[field])) for name, cache in caches]
+    return lines
+
+def _collect_single_flights():
+    flights = sorted(get_single_flights().items())
+    lines = []
+    for metric, kind, field, documentation in [
+            ("single_flight_calls_total", "counter", "calls", "Calls run by a leader."),
+            ("single_flight_shared_total", "counter", "shared",
+             "Calls which waited for the identical call in flight."),
+            ("single_flight_in_flight", "gauge", "in_flight", "Number of calls in flight.")]:
+        lines += ["# HELP {} {}".format(metric, documentation),
+                  "# TYPE {} {}".format(metric, kind)]
+        lines += ["{}{} {}".format(metric, _labels(("name",), (name,)),
+                                   _number(flight.stats()[field])) for name, flight in flights]
+    return lines
+
+def render():
+    """All metrics of the process, in the Prometheus text format"""
+    lines = [line for metric in _METRICS for line in metric.collect()]
+    return "\n".join(lines + _collect_caches() + _collect_single_flights()) + "\n"
@@ -0,0 +1,111 @@
+"""Domain types module
+
+This module contains compact representations of the books handled by the
+recommendation engine. A sentiment timeline from the database service is a
+list of `[score, emotion, token, index]` lists, several Python objects per
+event. `SentimentTimeline` keeps the same events in three parallel NumPy
+arrays instead, and `Book` keeps only the fields the scoring needs.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import numpy as np
+
+
+EMOTIONS = ("sadness", "fear", "joy", "surprise", "anger", "love")
+
+EMOTION_CODES = {emotion: code for code, emotion in enumerate(EMOTIONS)}
+
+
+class SentimentTimeline(object):
+    """Events of a sentiment timeline, as parallel arrays.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        Uint8 emotion codes, positions in `EMOTIONS`.
+    indices : numpy.ndarray
+        Integer indices of the events in the text.
+    scores : numpy.ndarray
+        Sentiment scores of the events.
+    length : int
+        The `logic.get_max_len` of the timeline.
+    """
+
+    __slots__ = ("codes", "indices", "scores", "length")
+
+    def __init__(self, codes, indices, scores, length):
+        self.codes = codes
+        self.indices = indices
+        self.scores = scores
+        self.length = length
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_json(cls, events):
+        """Builds a timeline from the `sentiment.timeline` of a book object.
+
+        Parameters
+        ----------
+        events : list of (int, str, str, int)
+            Score, emotion, token and index of every event.
+
+        Returns
+        -------
+        SentimentTimeline
+            The events keep their order, the tokens are dropped.
+        """
+        count = len(events)
+        codes = np.fromiter((EMOTION_CODES[event[1]] for event in events), np.uint8, count)
+        # full precision, so that scores match the ones of the raw timelines
+        indices = np.fromiter((event[3] for event in events), np.int64, count)
+        scores = np.fromiter((event[0] for event in events), np.float64, count)
+
+        return cls(codes, indices, scores, _max_len(codes, indices, scores))
+
+def _max_len(codes, indices, scores):
+    """`logic.get_max_len` of a timeline given as parallel arrays"""
+    max_lens = []
+    for code in range(len(EMOTIONS)):
+        mask = codes == code
+        if not mask.any():
+            max_lens.append(-1)
+            continue
+
+        emotion_scores, emotion_indices = scores[mask], indices[mask]
+        top_score = emotion_scores.max()
+        max_lens += [top_score, emotion_indices[emotion_scores == top_score].max()]
+
+    return int(max(max_lens))
+
+class Book(object):
+    """The fields of a book object used for scoring.
+
+    Parameters
+    ----------
+    id : str
+    title : str
+    timeline : SentimentTimeline or None
+        None when the book object was fetched without its `sentiment.timeline`.
+    """
+
+    __slots__ = ("id", "title", "timeline")
+
+    def __init__(self, id, title, timeline): # pylint: disable=redefined-builtin
+        self.id = id
+        self.title = title
+        self.timeline = timeline
+
+    @classmethod
+    def from_json(cls, obj):
+        """Builds a book from a book object, as returned by the database service"""
+        events = obj.get("sentiment", {}).get("timeline")
+        return cls(obj.get("id"), obj["metadata"]["title"],
+                   None if events is None else SentimentTimeline.from_json(events))
+
+def as_book(obj):
+    """Returns `obj` if it is a `Book`, or the `Book` of the book object `obj`"""
+    return obj if isinstance(obj, Book) else Book.from_json(obj)
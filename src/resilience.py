@@ -0,0 +1,211 @@
+"""Resilience module
+
+This module protects the service from a slow or failing Database Service:
+an adaptive limit on the number of concurrent calls, so that requests are
+turned away early instead of piling up, and a circuit breaker, which stops
+calling the Database Service for a while once it keeps failing. Turned away
+calls raise `Overloaded`, the API serves stale cached results instead when
+it has some, or answers with `503 Service Unavailable`.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import threading
+import time
+
+from .metrics import Counter, Gauge
+
+SHED_CALLS = Counter("db_calls_shed_total",
+                     "Calls to the Database Service turned away, by reason.",
+                     labelnames=("reason",))
+CONCURRENCY_LIMIT = Gauge("db_concurrency_limit",
+                          "Current limit of concurrent calls to the Database Service.")
+CIRCUIT_OPEN = Gauge("db_circuit_open",
+                     "1 while the circuit breaker of the Database Service is open, else 0.")
+
+
+class Overloaded(Exception):
+    """Raised when a call is turned away to protect the Database Service"""
+
+class CircuitOpen(Overloaded):
+    """Raised when a call is turned away because the circuit breaker is open"""
+
+class AdaptiveLimiter(object):
+    """Limits concurrent calls, adapting the limit with AIMD to their latency.
+
+    Every call finishing in time raises the limit by `1 / limit`, about one per
+    round of calls, a failed or slow call multiplies it by `backoff`. Calls over
+    the limit wait at most `queue_timeout` seconds for a slot, at most
+    `max_waiting` of them, the others are turned away at once.
+
+    Parameters
+    ----------
+    initial_limit : int, optional
+    min_limit : int, optional
+    max_limit : int, optional
+    latency_threshold : float, optional
+        Calls taking longer, in seconds, count as slow.
+    backoff : float, optional
+        Factor the limit is multiplied by after a failed or slow call.
+    max_waiting : int, optional
+    queue_timeout : float, optional
+    """
+
+    def __init__(self, initial_limit=16, min_limit=2, max_limit=128, latency_threshold=1.0,
+                 backoff=0.7, max_waiting=32, queue_timeout=0.1):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.backoff = backoff
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._slot_freed = threading.Condition()
+        CONCURRENCY_LIMIT.set(self.limit)
+
+    def acquire(self):
+        """Takes a slot for a call, waiting a little if all are taken.
+
+        Raises
+        ------
+        Overloaded
+            If no slot got free in time, or too many calls are waiting already.
+        """
+        with self._slot_freed:
+            if self.in_flight >= int(self.limit):
+                if self.waiting >= self.max_waiting:
+                    SHED_CALLS.inc("queue_full")
+                    raise Overloaded("Too many calls waiting for the Database Service")
+
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.queue_timeout
+                    while self.in_flight >= int(self.limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not self._slot_freed.wait(remaining):
+                            SHED_CALLS.inc("limit")
+                            raise Overloaded("The Database Service is at its concurrency limit")
+                finally:
+                    self.waiting -= 1
+
+            self.in_flight += 1
+
+    def release(self, latency, failed=False):
+        """Frees the slot of a call which took `latency` seconds, and adapts the limit"""
+        with self._slot_freed:
+            self.in_flight -= 1
+            if failed or latency > self.latency_threshold:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            CONCURRENCY_LIMIT.set(self.limit)
+            self._slot_freed.notify()
+
+class CircuitBreaker(object):
+    """Stops calls after `failure_threshold` consecutive failures.
+
+    Once open, calls are turned away for `reset_timeout` seconds, then a single
+    trial call is let through, half-open, which closes the breaker if it succeeds
+    and opens it again otherwise.
+
+    Parameters
+    ----------
+    failure_threshold : int, optional
+    reset_timeout : float, optional
+    timer : callable, optional
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10, timer=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False # whether the trial call of the half-open breaker is running
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """Whether calls are being turned away"""
+        return self.opened_at is not None
+
+    def before_call(self):
+        """Checks whether a call can be made.
+
+        Raises
+        ------
+        CircuitOpen
+            If the breaker is open, or half-open with its trial call running.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or self.timer() < self.opened_at + self.reset_timeout:
+                SHED_CALLS.inc("circuit_open")
+                raise CircuitOpen("The Database Service is failing, calls are paused")
+            self._trial = True
+
+    def cancel_call(self):
+        """Records that a call let through by `before_call` wasn't made after all"""
+        with self._lock:
+            self._trial = False
+
+    def after_call(self, failed):
+        """Records the outcome of a call let through by `before_call`"""
+        with self._lock:
+            self._trial = False
+            if not failed:
+                self.failures, self.opened_at = 0, None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.failure_threshold:
+                    self.opened_at = self.timer()
+            CIRCUIT_OPEN.set(int(self.opened_at is not None))
+
+class Guard(object):
+    """Runs calls to the Database Service through a circuit breaker and a limiter.
+
+    Parameters
+    ----------
+    limiter : AdaptiveLimiter
+    breaker : CircuitBreaker
+    is_failure : callable, optional
+        Tells whether an exception raised by a call is a failure of the Database
+        Service, e.g. not a rejected query. All exceptions are by default.
+    """
+
+    def __init__(self, limiter, breaker, is_failure=lambda error: True):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.is_failure = is_failure
+
+    def call(self, func):
+        """Calls `func` if neither the breaker nor the limiter turn it away.
+
+        Raises
+        ------
+        Overloaded
+            If the call was turned away.
+        """
+        self.breaker.before_call()
+        try:
+            self.limiter.acquire()
+        except Overloaded:
+            self.breaker.cancel_call()
+            raise
+
+        started, failed = time.monotonic(), True
+        try:
+            result = func()
+            failed = False
+            return result
+        except Exception as error:
+            failed = self.is_failure(error)
+            raise
+        finally:
+            self.limiter.release(time.monotonic() - started, failed)
+            self.breaker.after_call(failed)
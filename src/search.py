@@ -0,0 +1,229 @@
+"""Search module
+
+This module provides an in-process inverted index over the authors and titles
+of the catalog, to answer the search box queries without a regex scan of the
+database. The index is rebuilt from the database service in the background.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import copy
+import logging
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+
+from .concurrency import run_periodically
+from .db_utils import NOT_DELETED, db_fetch
+
+# fields of the books the index is built from
+INDEX_FIELDS = {"id": 1, "metadata.title": 1, "metadata.author": 1}
+
+# weight of a query token matching a whole token or a prefix of a token, by field
+WEIGHTS = {("title", True): 4, ("title", False): 2, ("author", True): 3, ("author", False): 1}
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(text):
+    """Splits text into lowercase tokens without diacritics.
+
+    >>> tokenize("Ender's Game, by Orson Scott Card")
+    ['ender', 's', 'game', 'by', 'orson', 'scott', 'card']
+    >>> tokenize("Stanisław Lem: Solaris")
+    ['stanisław', 'lem', 'solaris']
+    """
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return [token for token in re.split(r"\W+", stripped.casefold()) if token]
+
+def _book_tokens(book):
+    """Fields of a book object every token of its author and title is in"""
+    tokens = {}
+    for field in ("title", "author"):
+        for token in tokenize(book["metadata"].get(field)):
+            tokens.setdefault(token, set()).add(field)
+    return tokens
+
+class SearchIndex(object):
+    """Inverted index of the `metadata.author` and `metadata.title` of books.
+
+    Parameters
+    ----------
+    books : iterable of dict
+        Book objects, as returned by the database service.
+    """
+
+    def __init__(self, books):
+        self.ids = []
+        self._titles = []
+        self._authors = []
+        self._postings = {} # token -> {row: {"title", "author"}}
+        self._rows = {}
+        self._removed = frozenset() # rows of removed books
+
+        for row, book in enumerate(books):
+            self.ids.append(book["id"])
+            self._rows[book["id"]] = row
+            self._titles.append(book["metadata"].get("title") or "")
+            self._authors.append(book["metadata"].get("author") or "")
+            for token, fields in _book_tokens(book).items():
+                self._postings.setdefault(token, {})[row] = fields
+
+        self._tokens = sorted(self._postings)
+
+    def __len__(self):
+        return len(self.ids) - len(self._removed)
+
+    def books(self):
+        """Minimal book objects the index was built from, without the removed ones"""
+        return [{"id": book_id, "metadata": {"title": title, "author": author}}
+                for row, (book_id, title, author) in
+                enumerate(zip(self.ids, self._titles, self._authors))
+                if row not in self._removed]
+
+    def updated(self, books, removed=()):
+        """Returns a copy of the index with changed books.
+
+        Only the postings of the tokens of the changed books are copied, the
+        rest is shared. The index itself is left untouched, so requests using
+        it meanwhile aren't affected, and the copy can be swapped in at once.
+
+        Parameters
+        ----------
+        books : iterable of dict
+            Added or updated book objects.
+        removed : iterable of str
+            IDs of the books to remove.
+
+        Returns
+        -------
+        SearchIndex
+        """
+        index = copy.copy(self)
+        index.ids, index._titles, index._authors = list(self.ids), list(self._titles), \
+            list(self._authors)
+        index._rows, index._postings = dict(self._rows), dict(self._postings)
+        removed_rows = set(self._removed)
+
+        def unindex(row):
+            old = {"metadata": {"title": index._titles[row], "author": index._authors[row]}}
+            for token in _book_tokens(old):
+                postings = {r: f for r, f in index._postings[token].items() if r != row}
+                if postings:
+                    index._postings[token] = postings
+                else:
+                    del index._postings[token]
+
+        for book_id in removed:
+            if book_id in index._rows and index._rows[book_id] not in removed_rows:
+                unindex(index._rows[book_id])
+                removed_rows.add(index._rows[book_id])
+
+        for book in books:
+            row = index._rows.get(book["id"])
+            if row is None:
+                row = index._rows[book["id"]] = len(index.ids)
+                index.ids.append(book["id"])
+                index._titles.append("")
+                index._authors.append("")
+            elif row not in removed_rows:
+                unindex(row)
+            removed_rows.discard(row)
+
+            index._titles[row] = book["metadata"].get("title") or ""
+            index._authors[row] = book["metadata"].get("author") or ""
+            for token, fields in _book_tokens(book).items():
+                index._postings[token] = {**index._postings.get(token, {}), row: fields}
+
+        index._removed = frozenset(removed_rows)
+        index._tokens = sorted(index._postings)
+        return index
+
+    def _match(self, query_token):
+        """Scores of the books having a token starting with `query_token`"""
+        scores = {}
+        start = bisect_left(self._tokens, query_token)
+        for token in self._tokens[start:bisect_left(self._tokens, query_token + "\uffff")]:
+            for row, fields in self._postings[token].items():
+                score = max(WEIGHTS[(field, token == query_token)] for field in fields)
+                scores[row] = max(scores.get(row, 0), score)
+
+        return scores
+
+    def search(self, query, limit):
+        """Finds books whose author or title has tokens starting with every query token.
+
+        Parameters
+        ----------
+        query : str
+        limit : int
+            Maximum number of books to return.
+
+        Returns
+        -------
+        list of str
+            IDs of the matching books, best first. Whole-token matches rank above
+            prefix matches, and title matches above author matches.
+        """
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            if not self._removed:
+                return self.ids[:limit]
+            return [book_id for row, book_id in enumerate(self.ids)
+                    if row not in self._removed][:limit]
+
+        scores = None
+        for query_token in set(query_tokens):
+            matches = self._match(query_token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {row: score + matches[row] for row, score in scores.items()
+                          if row in matches}
+            if not scores:
+                return []
+
+        ranked = sorted(scores, key=lambda row: (-scores[row], self._titles[row], row))
+        return [self.ids[row] for row in ranked[:limit]]
+
+_INDEX = {}
+_INDEX_LOCK = threading.Lock()
+_REFRESHING = set() # addresses whose index is rebuilt in the background
+
+def refresh_search_index(addr):
+    """Rebuilds the search index from the database service at `addr` and swaps
+    it in, requests keep being answered by the previous index meanwhile."""
+    books = db_fetch(addr, NOT_DELETED, INDEX_FIELDS)["resp"]
+    _INDEX[addr] = SearchIndex(books)
+    logger.info("Search index of %d books built", len(books))
+
+def peek_search_index(addr):
+    """Returns the search index of the database service at `addr`, if it was
+    built, without starting to build it as `get_search_index` does."""
+    return _INDEX.get(addr)
+
+def swap_search_index(addr, index):
+    """Replaces the search index of the database service at `addr`,
+    e.g. by an `updated` copy"""
+    _INDEX[addr] = index
+
+def get_search_index(addr, refresh_interval):
+    """Returns the search index of the database service at `addr`.
+
+    The first call starts rebuilding the index every `refresh_interval` seconds
+    in the background, None is returned until the first build completes. An
+    index loaded from a snapshot, see `src.snapshot`, is rebuilt a first time
+    only after `refresh_interval` seconds.
+    """
+    if addr not in _REFRESHING:
+        with _INDEX_LOCK:
+            if addr not in _REFRESHING:
+                _REFRESHING.add(addr)
+                delay = 0 if _INDEX.get(addr) is None else refresh_interval
+                _INDEX.setdefault(addr, None)
+                run_periodically(lambda: refresh_search_index(addr), refresh_interval, delay)
+
+    return _INDEX[addr]
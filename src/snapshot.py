@@ -0,0 +1,183 @@
+"""Snapshot module
+
+This module saves the hot state of a worker process, the cached book objects
+and recommendations and the search index, to a compressed binary file, and
+loads it back in a new process, so that a restarted service starts warm
+instead of sending the whole catalog and every popular request to the
+Database Service at once. Under gunicorn the snapshot is loaded by the master
+process before it forks the workers, see `gunicorn.conf.py`, which share the
+loaded objects copy-on-write.
+
+A snapshot is ignored rather than served when it was written in another
+format, for another Database Service, for another build of the feature store,
+or more than `max_age` seconds ago.
+"""
+
+# Author: Alexandru Burlacu
+# Email:  alexandru-varacuta@bookvoyager.org
+
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from . import features, search
+from .cache import get_cache
+from .concurrency import run_periodically
+
+logger = logging.getLogger(__name__)
+
+MAGIC = "bv-snapshot"
+FORMAT_VERSION = 2
+
+# caches saved in a snapshot, with the function restoring their values from JSON
+CACHES = {
+    "books": lambda value: value,
+    "recommendations": lambda value: (value[0], value[1], tuple(value[2]))
+}
+
+
+def _to_array(obj):
+    return np.frombuffer(json.dumps(obj).encode("utf-8"), dtype=np.uint8)
+
+def _from_array(array):
+    return json.loads(array.tobytes().decode("utf-8"))
+
+def _header(addr):
+    store = features.get_feature_store()
+    return {"magic": MAGIC, "version": FORMAT_VERSION, "addr": addr,
+            "watermark": store.watermark if store is not None else None}
+
+def save_snapshot(path, addr):
+    """Saves the caches and the search index of this process to `path`.
+
+    The file is replaced atomically, a process loading it never sees it half
+    written.
+
+    Parameters
+    ----------
+    path : str
+    addr : str
+        Address of the Database Service the state comes from.
+
+    Returns
+    -------
+    dict
+        Number of saved entries by part of the snapshot, nothing is saved if
+        they are all 0.
+    """
+    now = time.time()
+    arrays, counts = {}, {}
+    for name in CACHES:
+        entries = [[list(key), value, now + expires_in]
+                   for key, value, expires_in in get_cache(name).items()]
+        arrays[name], counts[name] = _to_array(entries), len(entries)
+
+    index = search.peek_search_index(addr)
+    books = index.books() if index is not None else None
+    arrays["search_index"] = _to_array(books)
+    counts["search_index"] = len(books) if books is not None else 0
+    arrays["header"] = _to_array({**_header(addr), "created_at": now})
+    if not any(counts.values()):
+        return counts
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid()) # the workers save the same snapshot
+    with open(tmp_path, "wb") as snapshot_ptr:
+        np.savez_compressed(snapshot_ptr, **arrays)
+    os.replace(tmp_path, path)
+    return counts
+
+def _check_header(header, addr, max_age):
+    """Reason why a snapshot with `header` can't be loaded, or None"""
+    expected = _header(addr)
+    if header.get("magic") != MAGIC or header.get("version") != FORMAT_VERSION:
+        return "format {} is not supported".format(header.get("version"))
+    if header["addr"] != expected["addr"]:
+        return "it was taken from another Database Service, {}".format(header["addr"])
+    if header["watermark"] != expected["watermark"]:
+        return "the feature store was rebuilt since"
+    if time.time() - header["created_at"] > max_age:
+        return "it is older than {} seconds".format(max_age)
+    return None
+
+def load_snapshot(path, addr, max_age):
+    """Loads the caches and the search index saved at `path` into this process.
+
+    Cache entries keep their expiry, the ones past their stale period are
+    skipped. Nothing is loaded if the snapshot can't be read or is stale.
+
+    Parameters
+    ----------
+    path : str
+    addr : str
+        Address of the Database Service of this process.
+    max_age : float
+        Snapshots taken longer ago, in seconds, are ignored.
+
+    Returns
+    -------
+    dict or None
+        Number of loaded entries by part of the snapshot, None if it was ignored.
+    """
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            header = _from_array(arrays["header"])
+            reason = _check_header(header, addr, max_age)
+            if reason is not None:
+                logger.warning("Ignored the snapshot %s, %s", path, reason)
+                return None
+            parts = {name: _from_array(arrays[name]) for name in [*CACHES, "search_index"]}
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+        logger.warning("Ignored the unreadable snapshot %s: %s", path, error)
+        return None
+
+    now, counts = time.time(), {}
+    for name, restore in CACHES.items():
+        cache, count = get_cache(name), 0
+        for key, value, expires_at in parts[name]:
+            if expires_at - now > -cache.stale_ttl:
+                cache.set(tuple(key), restore(value), ttl=expires_at - now)
+                count += 1
+        counts[name] = count
+
+    books = parts["search_index"]
+    if books is not None and search.peek_search_index(addr) is None:
+        search.swap_search_index(addr, search.SearchIndex(books))
+    counts["search_index"] = len(books) if books is not None else 0
+
+    logger.info("Loaded the snapshot %s taken %.0f seconds ago: %s",
+                path, now - header["created_at"], counts)
+    return counts
+
+_LOADED = {}
+_LOADED_LOCK = threading.Lock()
+
+def warm_start(config):
+    """Loads the snapshot configured by the `snapshot` section of `config` once
+    per process, a process forked after loading it doesn't load it again.
+
+    Returns
+    -------
+    dict or None
+        See `load_snapshot`.
+    """
+    with _LOADED_LOCK:
+        if "counts" not in _LOADED:
+            _LOADED["counts"] = load_snapshot(config["snapshot"]["path"],
+                                              config["mongo_rest_interface_addr"],
+                                              config["snapshot"]["max_age"])
+        return _LOADED["counts"]
+
+def start_snapshots(config):
+    """Saves the snapshot configured by the `snapshot` section of `config` every
+    `save_interval` seconds in the background, the first time after one interval"""
+    path, addr = config["snapshot"]["path"], config["mongo_rest_interface_addr"]
+    interval = config["snapshot"]["save_interval"]
+    return run_periodically(lambda: save_snapshot(path, addr), interval, interval)
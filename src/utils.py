@@ -6,10 +6,16 @@ This module provides utility functions.
 # Author: Alexandru Burlacu
 # Email:  alexandru-varacuta@bookvoyager.org
 
+import base64
+import binascii
+import heapq
 import json
 import os
+import re
 
+from .cache import get_cache
 from .db_utils import get_book_by
+from .metrics import stage
 
 PATH = os.path.abspath(os.path.dirname(__file__))
 
@@ -75,59 +81,165 @@ def make_query(obj):
         ]
     }
 
+# regex of `make_query` for an author given as plain text, without escapes, classes or groups
+_AUTHOR_REGEX = re.compile(r"\((?P<author>[^\\\[\](){}?]*)\)\\w\*")
+
+def _canonical_query(query):
+    """Rewrites equivalent MongoDB-style queries to the same form, namely the
+    author of case-insensitive author regexes of `make_query` is lowercased.
+    Other regexes are kept as they are, e.g. lowercasing `\\W` would turn it to `\\w`."""
+    if isinstance(query, list):
+        return [_canonical_query(q) for q in query]
+    if not isinstance(query, dict):
+        return query
+    if "i" in query.get("$options", "") and "$regex" in query:
+        match = _AUTHOR_REGEX.fullmatch(query["$regex"])
+        if match is not None:
+            return {**query, "$regex": r"({})\w*".format(match.group("author").lower())}
+        return query
+
+    return {k: _canonical_query(v) for k, v in query.items()}
+
+def recommendation_key(book_id, query, top_n=5, mode="exact", nprobe=None, window=None):
+    """Key of a recommendation in the `recommendations` cache.
+
+    Parameters
+    ----------
+    book_id : str
+    query : dict
+        Output of `make_query`. It only keeps the filters used for searching,
+        so UI-only fields such as `metadata.*.label` don't change the key.
+    top_n : int, optional
+    mode : str, optional
+    nprobe : int, optional
+    window : int, optional
+
+    Returns
+    -------
+    (str, str, int, str, int, int)
+    """
+    return book_id, json.dumps(_canonical_query(query), sort_keys=True), top_n, mode, nprobe, \
+        window
+
+def make_projection(fields):
+    """Builds the projection of a comma-separated list of dotted paths, e.g.
+    `"metadata,sentiment.overall"`, to fetch only these fields of the books.
+
+    Parameters
+    ----------
+    fields : str
+
+    Returns
+    -------
+    dict
+        An inclusion projection, with `id` always included.
+
+    Raises
+    ------
+    ValueError
+        If a path is not made of field names.
+    """
+    paths = [path.strip() for path in fields.split(",") if path.strip()]
+    for path in paths:
+        if not re.fullmatch(r"[A-Za-z_]\w*(\.[A-Za-z_]\w*)*", path):
+            raise ValueError("Invalid field '{}'".format(path))
+
+    return {"id": 1, **{path: 1 for path in paths}}
+
+def encode_cursor(position):
+    """Encodes the position of the next page of a paginated response, a dict,
+    as an opaque URL-safe cursor"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Decodes a cursor of `encode_cursor`, raises ValueError if it is invalid"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
+
+def invalidate_recommendations(book_ids):
+    """Drops all cached recommendations for or of the books `book_ids`, in a single
+    pass over the cache. The recommended IDs are cached along with the response."""
+    book_ids = frozenset(book_ids)
+    get_cache("recommendations").invalidate_items_where(
+        lambda key, value: key[0] in book_ids or not book_ids.isdisjoint(value[2]))
+
 def _get_full_objs_decorator(func):
-    """Adds the full object about given title. Fetches it from DB.
+    """Adds the full object about given title.
     Also, the decorator enriches the `sentiment.overall` field of the top matching titles
     with the base title's `sentiment.overall` list of objects.
 
-    From [{"score": float, "title": str}]
+    The full objects are looked up by ID in the `docs` keyword argument, usually
+    the base book and the matches the scores were computed from. Whatever is not
+    there is fetched from DB in a single request. The base book is the one with the
+    `base_id` keyword argument, it isn't recommended to itself.
+
+    From [{"score": float, "title": str, "id": str}]
     To   [{"score": float, "title": obj] where obj is similart
     to the response from "/api/v1/books/<book_id>" endpoit but with the `sentiment.overall` field
     now containing 2 items, on index 0 the base book's object and on index 1 the current's one.
     """
     addr = get_config()["mongo_rest_interface_addr"]
-    get_obj = lambda t: json.loads(preprocess_resp(get_book_by("author_or_title", addr, t)))[0]
     get_overall_sentiment = lambda o: o["sentiment"]["overall"][0]
 
-    def __inner(base_title, scores, *args, **kwargs):
-        resp = func(base_title, scores, *args, **kwargs)
-        head_obj, *tail_objs = resp["resp"]
-
-        base_obj = get_obj(head_obj["title"])
-
-        for kvs in tail_objs:
-            kvs["title"] = get_obj(kvs["title"])
-
+    def __inner(base_title, scores, *args, base_id, docs=(), **kwargs):
+        with stage("sort"):
+            resp = func(base_title, scores, *args, base_id=base_id, **kwargs)
+        with stage("enrich"):
+            return _enrich(resp, base_id, docs)
+
+    def _enrich(resp, base_id, docs):
+        if not resp["resp"]:
+            return []
+
+        objs = {obj["id"]: obj for obj in docs}
+        missing = [book_id for book_id in [base_id] + [kvs["id"] for kvs in resp["resp"]]
+                   if book_id not in objs]
+        if missing:
+            objs.update((obj["id"], obj)
+                        for obj in get_book_by("ids", addr, missing)["resp"])
+
+        base_obj = objs.get(base_id)
+        if base_obj is None: # removed from DB since it was scored
+            return []
+
+        top_matches = []
+        for kvs in resp["resp"]:
+            obj = objs.get(kvs.pop("id"))
+            if obj is None: # removed from DB since it was scored
+                continue
+
+            # copy, `docs` may be shared with the caller
+            kvs["title"] = dict(obj, sentiment=dict(obj["sentiment"]))
             kvs["title"]["sentiment"]["overall"] = [get_overall_sentiment(base_obj),
-                                                    get_overall_sentiment(kvs["title"])]
-        _, *top_matches = resp["resp"]
+                                                    get_overall_sentiment(obj)]
+            top_matches.append(kvs)
         return top_matches
     return __inner
 
 @_get_full_objs_decorator
-def get_sorted(base_title, scores, top_n=5):
-    """Sorts the respond body and reshapes it before sending over the network"""
-    return {"resp": list(sorted(scores[base_title],
-                                key=lambda x: x["score"], reverse=True))[:top_n + 1]}
+def get_sorted(base_title, scores, top_n=5, base_id=None):
+    """Sorts the respond body and reshapes it before sending over the network,
+    the base book `base_id` is left out of it"""
+    return {"resp": heapq.nlargest(top_n, (entry for entry in scores[base_title]
+                                           if entry["id"] != base_id),
+                                   key=lambda x: x["score"])}
 
 def preprocess_resp(raw_resp):
-    """Transform the sentiment timeline dict of the response body.
+    """Extract the books of a response fetched from database.
 
     Parameters
     ----------
     raw_resp : dict of {"resp": [dict]}
-        The response dictionary fetched, and optionaly preprocessed, from database.
+        The response dictionary fetched from database.
 
     Returns
     -------
-    resp : list
-        List with dictionaries with modified structure of the value under
-        the `timeline` key of the `sentiment` dictionary
+    resp : list of dict
+        The books, ready to be encoded in the response body.
     """
-    resp = json.loads(raw_resp)["resp"]
-
-    timelines = (r["sentiment"]["timeline"] for r in resp)
-    [r["sentiment"].update({"timeline": list(timeline)}) # [WARNING] change in-place
-     for r, timeline in zip(resp, timelines)]
-
-    return json.dumps(resp)
+    return raw_resp["resp"]
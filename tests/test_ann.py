@@ -0,0 +1,87 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import src.ann as M
+from src.features import build_feature_store, FeatureStore
+from src.logic import EMOTIONS, get_candidates
+
+def make_book(book_id, n_events, max_index, seed):
+    rnd = random.Random(seed)
+    timeline = [[1, rnd.choice(EMOTIONS[:3 + seed % 4]), "tok", rnd.randrange(max_index)]
+                for _ in range(n_events)]
+    return {"id": book_id, "metadata": {"title": "title " + book_id},
+            "sentiment": {"timeline": timeline}}
+
+class TestAnnModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.books = [make_book("b%d" % i, 30 + i, 500 + 37 * i, i) for i in range(64)]
+        build_feature_store(os.path.join(self.tmp, "features"), self.books)
+        self.store = FeatureStore(os.path.join(self.tmp, "features"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_full_probe_matches_exact_scores(self):
+        M.build_ann_index(os.path.join(self.tmp, "ann"), self.store, n_lists=8)
+        index = M.AnnIndex(os.path.join(self.tmp, "ann"))
+        self.assertEqual((len(index), index.n_lists), (64, 8))
+
+        base = self.books[5]
+        exact = sorted(((c["score"], c["id"]) for c in get_candidates(base, self.books)[
+            "title b5"]), reverse=True)[:10]
+        hits = index.search(index.vector("b5"), 10, nprobe=8)
+        self.assertEqual([book_id for book_id, _ in hits], [book_id for _, book_id in exact])
+        for (_, score), (expected, _) in zip(hits, exact):
+            self.assertAlmostEqual(score, expected, places=5)
+
+    def test_partial_probe(self):
+        M.build_ann_index(os.path.join(self.tmp, "ann"), self.store, n_lists=8)
+        index = M.AnnIndex(os.path.join(self.tmp, "ann"))
+        hits = index.search(index.vector("b5"), 3, nprobe=1)
+        self.assertEqual(hits[0][0], "b5")
+        self.assertLessEqual(len(hits), 3)
+
+    def test_updated(self):
+        M.build_ann_index(os.path.join(self.tmp, "ann"), self.store, n_lists=8)
+        index = M.AnnIndex(os.path.join(self.tmp, "ann"))
+        updated = index.updated({"b7": index.vector("b5"), "new": index.vector("b5")},
+                                removed=["b5"])
+        self.assertNotIn("b5", updated)
+        self.assertIn("new", updated)
+        self.assertRaises(KeyError, lambda: updated.vector("b5"))
+
+        hits = updated.search(index.vector("b5"), 3, nprobe=1)
+        self.assertEqual(sorted(book_id for book_id, _ in hits[:2]), ["b7", "new"])
+        self.assertAlmostEqual(hits[0][1], index.search(index.vector("b5"), 1, nprobe=1)[0][1],
+                               places=5)
+        self.assertNotIn("b5", [book_id for book_id, _ in updated.search(
+            index.vector("b5"), 64, nprobe=8)])
+        self.assertEqual(index.search(index.vector("b5"), 1, nprobe=1)[0][0], "b5")
+
+    def test_changed_books_join_their_cluster(self):
+        M.build_ann_index(os.path.join(self.tmp, "ann"), self.store, n_lists=8)
+        index = M.AnnIndex(os.path.join(self.tmp, "ann"))
+        far = index.vector("b5") * -1
+        updated = index.updated({"new": index.vector("b5"), "far": far}, removed=["b9"])
+        self.assertNotIn("far", [book_id for book_id, _ in updated.search(
+            index.vector("b5"), 64, nprobe=1)])
+
+        compacted = updated.compacted()
+        self.assertEqual((len(compacted), compacted.n_changed, updated.n_changed), (65, 0, 3))
+        self.assertNotIn("b9", compacted)
+        ids = lambda hits: sorted(book_id for book_id, _ in hits)
+        for k, nprobe in [(64, 8), (10, 2)]:
+            self.assertEqual(ids(compacted.search(index.vector("b5"), k, nprobe)),
+                             ids(updated.search(index.vector("b5"), k, nprobe)))
+
+    def test_unit_vectors(self):
+        tensor = np.zeros((1, 6, 100))
+        tensor[0, 2, :4] = [3, 0, 4, 0]
+        vectors = M.unit_vectors(tensor)
+        self.assertEqual(vectors.shape, (1, 600))
+        self.assertAlmostEqual(float(vectors[0] @ vectors[0]), 1.0, places=6)
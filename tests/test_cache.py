@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+import src.cache as M
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+class TestCacheModule(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = M.TTLCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_set(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("b", "default"), "default")
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "size": 1, "maxsize": 2})
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_ttl(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=100)
+        self.timer.now = 10
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("b"), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_get_stale(self):
+        cache = M.TTLCache(ttl=10, stale_ttl=5, timer=self.timer)
+        cache.set("a", 1)
+        self.timer.now = 12
+        self.assertEqual((cache.get("a"), cache.get_stale("a")), (None, 1))
+        self.timer.now = 15
+        self.assertEqual((cache.get_stale("a", "default"), len(cache)), ("default", 0))
+        self.assertEqual(self.cache.get_stale("missing"), None)
+
+    def test_invalidate(self):
+        self.cache.set(("x", 1), 1)
+        self.cache.set(("y", 2), 2)
+        self.cache.invalidate(("x", 1))
+        self.assertEqual(len(self.cache), 1)
+        self.cache.invalidate_where(lambda k: k[0] == "y")
+        self.assertEqual(len(self.cache), 0)
+        self.cache.set("a", "[1]")
+        self.cache.set("b", "[2]")
+        self.cache.invalidate_items_where(lambda k, v: "2" in v)
+        self.assertEqual((self.cache.get("a"), self.cache.get("b")), ("[1]", None))
+
+    def test_cached(self):
+        calls = []
+        @M.cached("test_cached", key=lambda x: x)
+        def double(x):
+            calls.append(x)
+            return x * 2
+        self.assertEqual([double(1), double(1), double(2)], [2, 2, 4])
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(M.get_cache("test_cached").stats()["hits"], 1)
+
+    def test_cached_cacheable(self):
+        calls = []
+        @M.cached("test_cached_cacheable", key=lambda x: x, cacheable=bool)
+        def halve(x):
+            calls.append(x)
+            return x // 2
+        self.assertEqual([halve(1), halve(1), halve(4), halve(4)], [0, 0, 2, 2])
+        self.assertEqual(calls, [1, 1, 4])
+
+    def test_cached_single_flight(self):
+        calls, results = [], []
+        @M.cached("test_cached_single_flight", key=lambda x: x, single_flight=True)
+        def slow_double(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * 2
+        threads = [threading.Thread(target=lambda: results.append(slow_double(1)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [2, 2, 2])
+        self.assertEqual((calls, slow_double(1)), ([1], 2))
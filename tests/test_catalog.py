@@ -0,0 +1,32 @@
+import unittest
+import src.catalog as M
+from src.logic import get_candidates, get_max_len, reshape_transform
+from src.utils import make_query
+
+class TestCatalogModule(unittest.TestCase):
+
+    def test_generate_catalog_is_deterministic(self):
+        self.assertEqual(M.generate_catalog(5, median_events=50, seed=3),
+                         M.generate_catalog(5, median_events=50, seed=3))
+        self.assertNotEqual(M.generate_catalog(5, median_events=50, seed=3),
+                            M.generate_catalog(5, median_events=50, seed=4))
+
+    def test_timelines_are_chronological(self):
+        for book in M.generate_catalog(10, median_events=50):
+            indices = [event[3] for event in book["sentiment"]["timeline"]]
+            self.assertEqual(indices, sorted(set(indices)))
+            timeline = reshape_transform(book["sentiment"]["timeline"])
+            self.assertEqual(get_max_len([timeline]), indices[-1])
+
+    def test_books_can_be_scored(self):
+        books = M.generate_catalog(20, median_events=50)
+        scores = get_candidates(books[0], books)[books[0]["metadata"]["title"]]
+        self.assertEqual(len(scores), 20)
+        emotions = reshape_transform(books[0]["sentiment"]["timeline"]).values()
+        self.assertAlmostEqual(scores[0]["score"], sum(1 for events in emotions if events))
+
+    def test_make_filters(self):
+        filters = M.make_filters(author="Ursula Le Guin", characters=("dragons",))
+        query = make_query(filters)
+        self.assertEqual(query["$or"][0]["metadata.author"]["$regex"], r"(Ursula Le Guin)\w*")
+        self.assertEqual(query["$or"][1]["genre.characters.labels.dragons"], 1)
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+import src.changes as M
+from src import ann, features, search
+from src.cache import get_cache
+from src.catalog import generate_catalog
+from src.db_utils import db_fetch, get_book_by, not_deleted, search_page_by_auth_or_title
+from src.local_db import LocalDatabase, serve_in_background
+from src.utils import recommendation_key
+
+class TestChangesModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.books = generate_catalog(12, median_events=20)
+        for i, book in enumerate(self.books):
+            book["updated_at"] = i
+
+        self.db = LocalDatabase(self.books)
+        self.server = serve_in_background(self.db, port=0)
+        self.addr = "http://127.0.0.1:%d" % self.server.server_port
+
+        features.build_feature_store(os.path.join(self.tmp, "features"), self.books,
+                                     watermark=M.latest_change(self.books, "updated_at"))
+        features.swap_feature_store(features.FeatureStore(os.path.join(self.tmp, "features")))
+        ann.build_ann_index(os.path.join(self.tmp, "ann"), features.get_feature_store(), n_lists=2)
+        ann.swap_ann_index(ann.AnnIndex(os.path.join(self.tmp, "ann")))
+        search.swap_search_index(self.addr, search.SearchIndex(self.books))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        features._STORE.clear()
+        ann._INDEX.clear()
+        search._INDEX.pop(self.addr, None)
+        shutil.rmtree(self.tmp)
+
+    def test_latest_change(self):
+        self.assertEqual(M.latest_change(self.books, "updated_at"), 11)
+        self.assertEqual(M.latest_change([{"id": "x"}], "updated_at"), None)
+
+    def test_poll(self):
+        store = features.get_feature_store()
+        feed = M.ChangeFeed(self.addr, "updated_at", store.watermark, batch_size=2)
+        self.assertEqual(feed.poll(), 1) # the book changed at the watermark, applied again
+        self.assertEqual(feed.poll(), 0)
+
+        cache = get_cache("recommendations")
+        cache.set(recommendation_key("other", {}),
+                  ('[{"id": "syn000003"}]', "exact", ("syn000003",)))
+        cache.set(recommendation_key("kept", {}),
+                  ('[{"id": "syn000004"}]', "exact", ("syn000004",)))
+
+        added = generate_catalog(13, median_events=20, seed=1)[12]
+        added["metadata"]["title"] = "Zyzzyva"
+        self.db.put({**added, "updated_at": 12})
+        self.db.put({**self.books[2], "updated_at": 13, "metadata": {"title": "Renamed"}})
+        self.db.put({"id": self.books[3]["id"], "updated_at": 14, "deleted": True})
+
+        self.assertEqual(feed.poll(), 3)
+        self.assertEqual(feed.watermark, 14)
+
+        store = features.get_feature_store()
+        self.assertIn(added["id"], store)
+        self.assertNotIn(self.books[3]["id"], store)
+        self.assertEqual(len(store.timeline(added["id"])), len(added["sentiment"]["timeline"]))
+        self.assertNotIn(self.books[3]["id"], ann.get_ann_index())
+
+        index = search.peek_search_index(self.addr)
+        self.assertEqual(index.search("zyzzyva", 10), [added["id"]])
+        self.assertEqual(index.search("renamed", 10), [self.books[2]["id"]])
+        self.assertEqual(len(index), 12)
+
+        self.assertEqual(cache.get(recommendation_key("other", {})), None)
+        self.assertEqual(cache.get(recommendation_key("kept", {}))[1], "exact")
+        self.assertEqual(feed.poll(), 0)
+
+    def test_poll_compacts_changes(self):
+        feed = M.ChangeFeed(self.addr, "updated_at", 11, batch_size=2, compact_ratio=0.2)
+        feed.poll()
+        for i in range(5):
+            self.db.put({**self.books[i], "updated_at": 12 + i})
+        self.assertEqual(feed.poll(), 5)
+        self.assertEqual(feed.watermark, 16)
+
+        store, index = features.get_feature_store(), ann.get_ann_index()
+        self.assertLess(store.n_changed, 3)
+        self.assertLess(index.n_changed, 3)
+        self.assertEqual(len(store), 12)
+        self.assertEqual(len(store.timeline(self.books[0]["id"])),
+                         len(self.books[0]["sentiment"]["timeline"]))
+
+    def test_poll_same_time_and_missing_field(self):
+        feed = M.ChangeFeed(self.addr, "updated_at", 11)
+        feed.poll()
+        self.db.put({**self.books[4], "updated_at": 12})
+        self.assertEqual(feed.poll(), 1)
+
+        # written after the last poll, with the same time as the watermark
+        self.db.put({**self.books[5], "updated_at": 12, "metadata": {"title": "Late"}})
+        self.db.put({"id": "no-time", "metadata": {"title": "Untimed"}})
+        self.assertEqual(feed.poll(), 1)
+        self.assertEqual(search.peek_search_index(self.addr).search("late", 10),
+                         [self.books[5]["id"]])
+        self.assertEqual((feed.poll(), feed.watermark), (0, 12))
+
+    def test_deleted_books_are_not_served(self):
+        feed = M.ChangeFeed(self.addr, "updated_at", 11)
+        feed.poll()
+        removed = self.books[3]
+        self.assertEqual(len(get_book_by("id", self.addr, removed["id"])["resp"]), 1)
+
+        self.db.put({**removed, "updated_at": 12, "deleted": True})
+        self.assertEqual(feed.poll(), 1)
+
+        self.assertEqual(get_book_by("id", self.addr, removed["id"])["resp"], [])
+        self.assertEqual(get_book_by("ids", self.addr, [removed["id"]])["resp"], [])
+        candidates = db_fetch(self.addr, not_deleted({}), {"id": 1})["resp"]
+        self.assertEqual(len(candidates), 11)
+        self.assertNotIn(removed["id"], [book["id"] for book in candidates])
+        title = removed["metadata"]["title"]
+        found = search_page_by_auth_or_title(self.addr, title, 20)["resp"]
+        self.assertNotIn(removed["id"], [book["id"] for book in found])
+
+        search.refresh_search_index(self.addr)
+        self.assertEqual(len(search.peek_search_index(self.addr)), 11)
+        self.assertNotIn(removed["id"], search.peek_search_index(self.addr).search(title, 20))
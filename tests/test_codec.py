@@ -0,0 +1,18 @@
+import unittest
+import src.codec as M
+
+class TestCodecModule(unittest.TestCase):
+
+    def test_json_codec(self):
+        codec = M.make_codec("json")
+        self.assertEqual(codec.name, "json")
+        self.assertEqual(codec.loads(codec.dumps({"a": [1, "ş"]})), {"a": [1, "ş"]})
+        self.assertEqual(codec.loads(b'{"a": 1}'), {"a": 1})
+
+    def test_auto_codec(self):
+        codec = M.make_codec()
+        self.assertIn(codec.name, M.CODECS)
+        self.assertIsInstance(codec.dumps([1.5, None]), str)
+
+    def test_unknown_codec(self):
+        self.assertRaises(KeyError, lambda: M.make_codec("yaml"))
@@ -0,0 +1,94 @@
+import time
+import unittest
+from unittest import mock
+import gevent
+import src.concurrency as M
+
+def fail():
+    raise ValueError("failed")
+
+class TestConcurrencyModule(unittest.TestCase):
+
+    def test_run_threads(self):
+        start = time.monotonic()
+        calls = [lambda i=i: time.sleep(0.1) or i for i in range(4)]
+        self.assertEqual(M.run_concurrently(calls, timeout=5), [0, 1, 2, 3])
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_run_threads_error(self):
+        self.assertRaises(ValueError, lambda: M.run_concurrently([lambda: 1, fail], timeout=5))
+
+    def test_run_threads_deadline(self):
+        self.assertRaises(M.DeadlineExceeded,
+                          lambda: M.run_concurrently([lambda: time.sleep(0.5)], timeout=0.05))
+
+    def test_run_greenlets(self):
+        start = time.monotonic()
+        calls = [lambda i=i: gevent.sleep(0.1) or i for i in range(4)]
+        self.assertEqual(M._run_greenlets(calls, timeout=5), [0, 1, 2, 3])
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_run_greenlets_error_and_deadline(self):
+        slow = []
+        calls = [lambda: gevent.sleep(5) or slow.append(1), fail]
+        self.assertRaises(ValueError, lambda: M._run_greenlets(calls, timeout=5))
+        self.assertRaises(M.DeadlineExceeded,
+                          lambda: M._run_greenlets([lambda: gevent.sleep(5)], timeout=0.05))
+        gevent.sleep(0)
+        self.assertEqual(slow, [])
+
+    def test_run_in_processes(self):
+        self.assertEqual(M.run_in_processes(pow, [(2, 3), (3, 2)], workers=1, timeout=60), [8, 9])
+        self.assertRaises(ValueError, lambda: M.run_in_processes(int, [("x",)], workers=1))
+        self.assertIs(M.get_process_pool(1), M.get_process_pool(1))
+
+    def test_run_in_processes_without_pool(self):
+        pool = M._PROCESS_POOL.pop("pool", None)
+        try:
+            with mock.patch.object(M, "ProcessPoolExecutor", side_effect=TypeError):
+                self.assertIs(M.get_process_pool(1), None)
+                self.assertEqual(M.run_in_processes(pow, [(2, 3), (3, 2)], workers=1), [8, 9])
+        finally:
+            M._PROCESS_POOL.pop("pool", None)
+            if pool is not None:
+                M._PROCESS_POOL["pool"] = pool
+
+    def test_single_flight(self):
+        flight = M.SingleFlight(timeout=5)
+        calls = []
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return calls
+
+        results = M.run_concurrently([lambda: flight.do("k", slow) for _ in range(5)], timeout=5)
+        self.assertEqual(results, [[1]] * 5)
+        self.assertEqual(flight.stats(), {"calls": 1, "shared": 4, "in_flight": 0})
+        self.assertEqual(flight.do("k", lambda: 2), 2)
+
+    def test_single_flight_error_and_timeout(self):
+        flight = M.SingleFlight(timeout=0.1)
+        def slow_fail():
+            time.sleep(0.05)
+            fail()
+
+        futures = [M._EXECUTOR.submit(flight.do, "k", slow_fail) for _ in range(3)]
+        self.assertTrue(all(isinstance(f.exception(), ValueError) for f in futures))
+
+        leader = M._EXECUTOR.submit(flight.do, "k", lambda: time.sleep(0.5))
+        time.sleep(0.05)
+        self.assertRaises(M.DeadlineExceeded, lambda: flight.do("k", lambda: 1))
+        leader.result()
+        self.assertEqual(len(flight), 0)
+
+    def test_single_flight_interrupted_leader(self):
+        flight = M.SingleFlight(timeout=5)
+        def interrupted():
+            time.sleep(0.1)
+            raise gevent.GreenletExit() # as when the leader's greenlet is killed
+
+        leader = M._EXECUTOR.submit(flight.do, "k", interrupted)
+        time.sleep(0.05)
+        # the follower runs the call itself instead of failing with the leader
+        self.assertEqual(flight.do("k", lambda: 2), 2)
+        self.assertIsInstance(leader.exception(), gevent.GreenletExit)
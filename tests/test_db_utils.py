@@ -0,0 +1,100 @@
+import json
+import threading
+import unittest
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import src.db_utils as M
+from src.local_db import LocalDatabase, serve_in_background
+from src.resilience import Overloaded
+
+class FetchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.peers.add(self.client_address)
+        self.server.queries.append(json.loads(body["constraints"]))
+        self.server.projections.append(json.loads(body.get("projection", "null")))
+
+        payload = json.dumps(json.dumps({"resp": []})).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+class TestDBUtilsModule(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FetchHandler)
+        self.server.daemon_threads = True
+        self.server.peers, self.server.queries, self.server.projections = set(), [], []
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addr = "http://127.0.0.1:%d" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_client_reuses_connection(self):
+        client = M.DBClient(self.addr, pool_size=1)
+        for i in range(5):
+            self.assertEqual(client.fetch({"id": i}), {"resp": []})
+        self.assertEqual(self.server.queries, [{"id": i} for i in range(5)])
+        self.assertEqual(len(self.server.peers), 1)
+
+    def test_get_client_is_shared(self):
+        self.assertIs(M.get_client(self.addr), M.get_client(self.addr))
+        self.assertEqual(M.db_fetch(self.addr, {"id": "x"}), {"resp": []})
+
+    def test_get_book_by_invalid_field(self):
+        self.assertRaises(KeyError, lambda: M.get_book_by("isbn", self.addr, "x"))
+
+    def test_fetch_projection(self):
+        client = M.DBClient(self.addr)
+        client.fetch({"id": 1})
+        client.fetch({"id": 1}, {"id": 1, "metadata.title": 1})
+        self.assertEqual(self.server.projections, [None, {"id": 1, "metadata.title": 1}])
+
+    def test_search_page_by_auth_or_title(self):
+        books = [{"id": "b%d" % i, "metadata": {"title": "Title %d" % i, "author": "A"}}
+                 for i in (3, 1, 4, 5, 9, 2, 6)]
+        server = serve_in_background(LocalDatabase(books), port=0)
+        try:
+            addr = "http://127.0.0.1:%d" % server.server_port
+            pages, after = [], None
+            while True:
+                page = M.search_page_by_auth_or_title(addr, "TITLE", 3, after, {"id": 1})["resp"]
+                pages.append([book["id"] for book in page])
+                if len(page) < 3:
+                    break
+                after = page[-1]["id"]
+            self.assertEqual(pages, [["b1", "b2", "b3"], ["b4", "b5", "b6"], ["b9"]])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_guard_counts_service_failures_only(self):
+        server = serve_in_background(LocalDatabase([{"id": "b1"}]), port=0)
+        addr = "http://127.0.0.1:%d" % server.server_port
+        guard = M.make_guard({"enabled": True, "limiter": {},
+                              "breaker": {"failure_threshold": 2, "reset_timeout": 60}})
+        client = M.DBClient(addr, max_retries=0, guard=guard)
+        try:
+            for _ in range(3): # rejected queries
+                self.assertRaises(requests.HTTPError,
+                                  lambda: client.fetch({"id": {"$nin": ["b1"]}}))
+            self.assertFalse(guard.breaker.is_open)
+            self.assertEqual(client.fetch({"id": "b1"}), {"resp": [{"id": "b1"}]})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        client = M.DBClient(addr, max_retries=0, guard=guard) # no kept-alive connection
+        for _ in range(2):
+            self.assertRaises(requests.ConnectionError, lambda: client.fetch({"id": "b1"}))
+        self.assertRaises(Overloaded, lambda: client.fetch({"id": "b1"}))
+        self.assertIsNone(M.make_guard({"enabled": False}))
@@ -0,0 +1,85 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import src.features as M
+from src.logic import EMOTIONS, get_candidates
+
+def make_book(book_id, n_events, max_index, seed):
+    rnd = random.Random(seed)
+    timeline = [[1, rnd.choice(EMOTIONS), "tok", rnd.randrange(max_index)]
+                for _ in range(n_events)]
+    return {"id": book_id, "metadata": {"title": "title " + book_id},
+            "sentiment": {"timeline": timeline}}
+
+class TestFeaturesModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "features")
+        self.books = [make_book("b%d" % i, 20 + 13 * i, 200 + 97 * i, i) for i in range(20)]
+        self.books.append(make_book("empty", 0, 1, 0))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_build_and_load(self):
+        self.assertEqual(M.build_feature_store(self.path, self.books), 21)
+        store = M.FeatureStore(self.path)
+        self.assertEqual(len(store), 21)
+        self.assertIn("b3", store)
+        self.assertNotIn("b99", store)
+        self.assertEqual(store.titles[store.row("b3")], "title b3")
+        self.assertEqual(len(store.timeline("b3")), 20 + 13 * 3)
+        self.assertEqual(len(store.timeline("empty")), 0)
+        self.assertEqual(store.timeline("empty").length, -1)
+
+    def test_updated(self):
+        M.build_feature_store(self.path, self.books, watermark=12.5)
+        store = M.FeatureStore(self.path)
+        self.assertEqual(store.watermark, 12.5)
+
+        timeline = M.FeatureStore(self.path).timeline("b1")
+        updated = store.updated({"b3": timeline, "new": timeline}, removed=["b4"])
+        self.assertEqual(len(updated.timeline("b3")), len(timeline))
+        self.assertIn("new", updated)
+        self.assertNotIn("b4", updated)
+        self.assertRaises(KeyError, lambda: updated.timeline("b4"))
+        self.assertEqual(len(store.timeline("b3")), 20 + 13 * 3)
+        self.assertNotIn("new", store)
+
+        updated = updated.updated({"b4": timeline})
+        self.assertIn("b4", updated)
+        self.assertIn("new", updated)
+
+    def test_compacted(self):
+        M.build_feature_store(self.path, self.books, watermark=12.5)
+        store = M.FeatureStore(self.path)
+        timeline = store.timeline("b1")
+        updated = store.updated({"b3": timeline, "new": timeline}, removed=["b4"],
+                                titles={"new": "title new"})
+        compacted = updated.compacted()
+        self.assertEqual((len(compacted), compacted.n_changed, updated.n_changed), (21, 0, 3))
+        self.assertNotIn("b4", compacted)
+        self.assertEqual(compacted.titles[compacted.row("new")], "title new")
+        self.assertEqual(compacted.titles[compacted.row("b3")], "title b3")
+        for book_id in ["b0", "b3", "new", "empty"]:
+            expected, actual = updated.timeline(book_id), compacted.timeline(book_id)
+            self.assertEqual(actual.length, expected.length)
+            self.assertEqual(actual.scores.tolist(), expected.scores.tolist())
+            self.assertEqual(actual.indices.tolist(), expected.indices.tolist())
+            self.assertEqual(actual.codes.tolist(), expected.codes.tolist())
+
+    def test_rebuild_replaces_store(self):
+        M.build_feature_store(self.path, self.books)
+        M.build_feature_store(self.path, self.books[:2])
+        self.assertEqual(len(M.FeatureStore(self.path)), 2)
+        self.assertEqual(os.listdir(self.tmp), ["features"])
+
+    def test_get_candidates_with_store(self):
+        M.build_feature_store(self.path, self.books[:10])
+        store = M.FeatureStore(self.path)
+        base, matches = self.books[0], self.books
+        self.assertEqual(get_candidates(base, matches, store=store),
+                         get_candidates(base, matches))
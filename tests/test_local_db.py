@@ -0,0 +1,105 @@
+import os
+import tempfile
+import time
+import unittest
+import src.local_db as M
+from src.catalog import generate_catalog, load_catalog, make_filters, write_catalog
+from src.db_utils import DBClient
+from src.utils import make_query
+
+BOOKS = [
+    {"id": "b1", "metadata": {"title": "Dune", "author": "Frank Herbert"},
+     "genre": {"characters": {"labels": {"aliens": 1, "robots": 0}}}, "tags": ["desert", "spice"]},
+    {"id": "b2", "metadata": {"title": "Solaris", "author": "Stanislaw Lem"},
+     "genre": {"characters": {"labels": {"aliens": 1, "robots": 1}}}},
+    {"id": "b3", "metadata": {"title": "I, Robot", "author": "Isaac Asimov"},
+     "genre": {"characters": {"labels": {"aliens": 0, "robots": 1}}}, "tags": ["robots"]}
+]
+
+class TestLocalDBModule(unittest.TestCase):
+
+    def setUp(self):
+        self.db = M.LocalDatabase(BOOKS)
+        self.find_ids = lambda query: [book["id"] for book in self.db.find(query)]
+
+    def test_equality_and_dotted_paths(self):
+        self.assertEqual(self.find_ids({"id": "b2"}), ["b2"])
+        self.assertEqual(self.find_ids({"genre.characters.labels.robots": 1}), ["b2", "b3"])
+        self.assertEqual(self.find_ids({"genre.characters.labels.dragons": None}),
+                         ["b1", "b2", "b3"])
+        self.assertEqual(self.find_ids({"tags": "robots"}), ["b3"])
+        self.assertEqual(self.find_ids({}), ["b1", "b2", "b3"])
+
+    def test_in_and_regex(self):
+        self.assertEqual(self.find_ids({"id": {"$in": ["b3", "b1", "b9", "b3"]}}), ["b3", "b1"])
+        self.assertEqual(self.find_ids({"genre.characters.labels.aliens": {"$in": [0]}}), ["b3"])
+        self.assertEqual(self.find_ids({"metadata.author": {"$regex": "(lem)\\w*"}}), [])
+        self.assertEqual(self.find_ids({"metadata.author": {"$regex": "(lem)\\w*",
+                                                            "$options": "i"}}), ["b2"])
+
+    def test_comparisons(self):
+        db = M.LocalDatabase([{"id": "a", "t": 1}, {"id": "b", "t": 2.5}, {"id": "c", "t": "x"},
+                              {"id": "d"}])
+        self.assertEqual([b["id"] for b in db.find({"t": {"$gt": 1}})], ["b"])
+        self.assertEqual([b["id"] for b in db.find({"t": {"$gte": 1, "$lt": 3}})], ["a", "b"])
+        self.assertEqual([b["id"] for b in db.find({"t": {"$lte": "z"}})], ["c"])
+
+    def test_ne(self):
+        self.assertEqual(self.find_ids({"id": {"$ne": "b1"}}), ["b2", "b3"])
+        self.assertEqual(self.find_ids({"tags": {"$ne": "robots"}}), ["b1", "b2"])
+        self.assertEqual(self.find_ids({"deleted": {"$ne": True}}), ["b1", "b2", "b3"])
+
+    def test_sort_and_limit(self):
+        self.assertEqual([b["id"] for b in self.db.find({}, sort=[["metadata.title", -1]])],
+                         ["b2", "b3", "b1"])
+        self.assertEqual([b["id"] for b in self.db.find({}, sort=[["tags", 1], ["id", -1]])],
+                         ["b2", "b1", "b3"])
+        self.assertEqual(self.find_ids({"id": {"$gt": "b1"}}), ["b2", "b3"])
+        self.assertEqual([b["id"] for b in self.db.find({}, limit=2)], ["b1", "b2"])
+        self.assertEqual(len(self.db.find({}, limit=0)), 3)
+        self.assertRaises(ValueError, lambda: self.db.find({}, sort=[["id", 0]]))
+
+    def test_or_and(self):
+        query = {"$or": [{"metadata.title": "Dune"}, {"genre.characters.labels.aliens": 0}]}
+        self.assertEqual(self.find_ids(query), ["b1", "b3"])
+        query = {"$and": [{"genre.characters.labels.aliens": 1}, {"id": {"$in": ["b2", "b3"]}}]}
+        self.assertEqual(self.find_ids(query), ["b2"])
+
+    def test_make_query(self):
+        query = make_query(make_filters(author="isaac", characters=("dragons",)))
+        query["$or"] = query["$or"][:2]
+        self.assertEqual(self.find_ids(query), ["b3"])
+
+    def test_unsupported_operator(self):
+        self.assertRaises(ValueError, lambda: self.db.find({"id": {"$nin": ["b1"]}}))
+        self.assertRaises(ValueError, lambda: self.db.find({"$nor": []}))
+
+    def test_projection(self):
+        self.assertEqual(self.db.find({"id": "b1"}, {"id": 1, "metadata.title": 1, "x.y": 1}),
+                         [{"id": "b1", "metadata": {"title": "Dune"}}])
+        self.assertEqual(self.db.find({"id": "b3"}, {"genre": 0, "metadata.author": 0}),
+                         [{"id": "b3", "metadata": {"title": "I, Robot"}, "tags": ["robots"]}])
+        self.assertIn("author", BOOKS[2]["metadata"])
+
+    def test_server(self):
+        server = M.serve_in_background(self.db, port=0, latency=0.05)
+        try:
+            client = DBClient("http://127.0.0.1:%d" % server.server_port)
+            start = time.monotonic()
+            self.assertEqual(client.fetch({"id": "b2"}, {"id": 1}), {"resp": [{"id": "b2"}]})
+            self.assertGreaterEqual(time.monotonic() - start, 0.05)
+            self.assertEqual(client.fetch({}, {"id": 1}, sort=[["id", -1]], limit=2),
+                             {"resp": [{"id": "b3"}, {"id": "b2"}]})
+            self.assertRaises(Exception, lambda: client.fetch({"id": {"$nin": [1]}}))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_catalog_files(self):
+        books = generate_catalog(3, median_events=20)
+        with tempfile.TemporaryDirectory() as tmp:
+            write_catalog(os.path.join(tmp, "books.ndjson"), books)
+            self.assertEqual(load_catalog(os.path.join(tmp, "books.ndjson")), books)
+            with open(os.path.join(tmp, "books.json"), "w") as catalog_ptr:
+                catalog_ptr.write(" [] ")
+            self.assertEqual(load_catalog(os.path.join(tmp, "books.json")), [])
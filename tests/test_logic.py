@@ -1,6 +1,38 @@
+import pickle
+import random
 import unittest
+import numpy as np
 import src.logic as M
 
+SIGNS = {"sadness": -1, "fear": -1, "joy": 1, "surprise": 1, "anger": -1, "love": 1}
+
+def make_book(title, n_events, max_index, seed):
+    rnd = random.Random(seed)
+    timeline = []
+    for _ in range(n_events):
+        emotion = rnd.choice(M.EMOTIONS)
+        timeline.append([SIGNS[emotion], emotion, "tok", rnd.randrange(max_index)])
+    return {"id": title, "metadata": {"title": title}, "sentiment": {"timeline": timeline}}
+
+def reference_scores(base, matches):
+    get_timeline = lambda o: M.reshape_transform(o["sentiment"]["timeline"])
+    base_sentiment = get_timeline(base)
+    matches_sentiment = [get_timeline(o) for o in matches]
+    max_len = M.get_max_len([base_sentiment, *matches_sentiment]) + 1
+    base_vec = M.fill_obj(base_sentiment, max_len)
+    return list(M.compute_score(M.similarity(base_vec, M.fill_obj(o, max_len))
+                                for o in matches_sentiment))
+
+def reference_dtw(x_series, y_series, window):
+    n = len(x_series)
+    costs = [[float("inf")] * (n + 1) for _ in range(n + 1)]
+    costs[0][0] = 0
+    for i in range(1, n + 1):
+        for j in range(max(1, i - window), min(n, i + window) + 1):
+            costs[i][j] = (x_series[i - 1] - y_series[j - 1]) ** 2 + \
+                min(costs[i - 1][j], costs[i][j - 1], costs[i - 1][j - 1])
+    return costs[n][n]
+
 class TestLogicModule(unittest.TestCase):
 
     def test_reshape_transform_valid_data(self):
@@ -36,3 +68,132 @@ class TestLogicModule(unittest.TestCase):
 
     def test_chunk_sum_invalid_data(self):
         self.assertEqual(M.chunk_sum(range(10)), [*range(10), *[0 for _ in range(90)]])
+
+    def test_chunk_layout(self):
+        self.assertEqual(M.chunk_layout(10), (100, 1))
+        self.assertEqual(M.chunk_layout(1000), (100, 10))
+        self.assertEqual(M.chunk_layout(199), (199, 1))
+        self.assertEqual(M.chunk_layout(1050), (105, 10))
+
+    def test_vectorize_matches_chunk_sum(self):
+        timeline = {k: [] for k in M.EMOTIONS}
+        timeline["joy"] = [(1, 0), (1, 250), (2, 1049)]
+        timeline["fear"] = [(-1, 7), (-3, 7)]
+        expected = [M.chunk_sum(M.fill(timeline[k], 1050)) for k in M.EMOTIONS]
+        self.assertEqual(M.vectorize([timeline], 1050)[0].tolist(), expected)
+
+    def test_vectorize_index_out_of_range(self):
+        timeline = {k: [] for k in M.EMOTIONS}
+        timeline["joy"] = [(1, 10)]
+        self.assertRaises(IndexError, lambda: M.vectorize([timeline], 10))
+
+    def test_get_candidates_matches_reference(self):
+        base = make_book("base", 300, 5000, 0)
+        matches = [base, *[make_book("b%d" % i, 50 + i * 7, 300 + i * 211, i + 1)
+                           for i in range(40)]]
+        expected = {"base": [{"score": score, "title": o["metadata"]["title"], "id": o["id"]}
+                             for score, o in zip(reference_scores(base, matches), matches)]}
+        self.assertEqual(M.get_candidates(base, matches), expected)
+
+    def test_get_candidates_no_matches(self):
+        self.assertEqual(M.get_candidates(make_book("base", 10, 50, 0), []), {"base": []})
+
+    def test_bucket_timeline_matches_chunk_sum(self):
+        timeline = {k: [] for k in M.EMOTIONS}
+        timeline["sadness"] = [(-1, 3), (-1, 1049)]
+        timeline["love"] = [(1, 0), (2, 0), (1, 42), (3, -1)]
+        for max_len in (1050, 1999, 4321, 98001):
+            expected = [M.chunk_sum(M.fill(timeline[k], max_len)) for k in M.EMOTIONS]
+            self.assertEqual(M.bucket_timeline(timeline, max_len).tolist(), expected)
+
+    def test_bucket_timeline_short_vector(self):
+        timeline = {k: [] for k in M.EMOTIONS}
+        timeline["anger"] = [(-1, 2), (-2, 9)]
+        expected = [M.chunk_sum(M.fill(timeline[k], 10)) for k in M.EMOTIONS]
+        self.assertEqual(M.bucket_timeline(timeline, 10).tolist(), expected)
+
+    def test_get_top_candidates_matches_sorted_candidates(self):
+        base = make_book("base", 300, 5000, 0)
+        matches = [make_book("b%d" % i, 5 + i * 3, 300 + i * 211, i + 1) for i in range(40)]
+        matches += [base, matches[3], make_book("none", 0, 1, 0)]
+        for book, emotions in zip(matches[:20], range(20)):
+            kept = M.EMOTIONS[:1 + emotions % 6]
+            book["sentiment"]["timeline"] = [e for e in book["sentiment"]["timeline"]
+                                             if e[1] in kept]
+
+        entries = list(enumerate(M.get_candidates(base, matches)["base"]))
+        for top_n in (0, 1, 6, 25, 100):
+            best = sorted(entries, key=lambda x: x[1]["score"], reverse=True)[:top_n]
+            expected = [entry for _, entry in sorted(best, key=lambda x: x[0])]
+            self.assertEqual(M.get_top_candidates(base, matches, top_n), {"base": expected})
+
+    def test_get_sharded_top_candidates_matches_top_candidates(self):
+        base = make_book("base", 300, 5000, 0)
+        matches = [make_book("b%d" % i, 5 + i * 3, 300 + i * 211, i + 1) for i in range(40)]
+        matches += [base, matches[3]]
+        # shards are sent to other processes, so their arguments go through pickle
+        run_shards = lambda func, shards: [func(*pickle.loads(pickle.dumps(args)))
+                                           for args in shards]
+        for top_n, n_shards in [(0, 3), (1, 1), (6, 4), (25, 7), (100, 50)]:
+            self.assertEqual(M.get_sharded_top_candidates(base, matches, top_n, run_shards,
+                                                          n_shards),
+                             M.get_top_candidates(base, matches, top_n))
+
+    def test_get_batch_candidates_matches_top_candidates(self):
+        matches = [make_book("b%d" % i, 5 + i * 3, 300 + i * 211, i + 1) for i in range(30)]
+        bases = [matches[4], matches[17], matches[4], matches[0]]
+        results = M.get_batch_candidates(bases, matches, 6)
+        self.assertEqual(len(results), 4)
+        for base, result in zip(bases, results):
+            expected = M.get_top_candidates(base, matches, 6)
+            self.assertEqual([e["id"] for e in result[base["id"]]],
+                             [e["id"] for e in expected[base["id"]]])
+            for entry, expected_entry in zip(result[base["id"]], expected[base["id"]]):
+                self.assertAlmostEqual(entry["score"], expected_entry["score"], places=12)
+
+    def test_get_batch_candidates_base_outside_matches(self):
+        matches = [make_book("b%d" % i, 20, 300, i + 1) for i in range(5)]
+        result = M.get_batch_candidates([make_book("base", 20, 200, 0)], matches, 2)
+        self.assertEqual(len(result[0]["base"]), 2)
+        self.assertEqual(M.get_batch_candidates([], matches, 2), [])
+
+    def test_dtw_distance_matches_reference(self):
+        rnd = np.random.RandomState(0)
+        for n_chunks, window in [(1, 0), (2, 1), (9, 0), (9, 2), (30, 4), (12, 40)]:
+            base, tensor = rnd.randn(6, n_chunks), rnd.randn(3, 6, n_chunks)
+            distances = M.dtw_distance(base, tensor, window)
+            expected = [[reference_dtw(base[e], book[e], window) for e in range(6)]
+                        for book in tensor]
+            np.testing.assert_allclose(distances, expected)
+
+            upper, lower = M.envelope(base, window)
+            self.assertTrue((M.lb_kim(base, tensor) <= distances + 1e-9).all())
+            self.assertTrue((M.lb_keogh(upper, lower, tensor) <= distances + 1e-9).all())
+
+    def test_dtw_similarity_without_warping_is_cosine(self):
+        base = make_book("base", 300, 5000, 0)
+        matches = [make_book("b%d" % i, 5 + i * 3, 300 + i * 211, i + 1) for i in range(10)]
+        tensor = M.vectorize([M.reshape_transform(book["sentiment"]["timeline"])
+                              for book in [base, *matches]], 5000)
+        tensor[3, 2] = 0
+        np.testing.assert_allclose(M.dtw_similarity(tensor[0], tensor[1:], 0),
+                                   M.batch_similarity(tensor[0], tensor[1:]), atol=1e-12)
+        self.assertTrue((M.dtw_similarity(tensor[0], tensor[1:], 5) >=
+                         M.dtw_similarity(tensor[0], tensor[1:], 0) - 1e-12).all())
+
+    def test_get_dtw_top_candidates_matches_full_dtw(self):
+        base = make_book("base", 300, 5000, 0)
+        matches = [make_book("b%d" % i, 5 + i * 3, 300 + i * 211, i + 1) for i in range(40)]
+        matches += [base, make_book("none", 0, 1, 0)]
+        timelines = [M.reshape_transform(book["sentiment"]["timeline"])
+                     for book in [base, *matches]]
+        tensor = M.vectorize(timelines, M.get_max_len(timelines) + 1)
+        scores = M.batch_score(M.dtw_similarity(tensor[0], tensor[1:], 3)).tolist()
+
+        for top_n in (0, 1, 6, 50):
+            best = sorted(range(len(matches)), key=lambda i: (-scores[i], i))[:top_n]
+            result = M.get_dtw_top_candidates(base, matches, top_n, 3, batch_size=4)["base"]
+            self.assertEqual([entry["id"] for entry in result],
+                             [matches[i]["id"] for i in sorted(best)])
+            for entry, i in zip(result, sorted(best)):
+                self.assertAlmostEqual(entry["score"], scores[i], places=12)
@@ -0,0 +1,44 @@
+import unittest
+import src.metrics as M
+from src.cache import get_cache
+
+class TestMetricsModule(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = M.Histogram("test_seconds", "Test.", buckets=(0.1, 1), labelnames=("stage",))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "a")
+        with histogram.time("b"):
+            pass
+
+        lines = histogram.collect()
+        self.assertEqual(lines[:2], ["# HELP test_seconds Test.", "# TYPE test_seconds histogram"])
+        self.assertEqual(lines[2:7], ['test_seconds_bucket{stage="a",le="0.1"} 2',
+                                      'test_seconds_bucket{stage="a",le="1.0"} 3',
+                                      'test_seconds_bucket{stage="a",le="+Inf"} 4',
+                                      'test_seconds_sum{stage="a"} 3.65',
+                                      'test_seconds_count{stage="a"} 4'])
+        self.assertIn('test_seconds_count{stage="b"} 1', lines)
+
+    def test_counter(self):
+        counter = M.Counter("test_total", "Test.", labelnames=("path",))
+        counter.inc("/a\"b")
+        counter.inc("/a\"b", amount=2)
+        self.assertEqual(counter.collect()[2], 'test_total{path="/a\\"b"} 3.0')
+
+    def test_gauge(self):
+        gauge = M.Gauge("test_limit", "Test.")
+        gauge.set(3)
+        gauge.set(2.5)
+        self.assertEqual(gauge.collect(), ["# HELP test_limit Test.", "# TYPE test_limit gauge",
+                                           "test_limit 2.5"])
+
+    def test_render(self):
+        get_cache("metrics-test").get("missing")
+        with M.stage("unit_test"):
+            pass
+
+        text = M.render()
+        self.assertTrue(text.endswith("\n"))
+        self.assertIn('cache_misses_total{cache="metrics-test"} 1.0', text)
+        self.assertIn('recommendation_stage_seconds_count{stage="unit_test"} 1', text)
@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+import src.models as M
+from src.logic import get_candidates, get_max_len, reshape_transform
+
+class TestModelsModule(unittest.TestCase):
+
+    def setUp(self):
+        self.events = [[1, "fear", "dread", 3], [2, "joy", "hope", 12], [2, "joy", "glee", 7],
+                       [-1, "fear", "gloom", 2], [1, "love", "care", 5]]
+        self.obj = {"id": "b1", "metadata": {"title": "Title", "author": "Author"},
+                    "sentiment": {"timeline": self.events}}
+
+    def test_timeline_from_json(self):
+        timeline = M.SentimentTimeline.from_json(self.events)
+        self.assertEqual(len(timeline), 5)
+        self.assertEqual(timeline.codes.tolist(), [1, 2, 2, 1, 5])
+        self.assertEqual(timeline.indices.tolist(), [3, 12, 7, 2, 5])
+        self.assertEqual(timeline.scores.tolist(), [1, 2, 2, -1, 1])
+        self.assertEqual(timeline.codes.dtype, np.uint8)
+        self.assertEqual(M.SentimentTimeline.from_json([[0.1, "joy", "a", 1]]).scores.tolist(),
+                         [0.1])
+
+    def test_timeline_length_matches_get_max_len(self):
+        for events in [self.events, [], [[1, "joy", "a", 3], [1, "joy", "b", 2]]]:
+            self.assertEqual(M.SentimentTimeline.from_json(events).length,
+                             get_max_len([reshape_transform(events)]))
+
+    def test_book_from_json(self):
+        book = M.Book.from_json(self.obj)
+        self.assertEqual((book.id, book.title), ("b1", "Title"))
+        self.assertEqual(len(book.timeline), 5)
+        self.assertFalse(hasattr(book, "__dict__"))
+
+    def test_book_without_timeline(self):
+        book = M.Book.from_json({"id": "b2", "metadata": {"title": "Other"}})
+        self.assertIsNone(book.timeline)
+
+    def test_as_book(self):
+        book = M.Book.from_json(self.obj)
+        self.assertIs(M.as_book(book), book)
+        self.assertEqual(M.as_book(self.obj).id, "b1")
+
+    def test_scoring_accepts_books(self):
+        other = {"id": "b2", "metadata": {"title": "Other"},
+                 "sentiment": {"timeline": [[0.3, "joy", "x", 4], [0.7, "fear", "y", 8],
+                                            [0.1, "fear", "z", 3]]}}
+        self.assertEqual(get_candidates(M.Book.from_json(self.obj), [M.Book.from_json(other)]),
+                         get_candidates(self.obj, [other]))
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+import src.resilience as M
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+def fail():
+    raise ValueError("failed")
+
+class TestResilienceModule(unittest.TestCase):
+
+    def test_limiter_aimd(self):
+        limiter = M.AdaptiveLimiter(initial_limit=4, min_limit=2, max_limit=5,
+                                    latency_threshold=1)
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertTrue(4.9 < limiter.limit < 5)
+        limit = limiter.limit
+        limiter.acquire()
+        limiter.release(2)
+        self.assertAlmostEqual(limiter.limit, limit * 0.7)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0, failed=True)
+        self.assertEqual((limiter.limit, limiter.in_flight), (2, 0))
+
+    def test_limiter_sheds(self):
+        limiter = M.AdaptiveLimiter(initial_limit=1, min_limit=1, max_waiting=1,
+                                    queue_timeout=0.05)
+        limiter.acquire()
+        start = time.monotonic()
+        self.assertRaises(M.Overloaded, limiter.acquire)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+        # a waiting call gets the slot once it's freed, another one is turned away at once
+        waiter = threading.Thread(target=lambda: limiter.acquire())
+        limiter.queue_timeout = 5
+        waiter.start()
+        while not limiter.waiting:
+            time.sleep(0.001)
+        self.assertRaises(M.Overloaded, limiter.acquire)
+        limiter.release(0)
+        waiter.join()
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_breaker(self):
+        timer = FakeTimer()
+        breaker = M.CircuitBreaker(failure_threshold=2, reset_timeout=10, timer=timer)
+        for failed in (True, False, True, True):
+            breaker.before_call()
+            breaker.after_call(failed)
+        self.assertTrue(breaker.is_open)
+        self.assertRaises(M.CircuitOpen, breaker.before_call)
+
+        # half-open: a single trial call, which fails, then one which succeeds
+        timer.now = 10
+        breaker.before_call()
+        self.assertRaises(M.CircuitOpen, breaker.before_call)
+        breaker.after_call(failed=True)
+        self.assertRaises(M.CircuitOpen, breaker.before_call)
+        timer.now = 20
+        breaker.before_call()
+        breaker.after_call(failed=False)
+        self.assertFalse(breaker.is_open)
+
+    def test_guard(self):
+        guard = M.Guard(M.AdaptiveLimiter(initial_limit=2),
+                        M.CircuitBreaker(failure_threshold=2),
+                        is_failure=lambda error: not isinstance(error, KeyError))
+        self.assertEqual(guard.call(lambda: 1), 1)
+        for _ in range(3):
+            self.assertRaises(KeyError, lambda: guard.call(lambda: {}["x"]))
+        self.assertFalse(guard.breaker.is_open)
+
+        self.assertRaises(ValueError, lambda: guard.call(fail))
+        self.assertRaises(ValueError, lambda: guard.call(fail))
+        self.assertRaises(M.CircuitOpen, lambda: guard.call(lambda: 1))
+        self.assertEqual(guard.limiter.in_flight, 0)
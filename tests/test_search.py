@@ -0,0 +1,55 @@
+import unittest
+import src.search as M
+
+BOOKS = [
+    {"id": "1", "metadata": {"title": "Stranger in a Strange Land", "author": "Robert A. Heinlein"}},
+    {"id": "2", "metadata": {"title": "The Moon Is a Harsh Mistress", "author": "Robert A. Heinlein"}},
+    {"id": "3", "metadata": {"title": "Solaris", "author": "Stanisław Lem"}},
+    {"id": "4", "metadata": {"title": "Heinlein's Children", "author": "Joseph T. Major"}},
+    {"id": "5", "metadata": {"title": "Les Misérables", "author": "Victor Hugo"}},
+]
+
+class TestSearchModule(unittest.TestCase):
+
+    def setUp(self):
+        self.index = M.SearchIndex(BOOKS)
+
+    def test_tokenize(self):
+        self.assertEqual(M.tokenize("Les Misérables"), ["les", "miserables"])
+        self.assertEqual(M.tokenize(None), [])
+
+    def test_prefix_and_case(self):
+        self.assertEqual(self.index.search("sol", 10), ["3"])
+        self.assertEqual(self.index.search("MISER", 10), ["5"])
+        self.assertEqual(self.index.search("misérables", 10), ["5"])
+
+    def test_ranking(self):
+        # title matches before author matches, then by title
+        self.assertEqual(self.index.search("heinlein", 10), ["4", "1", "2"])
+        self.assertEqual(self.index.search("heinl", 10), ["4", "1", "2"])
+        self.assertEqual(self.index.search("robert strange", 10), ["1"])
+
+    def test_all_tokens_must_match(self):
+        self.assertEqual(self.index.search("heinlein solaris", 10), [])
+        self.assertEqual(self.index.search("xyz", 10), [])
+
+    def test_limit(self):
+        self.assertEqual(self.index.search("heinlein", 2), ["4", "1"])
+        self.assertEqual(self.index.search("", 3), ["1", "2", "3"])
+
+    def test_updated(self):
+        index = self.index.updated(
+            [{"id": "3", "metadata": {"title": "Fiasco", "author": "Stanisław Lem"}},
+             {"id": "6", "metadata": {"title": "Starship Troopers", "author": "Robert A. Heinlein"}}],
+            removed=["4", "9"])
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.search("heinlein", 10), ["6", "1", "2"])
+        self.assertEqual(index.search("solaris", 10), [])
+        self.assertEqual(index.search("fiasco", 10), ["3"])
+        self.assertEqual(index.search("", 10), ["1", "2", "3", "5", "6"])
+        # the original index is untouched
+        self.assertEqual(self.index.search("heinlein", 10), ["4", "1", "2"])
+        self.assertEqual(self.index.search("solaris", 10), ["3"])
+
+        index = index.updated([{"id": "4", "metadata": {"title": "Heinlein's Children"}}])
+        self.assertEqual(index.search("heinlein", 10), ["4", "6", "1", "2"])
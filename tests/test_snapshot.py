@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+import src.snapshot as M
+from src import features, search
+from src.cache import get_cache
+from src.utils import recommendation_key
+
+ADDR = "http://snapshot.test"
+BOOKS = [
+    {"id": "b1", "metadata": {"title": "Dune", "author": "Frank Herbert"}},
+    {"id": "b2", "metadata": {"title": "Solaris", "author": "Stanislaw Lem"}},
+    {"id": "b3", "metadata": {"title": "I, Robot", "author": "Isaac Asimov"}}
+]
+
+class TestSnapshotModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "snapshot.npz")
+        features._STORE["store"] = None
+        self.books, self.recommendations = get_cache("books"), get_cache("recommendations")
+        self.books.clear()
+        self.recommendations.clear()
+
+        self.books.set((ADDR, "b1"), {"resp": [BOOKS[0]]})
+        self.books.set((ADDR, "b2"), {"resp": [BOOKS[1]]}, ttl=-10)
+        self.books.set((ADDR, "b3"), {"resp": [BOOKS[2]]}, ttl=-self.books.stale_ttl - 10)
+        self.recommendations.set(recommendation_key("b1", {}),
+                                 ('[{"id": "b2"}]', "exact", ("b2",)))
+        search.swap_search_index(ADDR, search.SearchIndex(BOOKS).updated([], ["b3"]))
+
+    def tearDown(self):
+        self.books.clear()
+        self.recommendations.clear()
+        features._STORE.clear()
+        search._INDEX.pop(ADDR, None)
+        shutil.rmtree(self.tmp)
+
+    def _reset(self):
+        self.books.clear()
+        self.recommendations.clear()
+        search._INDEX.pop(ADDR, None)
+
+    def test_round_trip(self):
+        self.assertEqual(M.save_snapshot(self.path, ADDR),
+                         {"books": 3, "recommendations": 1, "search_index": 2})
+        self.assertEqual(os.listdir(self.tmp), ["snapshot.npz"])
+        self._reset()
+
+        self.assertEqual(M.load_snapshot(self.path, ADDR, max_age=60),
+                         {"books": 2, "recommendations": 1, "search_index": 2})
+        self.assertEqual(self.books.get((ADDR, "b1")), {"resp": [BOOKS[0]]})
+        self.assertEqual(self.books.get((ADDR, "b2")), None)
+        self.assertEqual(self.books.get_stale((ADDR, "b2")), {"resp": [BOOKS[1]]})
+        self.assertEqual(self.books.get_stale((ADDR, "b3")), None)
+        self.assertEqual(self.recommendations.get(recommendation_key("b1", {})),
+                         ('[{"id": "b2"}]', "exact", ("b2",)))
+        index = search.peek_search_index(ADDR)
+        self.assertEqual(index.search("lem", 10), ["b2"])
+        self.assertEqual(index.search("asimov", 10), [])
+
+    def test_nothing_to_save(self):
+        self._reset()
+        self.assertEqual(M.save_snapshot(self.path, ADDR),
+                         {"books": 0, "recommendations": 0, "search_index": 0})
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(M.load_snapshot(self.path, ADDR, max_age=60), None)
+
+    def test_ignored_snapshots(self):
+        M.save_snapshot(self.path, ADDR)
+        self._reset()
+
+        self.assertEqual(M.load_snapshot(self.path, "http://other.test", max_age=60), None)
+        features._STORE["store"] = type("Store", (), {"watermark": 5})()
+        self.assertEqual(M.load_snapshot(self.path, ADDR, max_age=60), None)
+        features._STORE["store"] = None
+
+        with np.load(self.path) as arrays:
+            arrays = dict(arrays)
+        header = json.loads(arrays["header"].tobytes().decode("utf-8"))
+        for changes in [{"version": M.FORMAT_VERSION + 1}, {"created_at": time.time() - 120}]:
+            arrays["header"] = M._to_array({**header, **changes})
+            np.savez_compressed(self.path, **arrays)
+            self.assertEqual(M.load_snapshot(self.path, ADDR, max_age=60), None)
+
+        with open(self.path, "wb") as snapshot_ptr:
+            snapshot_ptr.write(b"not a snapshot")
+        self.assertEqual(M.load_snapshot(self.path, ADDR, max_age=60), None)
+        self.assertEqual(len(self.books), 0)
+        self.assertEqual(search.peek_search_index(ADDR), None)
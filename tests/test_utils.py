@@ -48,9 +48,58 @@ class TestUtilsModule(unittest.TestCase):
 
 
     def test_preprocess_resp(self):
-        obj = """{"resp": [{"sentiment":
-                         {"timeline": [[1, "joy", "hope", 1936],
-                                       [1, "joy", "hope", 3597]]}}]}"""
-        self.assertEqual(M.preprocess_resp(obj), '[{"sentiment": {"timeline": \
-                                                    [[1, "joy", "hope", 1936], \
-                                                    [1, "joy", "hope", 3597]]}}]'.replace("  ", ""))
+        obj = {"resp": [{"sentiment": {"timeline": [[1, "joy", "hope", 1936],
+                                                    [1, "joy", "hope", 3597]]}}]}
+        self.assertEqual(M.preprocess_resp(obj), [{"sentiment": {"timeline": [
+            [1, "joy", "hope", 1936], [1, "joy", "hope", 3597]]}}])
+
+    def test_get_sorted_uses_known_docs(self):
+        docs = [{"id": i, "metadata": {"title": "t%d" % i},
+                 "sentiment": {"overall": [{"book": i}]}} for i in range(8)]
+        scores = {"t0": [{"score": 6 - i / 2, "title": "t%d" % i, "id": i} for i in range(8)]}
+        resp = M.get_sorted("t0", scores, top_n=3, base_id=0, docs=docs)
+        self.assertEqual([r["score"] for r in resp], [5.5, 5, 4.5])
+        self.assertEqual([r["title"]["id"] for r in resp], [1, 2, 3])
+        self.assertEqual(resp[0]["title"]["sentiment"]["overall"], [{"book": 0}, {"book": 1}])
+        self.assertEqual(docs[1]["sentiment"]["overall"], [{"book": 1}])
+
+    def test_get_sorted_without_base_in_scores(self):
+        docs = [{"id": i, "metadata": {"title": "t%d" % i},
+                 "sentiment": {"overall": [{"book": i}]}} for i in range(4)]
+        # the base book was left out by the filters, the best match is the first one
+        scores = {"t0": [{"score": 6 - i, "title": "t%d" % i, "id": i} for i in range(1, 4)]}
+        resp = M.get_sorted("t0", scores, top_n=2, base_id=0, docs=docs)
+        self.assertEqual([r["title"]["id"] for r in resp], [1, 2])
+        self.assertEqual(resp[0]["title"]["sentiment"]["overall"], [{"book": 0}, {"book": 1}])
+
+    def test_recommendation_key_ignores_ui_fields_and_case(self):
+        filters = {"characters": {"aliens": 1}, "spaceSetting": {"outerspace": 0},
+                   "metadata": {"author": {"value": "Robert A. Heinlein", "label": "Author:",
+                                           "state": 1, "initial": None}}}
+        other = {"characters": {"aliens": 1}, "spaceSetting": {"outerspace": 0},
+                 "metadata": {"author": {"value": "robert a. heinlein", "label": "",
+                                         "state": 2}}}
+        self.assertEqual(M.recommendation_key("x", M.make_query(filters)),
+                         M.recommendation_key("x", M.make_query(other)))
+        self.assertNotEqual(M.recommendation_key("x", M.make_query(filters)),
+                            M.recommendation_key("y", M.make_query(filters)))
+        self.assertNotEqual(M.recommendation_key("x", M.make_query(filters), 5),
+                            M.recommendation_key("x", M.make_query(filters), 10))
+
+    def test_recommendation_key_keeps_case_of_regex_syntax(self):
+        make_filters = lambda author: {"characters": {}, "spaceSetting": {},
+                                       "metadata": {"author": {"value": author}}}
+        for author, other in [(r"\W", r"\w"), (r"[^A-Z]", r"[^a-z]"), (r"(?P<A>x)", r"(?P<a>x)")]:
+            self.assertNotEqual(M.recommendation_key("x", M.make_query(make_filters(author))),
+                                M.recommendation_key("x", M.make_query(make_filters(other))))
+
+    def test_make_projection(self):
+        self.assertEqual(M.make_projection("metadata, sentiment.overall,"),
+                         {"id": 1, "metadata": 1, "sentiment.overall": 1})
+        self.assertRaises(ValueError, lambda: M.make_projection("metadata,$where"))
+        self.assertRaises(ValueError, lambda: M.make_projection("sentiment..overall"))
+
+    def test_cursor(self):
+        self.assertEqual(M.decode_cursor(M.encode_cursor({"after": "b/1"})), {"after": "b/1"})
+        for cursor in ("zz", "!!", M.encode_cursor([1])):
+            self.assertRaises(ValueError, lambda: M.decode_cursor(cursor))